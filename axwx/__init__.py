@@ -1,8 +1,16 @@
 from .get_wu_data import *
 from .merge_datasets import *
+from .station_cache import *
 from .wsp_cleaning import *
 from .wu_cleaning import *
+from .wu_concurrency import *
+from .wu_fetch import *
+from .wu_http import *
 from .wu_metadata_scraping import *
+from .wu_obs_store import *
 from .wu_observation_scraping import *
+from .wu_response_cache import *
+from .wu_scrape_manifest import *
+from .wu_station_store import *
 
 from .wu_metadata_scraping_test import *
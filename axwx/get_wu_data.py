@@ -1,14 +1,19 @@
+from axwx import wu_fetch
 from axwx import wu_metadata_scraping as wumeta
 from axwx import wu_observation_scraping as wuobs
+from axwx.wu_obs_store import ObsStore
+from axwx.wu_response_cache import ResponseCache
 
 
 def get_wu_obs(station_data_csv, startdate, enddate, data_dir, index_start=0,
                index_end=-1, lat_range=[47.4, 47.8],
-               lon_range=[-122.5, -122.2]):
+               lon_range=[-122.5, -122.2], cache_dir=None, resume=False,
+               store_dir=None, span_days=1, concurrency=None,
+               requests_per_sec=2):
     """
     Pull PWS observations from WU
-    :param station_data_csv: str
-        station data csv filepath
+    :param station_data_csv: str or wu_station_store.StationStore
+        station data csv filepath, or station store
     :param startdate int
         start date for data to retrieve (YYYYMMDD)
     :param enddate int
@@ -19,8 +24,38 @@ def get_wu_obs(station_data_csv, startdate, enddate, data_dir, index_start=0,
         index start for station list
     :param index_end: int
         index end for station list
+    :param cache_dir: str
+        directory for a persistent cache of raw WU responses, so that
+        station-days already retrieved aren't downloaded again (no caching
+        if None)
+    :param resume: bool
+        if True, keep a manifest of completed station-days in data_dir, so
+        that rerunning after an interruption picks up where it left off
+        (see wu_observation_scraping.scrape_data_multiple_stations_and_days)
+    :param store_dir: str
+        directory of a partitioned observation store (see wu_obs_store) to
+        save data to, instead of one pickle file per station in data_dir;
+        only the store writes days as they arrive, while pickle files keep
+        each station's date range in memory until it's complete
+    :param span_days: int
+        maximum number of days retrieved per request; e.g. 7 or 31 to
+        retrieve a week or a month at a time, for far fewer requests
+        (see wu_observation_scraping.scrape_data_multiple_day)
+    :param concurrency: int
+        if given, retrieve station-days with this many requests in flight
+        (see wu_fetch.scrape_data_multiple_stations_and_days_async), rather
+        than one at a time; resume and span_days (other than 1) are not
+        supported then, and raise ValueError
+    :param requests_per_sec: float
+        maximum request rate when concurrency is given (no rate limit if
+        None)
     :return: None
     """
+    if concurrency is not None and resume:
+        raise ValueError("resume is not supported with concurrency")
+    if concurrency is not None and span_days != 1:
+        raise ValueError("span_days is not supported with concurrency")
+
     # get station IDs from station_data.csv and subset by lat/lon bounds
 
     all_station_ids_in_box = wumeta.get_station_ids_by_coords(station_data_csv,
@@ -33,5 +68,22 @@ def get_wu_obs(station_data_csv, startdate, enddate, data_dir, index_start=0,
     print("Attempting to pull data for the following stations:")
     print(station_ids)
 
-    wuobs.scrape_data_multiple_stations_and_days(station_ids, startdate,
-                                                 enddate, data_dir)
+    cache = None if cache_dir is None else ResponseCache(cache_dir)
+    store = None if store_dir is None else ObsStore(store_dir)
+
+    if concurrency is None:
+        wuobs.scrape_data_multiple_stations_and_days(station_ids, startdate,
+                                                     enddate, data_dir,
+                                                     cache=cache,
+                                                     resume=resume,
+                                                     store=store,
+                                                     span_days=span_days)
+    else:
+        wu_fetch.scrape_data_multiple_stations_and_days_async(
+            station_ids, startdate, enddate, data_dir,
+            concurrency=concurrency, requests_per_sec=requests_per_sec,
+            cache=cache, store=store)
+
+    if cache is not None:
+        print("response cache: " + str(cache.hits) + " hits, " +
+              str(cache.misses) + " misses")
@@ -2,13 +2,105 @@
 Functions to combine Washington State Patrol and Weather Underground datasets
 into single enhanced DF
 """
+import hashlib
+import json
 import pandas as pd
 import os
 import numpy as np
-import copy
-import pickle
+from concurrent.futures import ProcessPoolExecutor
 from geopy.distance import vincenty  # note: had to pip install geopy
+from sklearn.neighbors import BallTree
 from axwx import wu_metadata_scraping as wu_meta
+from axwx.station_cache import StationObsCache
+from axwx.wu_obs_store import ObsStore
+
+EARTH_RADIUS_MI = 3958.7613  # mean Earth radius
+KM_PER_MI = 1.609344
+MI_PER_DEG_LAT = 69.0
+
+# windows preceding a collision: {window: length}
+WINDOW_LENGTHS = {"latest": np.timedelta64(15, "m"),
+                  "last_1hr": np.timedelta64(60, "m"),
+                  "last_24hr": np.timedelta64(24, "h")}
+# aggregates over a window:
+#   "latest": last reading
+#   "avg": mean of valid readings
+#   "max": max of valid readings
+#   "change": last reading minus first reading
+#   "avg_increase", "avg_decrease": mean fall and rise between consecutive
+#       readings (looking back from the collision)
+#   "rate": change per hour between first and last readings
+# all but "latest", "avg" and "max" require readings spread over more than
+# 3/4 of the window
+AGGREGATES = ["latest", "avg", "max", "change", "avg_increase",
+              "avg_decrease", "rate"]
+SPREAD_AGGREGATES = ["change", "avg_increase", "avg_decrease", "rate"]
+
+# weather features merged by default, in output order:
+# (WU observation column, window, aggregate, decimals to round to or None)
+WX_FEATURE_SPEC = [("TemperatureF", "latest", "latest", None),
+                   ("TemperatureF", "last_1hr", "avg", 1),
+                   ("TemperatureF", "last_1hr", "change", None),
+                   ("TemperatureF", "last_1hr", "avg_increase", 1),
+                   ("TemperatureF", "last_1hr", "avg_decrease", 1),
+                   ("DewpointF", "latest", "latest", None),
+                   ("DewpointF", "last_1hr", "avg", 1),
+                   ("DewpointF", "last_1hr", "change", None),
+                   ("DewpointF", "last_1hr", "avg_increase", 1),
+                   ("DewpointF", "last_1hr", "avg_decrease", 1),
+                   ("PressureIn", "latest", "latest", None),
+                   ("PressureIn", "last_1hr", "avg", 2),
+                   ("PressureIn", "last_1hr", "change", None),
+                   ("WindSpeedMPH", "latest", "latest", None),
+                   ("WindSpeedMPH", "last_1hr", "avg", 1),
+                   ("WindSpeedGustMPH", "latest", "latest", None),
+                   ("WindSpeedGustMPH", "last_1hr", "max", 1),
+                   ("Humidity", "latest", "latest", None),
+                   ("Humidity", "last_1hr", "avg", 1),
+                   ("Humidity", "last_1hr", "change", None),
+                   ("Humidity", "last_1hr", "avg_increase", 1),
+                   ("Humidity", "last_1hr", "avg_decrease", 1),
+                   ("HourlyPrecipIn", "latest", "latest", None),
+                   ("cum_rain_in", "last_1hr", "rate", None)]
+# feature names that don't follow the wx_<column>_<window>_<aggregate>
+# pattern: {(column, window, aggregate): name}
+FEATURE_NAMES = {("HourlyPrecipIn", "latest", "latest"):
+                 "wx_PrecipRate_inhr_latest_max",
+                 ("cum_rain_in", "last_1hr", "rate"):
+                 "wx_PrecipRate_inhr_last_1hr"}
+# columns whose features are combined across stations by taking the max
+# (rather than the mean)
+MAX_COMBINE_COLUMNS = ["WindSpeedGustMPH", "HourlyPrecipIn", "cum_rain_in"]
+# merged columns added after the weather features
+WX_SUMMARY_COLUMNS = ["wx_mean_station_dist_mi",
+                      "wx_station_count",
+                      "wx_unique_event_id"]
+
+
+def get_feature_name(column, window, aggregate):
+    """
+    Name of the merged column for a weather feature
+    :param column: string
+        WU observation column, e.g. "TemperatureF"
+    :param window: string
+        window preceding the collision (see WINDOW_LENGTHS)
+    :param aggregate: string
+        aggregate over the window (see AGGREGATES)
+    :return: string, e.g. "wx_TemperatureF_last_1hr_avg"
+    """
+    if (column, window, aggregate) in FEATURE_NAMES:
+        return FEATURE_NAMES[(column, window, aggregate)]
+    elif window == aggregate == "latest":
+        return "wx_" + column + "_latest"
+    else:
+        return "wx_" + column + "_" + window + "_" + aggregate
+
+
+# default features by name, and default merged columns in output order
+DEFAULT_FEATURES = {get_feature_name(*feature[:3]): feature
+                    for feature in WX_FEATURE_SPEC}
+WX_COLUMNS = ([get_feature_name(*feature[:3])
+               for feature in WX_FEATURE_SPEC] + WX_SUMMARY_COLUMNS)
 
 
 def get_bounding_box(coords, dist_mi):
@@ -31,363 +123,964 @@ def get_bounding_box(coords, dist_mi):
     return lat_bounds_deg, lon_bounds_deg
 
 
+def build_station_tree(station_df):
+    """
+    Build a spatial index of station locations for radius queries
+    :param station_df: pandas.DataFrame
+        station metadata with "Latitude" and "Longitude" columns (e.g. from
+        wu_metadata_scraping.subset_stations_by_coords)
+    :return: sklearn.neighbors.BallTree on (lat, lon) in radians, using the
+        haversine metric
+    """
+    station_coords_rad = np.radians(station_df[["Latitude", "Longitude"]]
+                                    .values.astype(float))
+    return BallTree(station_coords_rad, metric="haversine")
+
+
+def get_distance_mi(lat1, lon1, lat2, lon2):
+    """
+    Vectorized distance between pairs of nearby locations, in miles. Uses the
+    FCC ellipsoidal flat-earth formula (47 CFR 73.208), which agrees with
+    geopy's vincenty to within a few meters at distances under ~300 miles
+    (the merge uses vincenty itself; see get_stations_within_radius).
+    :param lat1: array-like
+        latitude(s) of first location(s), in degrees
+    :param lon1: array-like
+        longitude(s) of first location(s), in degrees
+    :param lat2: array-like
+        latitude(s) of second location(s), in degrees
+    :param lon2: array-like
+        longitude(s) of second location(s), in degrees
+    :return: numpy array of distances, in miles
+    """
+    lat1, lon1, lat2, lon2 = [np.asarray(x, dtype=float)
+                              for x in (lat1, lon1, lat2, lon2)]
+    mean_lat_rad = np.radians((lat1 + lat2) / 2)
+    km_per_deg_lat = (111.13209 - 0.56605 * np.cos(2 * mean_lat_rad) +
+                      0.00120 * np.cos(4 * mean_lat_rad))
+    km_per_deg_lon = (111.41513 * np.cos(mean_lat_rad) -
+                      0.09455 * np.cos(3 * mean_lat_rad) +
+                      0.00012 * np.cos(5 * mean_lat_rad))
+    dist_km = np.hypot(km_per_deg_lat * (lat2 - lat1),
+                       km_per_deg_lon * (lon2 - lon1))
+    return dist_km / KM_PER_MI
+
+
+def get_stations_within_radius(station_tree, coords, radius_mi,
+                               station_coords=None):
+    """
+    Find all stations within a given radius of each of a set of locations.
+    The tree narrows the stations down to a few candidates per location,
+    whose distances are then calculated with geopy's vincenty, as when
+    checking every station.
+    :param station_tree: sklearn.neighbors.BallTree
+        station index from build_station_tree
+    :param coords: array-like
+        (n, 2) array of (latitude, longitude) pairs for reference locations
+    :param radius_mi: numeric
+        search radius, in miles
+    :param station_coords: array-like
+        (m, 2) array of station (latitude, longitude) pairs, in degrees,
+        in the order used to build the tree (taken from the tree if None,
+        which can differ from the original coordinates in the last digit)
+    :return: two length-n lists of numpy arrays: the row positions of the
+        stations within radius_mi of each location (in the DataFrame used to
+        build the tree) and their distances in miles, nearest first.
+        Locations with missing coordinates get empty arrays.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    valid = np.isfinite(coords).all(axis=1)
+
+    station_rows = [np.array([], dtype=int)] * coords.shape[0]
+    station_dists = [np.array([], dtype=float)] * coords.shape[0]
+    if not valid.any():
+        return station_rows, station_dists
+
+    if station_coords is None:
+        station_coords = np.degrees(np.asarray(station_tree.data))
+    else:
+        station_coords = np.asarray(station_coords, dtype=float)
+
+    # the tree uses a spherical earth, so pad the radius for candidates and
+    # then check candidates against ellipsoidal distances
+    candidate_rows = station_tree.query_radius(
+        np.radians(coords[valid]), r=1.01 * radius_mi / EARTH_RADIUS_MI)
+
+    for i, row_ids in zip(np.flatnonzero(valid), candidate_rows):
+        dists = np.array([vincenty(tuple(coords[i]),
+                                   tuple(station_coords[row_id])).miles
+                          for row_id in row_ids], dtype=float)
+        in_radius = dists <= radius_mi
+        order = np.argsort(dists[in_radius], kind="mergesort")
+        station_rows[i] = row_ids[in_radius][order]
+        station_dists[i] = dists[in_radius][order]
+
+    return station_rows, station_dists
+
+
+def prepare_station_obs(wu_station_data):
+    """
+    Sort WU observations for a single station by time and pre-parse the
+    observation times, so that windows can be found by binary search
+    :param wu_station_data: pandas.DataFrame
+        cleaned WU observations for a single station
+    :return: dict with keys "data" (observations sorted by "Time", rows with
+        unparseable times dropped), "time" (sorted datetime64 array of local
+        observation times) and "time_utc" (datetime64 array of "DateUTC")
+    """
+    obs_time = pd.to_datetime(wu_station_data["Time"], errors="coerce")
+    order = np.argsort(obs_time.values, kind="mergesort")
+    order = order[pd.notnull(obs_time.values[order])]
+
+    wu_station_data = wu_station_data.iloc[order].reset_index(drop=True)
+    obs_time_utc = pd.to_datetime(wu_station_data["DateUTC"],
+                                  errors="coerce")
+
+    return {"data": wu_station_data,
+            "time": obs_time.values[order],
+            "time_utc": obs_time_utc.values}
+
+
+def load_station_obs(wu_obs_filepath, station_id, columns=None,
+                     time_range=None):
+    """
+    Load cleaned WU observations for a single station
+    :param wu_obs_filepath: string or wu_obs_store.ObsStore
+        filepath for directory containing WU observation data (pickle files)
+        or
+        observation store with cleaned WU observation data
+    :param station_id: string
+        PWS station ID
+    :param columns: list
+        columns needed besides "Time" and "DateUTC" (all columns if None);
+        only these are read from an observation store
+    :param time_range: 2-tuple of datetime-like
+        (start, end) of observation times needed (all times if None); only
+        these are read from an observation store
+    :return: dict of prepared observations (see prepare_station_obs)
+    """
+    if isinstance(wu_obs_filepath, ObsStore):
+        if columns is not None:
+            columns = ["Time", "DateUTC"] + [col for col in columns if col
+                                             not in ["Time", "DateUTC"]]
+        start, end = (None, None) if time_range is None else time_range
+        wu_station_data = wu_obs_filepath.read(station_id, columns=columns,
+                                               start=start, end=end)
+    else:
+        wu_station_data = pd.read_pickle(os.path.join(
+            wu_obs_filepath, station_id + "_cleaned.p"))
+    return prepare_station_obs(wu_station_data)
+
+
+def get_station_obs_key(wu_obs_filepath):
+    """
+    Station cache key part identifying where observations come from
+    :param wu_obs_filepath: string or wu_obs_store.ObsStore
+        WU observation data (see load_station_obs)
+    :return: string
+    """
+    if isinstance(wu_obs_filepath, ObsStore):
+        return "store:" + wu_obs_filepath.root_dir
+    return os.path.abspath(wu_obs_filepath)
+
+
+def compile_feature_spec(features=None):
+    """
+    Compile a weather feature spec, so that only the station arrays needed
+    for the requested features are built and only those features are looked
+    up and combined
+    :param features: list
+        weather features to merge, in output order. Each is either the name
+        of a default feature (e.g. "wx_TemperatureF_latest") or a
+        (column, window, aggregate) or (column, window, aggregate, decimals)
+        tuple, e.g. ("TemperatureF", "last_24hr", "max", 1). Defaults to
+        WX_FEATURE_SPEC.
+    :return: dict with keys "features" (list of (name, column, window,
+        aggregate, decimals) tuples), "columns" (merged column names, in
+        output order), "is_max" (bool array, True for features combined
+        across stations by max) and "table_key" (station arrays needed, also
+        used in station cache keys)
+    """
+    if features is None:
+        features = WX_FEATURE_SPEC
+
+    compiled_features = []
+    table_arrays = set()
+    for feature in features:
+        if isinstance(feature, str):
+            if feature not in DEFAULT_FEATURES:
+                raise ValueError("unknown weather feature: " + feature)
+            feature = DEFAULT_FEATURES[feature]
+        column, window, aggregate = feature[:3]
+        decimals = feature[3] if len(feature) > 3 else None
+        if window not in WINDOW_LENGTHS:
+            raise ValueError("unknown window: " + str(window))
+        if aggregate not in AGGREGATES:
+            raise ValueError("unknown aggregate: " + str(aggregate))
+        compiled_features.append((get_feature_name(column, window, aggregate),
+                                  column, window, aggregate, decimals))
+
+        if aggregate == "avg":
+            table_arrays.add((column, "sums"))
+        elif aggregate in ["avg_increase", "avg_decrease"]:
+            table_arrays.add((column, "diffs"))
+        else:
+            table_arrays.add((column, "values"))
+
+    feature_names = [feature[0] for feature in compiled_features]
+    return {"features": compiled_features,
+            "columns": feature_names + WX_SUMMARY_COLUMNS,
+            "is_max": np.array([feature[1] in MAX_COMBINE_COLUMNS or
+                                feature[3] == "max"
+                                for feature in compiled_features],
+                               dtype=bool),
+            "table_key": tuple(sorted(table_arrays))}
+
+
+def get_window_bounds(obs_time, collision_datetimes):
+    """
+    Find the observations in each pre-collision window by binary search
+    :param obs_time: numpy array of datetime64
+        sorted observation times (e.g. from prepare_station_obs)
+    :param collision_datetimes: numpy.datetime64 or array of datetime64
+        collision date(s) and time(s)
+    :return: dict of slice bounds into obs_time (scalars or arrays, like
+        collision_datetimes). Observations in the window ending at a
+        collision are obs_time[bounds[<window>]:bounds["end"]], for each
+        window in WINDOW_LENGTHS ("latest" is 15 minutes).
+    """
+    collision_datetimes = np.asarray(collision_datetimes,
+                                     dtype="datetime64[ns]").astype(
+        obs_time.dtype)
+    end = np.searchsorted(obs_time, collision_datetimes, side="right")
+    bounds = {"end": end}
+    for window, window_length in WINDOW_LENGTHS.items():
+        bounds[window] = np.minimum(
+            np.searchsorted(obs_time, collision_datetimes - window_length,
+                            side="left"), end)
+
+    return bounds
+
+
+def build_station_feature_table(wu_station_obs, feature_spec=None):
+    """
+    Precompute per-station arrays from which the pre-collision weather
+    features can be looked up for any collision time, so only the window
+    bounds need to be found per collision. Window counts come from
+    cumulative counts over the whole time series; window sums are taken
+    over the window's own values (see sum_windows), so averages round
+    exactly like averages of the window alone.
+    :param wu_station_obs: dict
+        prepared observations for a single station (from prepare_station_obs)
+    :param feature_spec: dict
+        compiled feature spec (from compile_feature_spec); only the arrays
+        needed for its features are built. Defaults to WX_FEATURE_SPEC.
+    :return: dict of numpy arrays, aligned with the sorted observations
+        (cumulative arrays have one leading zero)
+    """
+    if feature_spec is None:
+        feature_spec = compile_feature_spec()
+
+    wu_station_data = wu_station_obs["data"]
+    feature_table = {"time": wu_station_obs["time"],
+                     "time_utc": wu_station_obs["time_utc"]}
+
+    for col, array_type in feature_spec["table_key"]:
+        values = wu_station_data[col].values.astype(float)
+
+        if array_type == "values":
+            feature_table[col] = values
+
+        # values with missing values as 0, and running counts of valid
+        # values (for window means that skip missing values)
+        elif array_type == "sums":
+            is_valid = ~np.isnan(values)
+            feature_table[col + "_filled"] = np.where(is_valid, values, 0)
+            feature_table[col + "_cumcount"] = np.append(
+                0, np.cumsum(is_valid))
+
+        # negative and positive steps between consecutive obs (for window
+        # average increase/decrease); a missing value makes any window
+        # spanning it NaN, so also count missing steps
+        elif array_type == "diffs":
+            diffs = np.diff(values)
+            feature_table[col + "_diff_neg"] = np.minimum(diffs, 0)
+            feature_table[col + "_diff_pos"] = np.maximum(diffs, 0)
+            feature_table[col + "_cumdiff_nan"] = np.append(
+                0, np.cumsum(np.isnan(diffs)))
+
+    return feature_table
+
+
+def sum_windows(values, start, end):
+    """
+    Sum values over many windows, adding each window's values in the same
+    order as numpy.sum over the window's slice (pairwise summation, whose
+    order depends only on the window length), so sums round identically.
+    Windows of the same length are summed together in one call.
+    :param values: numpy array
+        values to sum
+    :param start: numpy array of int
+        window start indices
+    :param end: numpy array of int
+        window end indices (exclusive)
+    :return: numpy array of window sums (0 for empty windows)
+    """
+    sums = np.zeros(len(start))
+    lengths = end - start
+    for length in np.unique(lengths[lengths > 0]):
+        rows = np.flatnonzero(lengths == length)
+        sums[rows] = values[start[rows, None] +
+                            np.arange(length)].sum(axis=1)
+
+    return sums
+
+
+def round_feature(values, decimals):
+    """
+    Round feature values, if the feature spec asks for it
+    :param values: numpy array
+        feature values
+    :param decimals: int or None
+        number of decimals (None for no rounding)
+    :return: numpy array of rounded values
+    """
+    if decimals is None:
+        return values
+    return np.round(values, decimals)
+
+
+def lookup_station_features(feature_table, collision_datetimes,
+                            feature_spec=None):
+    """
+    Look up the weather features for a single station over the windows
+    preceding each of a batch of collisions, with one vectorized reduction
+    per feature
+    :param feature_table: dict
+        precomputed station features (from build_station_feature_table, with
+        the same feature spec)
+    :param collision_datetimes: numpy.datetime64 or array of datetime64
+        collision date(s) and time(s)
+    :param feature_spec: dict
+        compiled feature spec (from compile_feature_spec); defaults to
+        WX_FEATURE_SPEC
+    :return: dict of "wx_*" weather features for the station (one array
+        per feature, with one value per collision)
+    """
+    if feature_spec is None:
+        feature_spec = compile_feature_spec()
+
+    collision_datetimes = np.atleast_1d(collision_datetimes)
+    features = dict()
+
+    # no observations at all
+    if len(feature_table["time"]) == 0:
+        for feature in feature_spec["features"]:
+            features[feature[0]] = np.full(len(collision_datetimes), np.nan)
+        return features
+
+    window = get_window_bounds(feature_table["time"], collision_datetimes)
+    end = window["end"]
+    last = np.maximum(end - 1, 0)  # last obs in window (if any)
+    time_utc = feature_table["time_utc"]
+    spread_hrs = dict()
+
+    for name, col, window_name, aggregate, decimals in \
+            feature_spec["features"]:
+        start = window[window_name]
+        nrow = end - start
+        first = np.minimum(start, last)  # first obs in window (if any)
+
+        # determine whether to calculate changes (requires good spread of
+        # data across window)
+        if aggregate in SPREAD_AGGREGATES and window_name not in spread_hrs:
+            time_delta = time_utc[last] - time_utc[first]
+            min_spread = (WINDOW_LENGTHS[window_name].astype("m8[s]") *
+                          3 // 4)
+            spread_hrs[window_name] = np.where(
+                (nrow > 0) & (time_delta > min_spread),
+                time_delta / np.timedelta64(1, "h"), np.nan)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+
+            if aggregate == "latest":
+                values = np.where(nrow > 0, feature_table[col][last],
+                                  np.nan)
+
+            elif aggregate == "avg":
+                count = (feature_table[col + "_cumcount"][end] -
+                         feature_table[col + "_cumcount"][start])
+                values = np.where(count > 0, round_feature(
+                    sum_windows(feature_table[col + "_filled"], start,
+                                end) / count, decimals), np.nan)
+
+            elif aggregate == "max":
+                # reduce over [start, end) for all collisions in one call
+                # (a trailing NaN keeps end in range)
+                window_maxes = np.fmax.reduceat(
+                    np.append(feature_table[col], np.nan),
+                    np.column_stack([start, end]).ravel())[::2]
+                values = np.where(nrow > 0,
+                                  round_feature(window_maxes, decimals),
+                                  np.nan)
+
+            elif aggregate in ["change", "rate"]:
+                values = (feature_table[col][last] -
+                          feature_table[col][first])
+                if aggregate == "rate":
+                    values = values / spread_hrs[window_name]
+                values = np.where(np.isnan(spread_hrs[window_name]),
+                                  np.nan, round_feature(values, decimals))
+
+            else:
+                # avg net increase and decrease beginning to end
+                cumdiff_nan = feature_table[col + "_cumdiff_nan"]
+                is_valid = (~np.isnan(spread_hrs[window_name]) &
+                            (cumdiff_nan[last] - cumdiff_nan[first] == 0))
+                if aggregate == "avg_increase":
+                    diffs = feature_table[col + "_diff_neg"]
+                    sign = -1
+                else:
+                    diffs = feature_table[col + "_diff_pos"]
+                    sign = 1
+                values = np.where(is_valid, sign * round_feature(
+                    sum_windows(diffs, first, last) / (nrow - 1), decimals),
+                    np.nan)
+
+        features[name] = values
+
+    # TODO: ADD WIND DIRECTION
+
+    return features
+
+
+def group_collision_events(wsp_df, event_ids=None):
+    """
+    Group collision records into unique events, i.e. records with the same
+    lat/lon/date/time (e.g. one record per vehicle or party involved)
+    :param wsp_df: pandas.DataFrame
+        cleaned WSP collision data
+    :param event_ids: dict
+        event IDs already assigned, by (lat, lon, date, time_of_day) key (e.g.
+        for earlier chunks of the same WSP file); updated in place with IDs
+        for new events. A new dict is used if None.
+    :return: tuple of pandas.DataFrame with one row per unique event, in order
+        of first appearance ("lat", "lon", "date", "time_of_day", "datetime"
+        and "wx_unique_event_id", numbered from 1 in order of first
+        appearance), and numpy array giving the event row position for each
+        collision record
+    """
+    if event_ids is None:
+        event_ids = dict()
+
+    event_keys = zip(wsp_df["lat"].values, wsp_df["lon"].values,
+                     wsp_df["date"].values, wsp_df["time_of_day"].values)
+
+    # hash each record's event key to the event's position
+    event_positions = dict()
+    first_row_ids = []
+    unique_event_ids = []
+    event_row_ids = np.empty(wsp_df.shape[0], dtype=int)
+    for collision_row_id, event_key in enumerate(event_keys):
+        if event_key not in event_positions:
+            event_positions[event_key] = len(first_row_ids)
+            first_row_ids.append(collision_row_id)
+            unique_event_ids.append(event_ids.setdefault(
+                event_key, len(event_ids) + 1))
+        event_row_ids[collision_row_id] = event_positions[event_key]
+
+    events = (wsp_df[["lat", "lon", "date", "time_of_day"]]
+              .iloc[first_row_ids].reset_index(drop=True))
+    events["datetime"] = pd.to_datetime(events["date"] + " " +
+                                        events["time_of_day"])
+    events["wx_unique_event_id"] = np.array(unique_event_ids, dtype=int)
+
+    return events, event_row_ids
+
+
+def shard_collision_events(events, shard_count, radius_mi):
+    """
+    Split collision events into spatially compact shards of similar size, so
+    that each shard needs wx obs from a small set of stations
+    :param events: pandas.DataFrame
+        unique collision events (from group_collision_events)
+    :param shard_count: int
+        number of shards
+    :param radius_mi: numeric
+        radius (miles) for WU station use; sets the size of the grid cells
+        events are ordered by
+    :return: list of numpy arrays of event row positions (empty shards are
+        dropped)
+    """
+    cell_size_deg = 2 * radius_mi / MI_PER_DEG_LAT
+    cell_lat = np.floor(events["lat"].values / cell_size_deg)
+    cell_lon = np.floor(events["lon"].values / cell_size_deg)
+    order = np.lexsort((events["datetime"].values, cell_lon, cell_lat))
+
+    return [shard for shard in np.array_split(order, shard_count)
+            if len(shard) > 0]
+
+
+def get_event_wx_data(event_datetimes, event_station_ids,
+                      event_station_dists, wu_obs_filepath,
+                      station_cache=None, feature_spec=None):
+    """
+    Combine wx info from nearby stations for each of a set of collision
+    events
+    :param event_datetimes: numpy array of datetime64
+        event dates and times
+    :param event_station_ids: list of numpy arrays
+        IDs of the stations within the merge radius of each event
+    :param event_station_dists: list of numpy arrays
+        distances (miles) to the stations within the merge radius of each
+        event
+    :param wu_obs_filepath: string or wu_obs_store.ObsStore
+        filepath for directory containing WU observation data (pickle files)
+        or
+        observation store with cleaned WU observation data; from a store,
+        only the columns in the feature spec and the months around the
+        events are read
+    :param station_cache: station_cache.StationObsCache
+        cache for station data (a new cache with the default budget is used
+        if None)
+    :param feature_spec: dict
+        compiled feature spec (from compile_feature_spec); defaults to
+        WX_FEATURE_SPEC
+    :return: pandas.DataFrame with one row of wx info per event (all
+        feature spec columns except wx_unique_event_id)
+    """
+    event_count = len(event_datetimes)
+
+    if station_cache is None:
+        station_cache = StationObsCache()
+    if feature_spec is None:
+        feature_spec = compile_feature_spec()
+    feature_names = [feature[0] for feature in feature_spec["features"]]
+
+    # flatten to one (event, station) pair per station within max radius of
+    # each event, grouped by event
+    station_counts = np.array([len(station_ids)
+                               for station_ids in event_station_ids],
+                              dtype=int)
+    pair_event_row_ids = np.repeat(np.arange(event_count), station_counts)
+    pair_station_ids = np.concatenate([np.empty(0, dtype=object)] +
+                                      list(event_station_ids))
+    pair_dists = np.concatenate([np.empty(0)] + list(event_station_dists))
+    pair_wx = np.full((len(pair_station_ids), len(feature_names)), np.nan)
+
+    # look up features for all events near each station in one batch
+    unique_station_ids, pair_station_rows = np.unique(pair_station_ids,
+                                                      return_inverse=True)
+    station_pair_ids = np.split(
+        np.argsort(pair_station_rows, kind="mergesort"),
+        np.cumsum(np.bincount(pair_station_rows,
+                              minlength=len(unique_station_ids)))[:-1])
+
+    # columns to read from an observation store
+    is_store = isinstance(wu_obs_filepath, ObsStore)
+    obs_columns = sorted(set(col for col, _ in feature_spec["table_key"]))
+    max_window_length = max(WINDOW_LENGTHS.values())
+
+    for station_row_id, station_id in enumerate(unique_station_ids):
+
+        print("-------- processing station #" + str(station_row_id + 1) +
+              " of " + str(len(unique_station_ids)) + " (" + station_id +
+              ") --------")
+
+        pair_ids = station_pair_ids[station_row_id]
+        pair_datetimes = event_datetimes[pair_event_row_ids[pair_ids]]
+
+        # from an observation store, read whole months covering the windows
+        # preceding the collisions (whole months, so the cached data can be
+        # reused by other events in the same months)
+        if is_store:
+            time_range = (
+                (pair_datetimes.min() - max_window_length).astype(
+                    "datetime64[M]"),
+                pair_datetimes.max().astype("datetime64[M]") +
+                np.timedelta64(1, "M"))
+        else:
+            time_range = None
+
+        # load wx obs for single station and precompute the arrays needed
+        # for the feature spec (if not already in station cache)
+        station_feature_table = station_cache.get(
+            (get_station_obs_key(wu_obs_filepath), station_id,
+             feature_spec["table_key"], str(time_range)),
+            lambda: build_station_feature_table(
+                load_station_obs(wu_obs_filepath, station_id, obs_columns,
+                                 time_range), feature_spec))
+
+        # look up features for the windows preceding the collisions
+        station_features = lookup_station_features(
+            station_feature_table, pair_datetimes, feature_spec)
+        for feature_col_id, name in enumerate(feature_names):
+            pair_wx[pair_ids, feature_col_id] = station_features[name]
+
+    # gather WU data means (ignoring missing values), except for parameters
+    # where the max across stations is used, reducing over each event's
+    # stations at once
+    event_wx = np.full((event_count, len(feature_names) + 2), np.nan)
+    has_stations = station_counts > 0
+    if has_stations.any():
+        event_starts = (np.cumsum(station_counts) -
+                        station_counts)[has_stations]
+        is_valid = ~np.isnan(pair_wx)
+        valid_count = np.add.reduceat(is_valid.astype(int), event_starts,
+                                      axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            station_means = np.add.reduceat(np.where(is_valid, pair_wx, 0),
+                                            event_starts,
+                                            axis=0) / valid_count
+        station_maxes = np.fmax.reduceat(pair_wx, event_starts, axis=0)
+        event_wx[has_stations, :-2] = np.where(feature_spec["is_max"],
+                                               station_maxes, station_means)
+        event_wx[has_stations, -2] = (np.add.reduceat(pair_dists,
+                                                      event_starts) /
+                                      station_counts[has_stations])
+    event_wx[:, -1] = station_counts
+
+    event_df = pd.DataFrame(event_wx, columns=feature_spec["columns"][:-1])
+
+    return event_df
+
+
 def enhance_wsp_with_wu_data(wu_metadata_full_filepath,
                              wsp_data_full_filepath,
                              wu_obs_filepath, radius_mi,
                              lat_range=[47.4, 47.8],
-                             lon_range=[-122.5, -122.2]):
+                             lon_range=[-122.5, -122.2], workers=1,
+                             station_cache=None, features=None):
     """
     Add columns with WU data to WSP DataFrame
-    :param wu_metadata_full_filepath: string
+    :param wu_metadata_full_filepath: string or wu_station_store.StationStore
         full filepath for wu_station_list (csv file)
+        or
+        station store, from which only stations in the box are read
     :param wsp_data_full_filepath: string
         full filepath for wsp data (csv file)
-    :param wu_obs_filepath: string
-        filepath for directory containing WU observation data
+    :param wu_obs_filepath: string or wu_obs_store.ObsStore
+        filepath for directory containing WU observation data (pickle files)
+        or
+        observation store with cleaned WU observation data
     :param radius_mi: int
         radius (miles) for WU station use
     :param lat_range: 2-element list
         min and max latitude range, e.g. [47.4, 47.8]
     :param lon_range: 2-element list
         min and max longitude range, e.g. [-122.5, -122.2]
+    :param workers: int
+        number of worker processes; with more than one, events are split
+        into spatially compact shards that are merged in parallel (output is
+        identical to a single process run). Scripts using this on platforms
+        that spawn processes (Windows, macOS) need an
+        `if __name__ == "__main__":` guard.
+    :param station_cache: station_cache.StationObsCache
+        cache for station data, which can be shared between merges (a new
+        cache with the default budget is used if None). With more than one
+        worker, each worker process uses its own cache with the same budget.
+    :param features: list
+        weather features to merge, in output order (see
+        compile_feature_spec); only these are computed. Defaults to all
+        features in WX_FEATURE_SPEC.
     :return:
     """
     station_df = wu_meta.subset_stations_by_coords(wu_metadata_full_filepath,
                                            lat_range, lon_range)
+    station_tree = build_station_tree(station_df)
     wsp_df = pd.read_csv(wsp_data_full_filepath, index_col="Unnamed: 0")
-    os.chdir(wu_obs_filepath)
-
-    collision_count = wsp_df.shape[0]
-
-    wsp_df_new = pd.DataFrame()
-    unique_event_id = 1
-
-    # # TEMP FOR TESTING
-    # collision_count = 2500
-
-    for collision_row_id in range(collision_count):
-
-        print("-------- processing row #" + str(collision_row_id + 1) +
-              " of " + str(collision_count) + " --------")
-
-        # get collision info
-        collision_coords = (wsp_df["lat"].iloc[collision_row_id],
-                            wsp_df["lon"].iloc[collision_row_id])
-        collision_date = wsp_df["date"].iloc[collision_row_id]
-        collision_time = wsp_df["time_of_day"].iloc[collision_row_id]
-        collision_datetime = np.datetime64(collision_date + " " +
-                                           collision_time)
-        collision_datetime_minus_15_mins = (collision_datetime -
-                                            np.timedelta64(15, 'm'))
-        collision_datetime_minus_60_mins = (collision_datetime -
-                                            np.timedelta64(60, 'm'))
-        collision_datetime_minus_24hrs = (collision_datetime -
-                                          np.timedelta64(24, 'h'))
-
-        # autopopulate wx info if duplicate collision record
-        # (i.e. same lat/lon/date/time)
-        if collision_row_id > 0:
-            dup_record = True
-            dup_record = dup_record & (collision_time == wsp_df_new
-                                       ["time_of_day"][collision_row_id - 1])
-            dup_record = dup_record & (collision_date == wsp_df_new
-                                       ["date"][collision_row_id - 1])
-            dup_record = dup_record & (collision_coords[0] == wsp_df_new
-                                       ["lat"][collision_row_id - 1])
-            dup_record = dup_record & (collision_coords[1] == wsp_df_new
-                                       ["lon"][collision_row_id - 1])
-            if dup_record:
-                # print("duplicate event")
-                temp_df_dict = dict(wsp_df.iloc[collision_row_id])
-                temp_df_dict.update(grouped_station_dict)
-                wsp_df_new = wsp_df_new.append(temp_df_dict,
-                                               ignore_index=True)
-                continue
-            else:
-                unique_event_id += 1
-                pass
-        else:
-            pass
-
-        # subset station DF by lat/lon bbox (to reduce # of distance
-        # calculations later)
-        station_df_temp = copy.deepcopy(station_df)
-        bbox = get_bounding_box(collision_coords, radius_mi)
-        station_df_temp = wu_meta.subset_stations_by_coords(station_df, bbox[0],
-                                                    bbox[1])
-
-        # initialize new DF for combined station info
-        stations = pd.DataFrame()
-
-        station_data_dict = dict()
-
-        # loop through stations
-        for station_row_id in range(station_df_temp.shape[0]):
-
-            # get station info and distance from collision
-            station_id = station_df_temp.index[station_row_id]
-            station_coords = (station_df_temp["Latitude"]
-                              .iloc[station_row_id],
-                              station_df_temp["Longitude"]
-                              .iloc[station_row_id])
-            station_dist_mi = vincenty(collision_coords, station_coords).miles
-
-            # proceed if station within max radius
-            if station_dist_mi <= radius_mi:
-
-                # load wx obs for single station (if not already in data
-                # dictionary)
-                if station_id not in station_data_dict.keys():
-                    station_data_dict[station_id] = pickle.load(
-                        open(station_id + "_cleaned.p", "rb"))
-                else:
-                    pass
-                wu_station_data = station_data_dict[station_id]
-
-                # subset wx obs to pre-collision only
-                wu_station_datetime = pd.DatetimeIndex(wu_station_data
-                                                       ["Time"])
-                wu_station_data = (wu_station_data[wu_station_datetime <=
-                                                   collision_datetime])
-                wu_station_datetime = (wu_station_datetime
-                                       [wu_station_datetime <=
-                                        collision_datetime])
-
-                # latest readings (up to 15 minutes prior to collision)
-                wu_station_data_latest = (wu_station_data
-                                          [wu_station_datetime >=
-                                           collision_datetime_minus_15_mins])
-                if wu_station_data_latest.shape[0] > 0:
-                    TemperatureF_latest = (wu_station_data_latest
-                                           ["TemperatureF"].iloc[-1])
-                    DewpointF_latest = (wu_station_data_latest
-                                        ["DewpointF"].iloc[-1])
-                    PressureIn_latest = (wu_station_data_latest
-                                         ["PressureIn"].iloc[-1])
-                    WindDirection_latest = (wu_station_data_latest
-                                            ["WindDirection"].iloc[-1])
-                    WindDirectionDegrees_latest = (wu_station_data_latest
-                                                   ["WindDirectionDegrees"]
-                                                   .iloc[-1])
-                    WindSpeedMPH_latest = (wu_station_data_latest
-                                           ["WindSpeedMPH"].iloc[-1])
-                    WindSpeedGustMPH_latest = (wu_station_data_latest
-                                               ["WindSpeedGustMPH"].iloc[-1])
-                    Humidity_latest = (wu_station_data_latest
-                                       ["Humidity"].iloc[-1])
-                    HourlyPrecipIn_latest = (wu_station_data_latest
-                                             ["HourlyPrecipIn"].iloc[-1])
-                    # TODO: ADD WIND DIRECTION
-                else:
-                    TemperatureF_latest = np.nan
-                    DewpointF_latest = np.nan
-                    PressureIn_latest = np.nan
-                    WindDirection_latest = np.nan
-                    WindDirectionDegrees_latest = np.nan
-                    WindSpeedMPH_latest = np.nan
-                    WindSpeedGustMPH_latest = np.nan
-                    Humidity_latest = np.nan
-                    HourlyPrecipIn_latest = np.nan
-                    # TODO: ADD WIND DIRECTION
-
-                # last 1 hr summary (note that not all parameters are
-                # averaged)
-                wu_station_data_last_hr = (wu_station_data
-                                           [wu_station_datetime >=
-                                            collision_datetime_minus_60_mins])
-                nrow_last_1hr = wu_station_data_last_hr.shape[0]
-                if nrow_last_1hr > 0:
-                    TemperatureF_last_1hr_avg = np.round(np.mean(
-                        wu_station_data_last_hr["TemperatureF"]), 1)
-                    DewpointF_last_1hr_avg = np.round(np.mean(
-                        wu_station_data_last_hr["DewpointF"]), 1)
-                    PressureIn_last_1hr_avg = np.round(np.mean(
-                        wu_station_data_last_hr["PressureIn"]), 2)
-                    WindSpeedMPH_last_1hr_avg = np.round(np.mean(
-                        wu_station_data_last_hr["WindSpeedMPH"]), 1)
-                    WindSpeedGustMPH_last_1hr_max = np.round(np.max(
-                        wu_station_data_last_hr["WindSpeedGustMPH"]), 1)
-                    Humidity_last_1hr_avg = np.round(np.mean(
-                        wu_station_data_last_hr["Humidity"]), 1)
-                    # TODO: ADD PRECIP RATE
-                    # TODO: ADD WIND DIRECTION
-                else:
-                    TemperatureF_last_1hr_avg = np.nan
-                    DewpointF_last_1hr_avg = np.nan
-                    PressureIn_last_1hr_avg = np.nan
-                    WindSpeedMPH_last_1hr_avg = np.nan
-                    WindSpeedGustMPH_last_1hr_max = np.nan
-                    Humidity_last_1hr_avg = np.nan
-                    # TODO: ADD PRECIP RATE
-                    # TODO: ADD WIND DIRECTION
-
-                # determine whether to calculate 1 hr changes
-                if nrow_last_1hr > 0:
-                    # get time delta in last hr to ensure good spread of data
-                    # across last hr
-                    wu_station_datetime_last_1hr = pd.DatetimeIndex(
-                        wu_station_data_last_hr["DateUTC"])
-                    last_1hr_time_delta = (wu_station_datetime_last_1hr[-1] -
-                                           wu_station_datetime_last_1hr[0])
-                    if last_1hr_time_delta > np.timedelta64(45, "m"):
-                        last_1hr_time_delta_hrs = (last_1hr_time_delta
-                                                   .seconds / 3600)
-                        do_last_1hr_calcs = True
-                    else:
-                        do_last_1hr_calcs = False
-                else:
-                    do_last_1hr_calcs = False
-
-                # last 1 hr changes
-                if do_last_1hr_calcs:
-                    # net change beginning to end
-                    TemperatureF_last_1hr_change = (wu_station_data_last_hr
-                                                    ["TemperatureF"]
-                                                    .iloc[-1] -
-                                                    wu_station_data_last_hr
-                                                    ["TemperatureF"].iloc[0])
-                    DewpointF_last_1hr_change = (wu_station_data_last_hr
-                                                 ["DewpointF"].iloc[-1] -
-                                                 wu_station_data_last_hr
-                                                 ["DewpointF"].iloc[0])
-                    PressureIn_last_1hr_change = (wu_station_data_last_hr
-                                                  ["PressureIn"].iloc[-1] -
-                                                  wu_station_data_last_hr
-                                                  ["PressureIn"].iloc[0])
-                    Humidity_last_1hr_change = (wu_station_data_last_hr
-                                                ["Humidity"].iloc[-1] -
-                                                wu_station_data_last_hr
-                                                ["Humidity"].iloc[0])
-                    # Avg net increase and decrease beginning to end
-                    if nrow_last_1hr > 1:
-                        TempF_diff = np.diff(wu_station_data_last_hr
-                                             ["TemperatureF"])
-                        TemperatureF_last_1hr_avg_increase = -1 * np.round(
-                            np.sum(np.minimum(TempF_diff, 0)) /
-                            (nrow_last_1hr - 1), 1)
-                        TemperatureF_last_1hr_avg_decrease = np.round(
-                            np.sum(np.maximum(TempF_diff, 0)) /
-                            (nrow_last_1hr - 1), 1)
-                        DpF_diff = np.diff(wu_station_data_last_hr
-                                           ["DewpointF"])
-                        DewpointF_last_1hr_avg_increase = -1 * np.round(
-                            np.sum(np.minimum(DpF_diff, 0)) /
-                            (nrow_last_1hr - 1), 1)
-                        DewpointF_last_1hr_avg_decrease = np.round(
-                            np.sum(np.maximum(DpF_diff, 0)) /
-                            (nrow_last_1hr - 1), 1)
-                        RH_diff = np.diff(wu_station_data_last_hr["Humidity"])
-                        Humidity_last_1hr_avg_increase = -1 * np.round(
-                            np.sum(np.minimum(RH_diff, 0)) /
-                            (nrow_last_1hr - 1), 1)
-                        Humidity_last_1hr_avg_decrease = np.round(
-                            np.sum(np.maximum(RH_diff, 0)) /
-                            (nrow_last_1hr - 1), 1)
-                        PrecipRate_inhr_last_1hr = ((wu_station_data_last_hr
-                                                     ["cum_rain_in"]
-                                                     .iloc[-1] -
-                                                     wu_station_data_last_hr
-                                                     ["cum_rain_in"]
-                                                     .iloc[0]) /
-                                                    last_1hr_time_delta_hrs)
-                        # TODO: ADD WIND DIRECTION
-                else:
-                    TemperatureF_last_1hr_change = np.nan
-                    DewpointF_last_1hr_change = np.nan
-                    PressureIn_last_1hr_change = np.nan
-                    Humidity_last_1hr_change = np.nan
-                    TemperatureF_last_1hr_avg_increase = np.nan
-                    TemperatureF_last_1hr_avg_decrease = np.nan
-                    DewpointF_last_1hr_avg_increase = np.nan
-                    DewpointF_last_1hr_avg_decrease = np.nan
-                    Humidity_last_1hr_avg_increase = np.nan
-                    Humidity_last_1hr_avg_decrease = np.nan
-                    PrecipRate_inhr_last_1hr = np.nan
-                    # TODO: ADD WIND DIRECTION
-
-                # save data in dataframe
-                stations = stations.append({
-                    "wx_station_id":
-                    station_id,
-                    "wx_station_dist_mi":
-                    station_dist_mi,
-                    "wx_TemperatureF_latest":
-                    TemperatureF_latest,
-                    "wx_TemperatureF_last_1hr_avg":
-                    TemperatureF_last_1hr_avg,
-                    "wx_TemperatureF_last_1hr_change":
-                    TemperatureF_last_1hr_change,
-                    "wx_TemperatureF_last_1hr_avg_increase":
-                    TemperatureF_last_1hr_avg_increase,
-                    "wx_TemperatureF_last_1hr_avg_decrease":
-                    TemperatureF_last_1hr_avg_decrease,
-                    "wx_DewpointF_latest":
-                    DewpointF_latest,
-                    "wx_DewpointF_last_1hr_avg":
-                    DewpointF_last_1hr_avg,
-                    "wx_DewpointF_last_1hr_change":
-                    DewpointF_last_1hr_change,
-                    "wx_DewpointF_last_1hr_avg_increase":
-                    DewpointF_last_1hr_avg_increase,
-                    "wx_DewpointF_last_1hr_avg_decrease":
-                    DewpointF_last_1hr_avg_decrease,
-                    "wx_PressureIn_latest":
-                    PressureIn_latest,
-                    "wx_PressureIn_last_1hr_avg":
-                    PressureIn_last_1hr_avg,
-                    "wx_PressureIn_last_1hr_change":
-                    PressureIn_last_1hr_change,
-                    "wx_WindSpeedMPH_latest":
-                    WindSpeedMPH_latest,
-                    "wx_WindSpeedMPH_last_1hr_avg":
-                    WindSpeedMPH_last_1hr_avg,
-                    "wx_WindSpeedGustMPH_latest":
-                    WindSpeedGustMPH_latest,
-                    "wx_WindSpeedGustMPH_last_1hr_max":
-                    WindSpeedGustMPH_last_1hr_max,
-                    "wx_Humidity_latest":
-                    Humidity_latest,
-                    "wx_Humidity_last_1hr_avg":
-                    Humidity_last_1hr_avg,
-                    "wx_Humidity_last_1hr_change":
-                    Humidity_last_1hr_change,
-                    "wx_Humidity_last_1hr_avg_increase":
-                    Humidity_last_1hr_avg_increase,
-                    "wx_Humidity_last_1hr_avg_decrease":
-                    Humidity_last_1hr_avg_decrease,
-                    "wx_PrecipRate_inhr_latest_max":
-                    HourlyPrecipIn_latest,
-                    "wx_PrecipRate_inhr_last_1hr":
-                    PrecipRate_inhr_last_1hr},
-                    # TODO: ADD WIND DIRECTION
-                    ignore_index=True)
-                stations = stations.sort_values("wx_station_dist_mi")
-            else:
-                pass
-
-        station_count = stations.shape[0]
-
-        # duplicate WSP data for current collision
-        temp_df_dict = dict(wsp_df.iloc[collision_row_id])
-
-        # gather WU data means and address renamed and non-mean'd parameters
-        grouped_station_dict = np.mean(stations)
-        grouped_station_dict["wx_mean_station_dist_mi"] = (grouped_station_dict
-                                                           .pop("wx_station_"
-                                                                "dist_mi"))
-        grouped_station_dict["wx_WindSpeedGustMPH_latest"] = np.max(
-            stations.wx_WindSpeedGustMPH_latest)
-        grouped_station_dict["wx_WindSpeedGustMPH_last_1hr_max"] = np.max(
-            stations.wx_WindSpeedGustMPH_last_1hr_max)
-        grouped_station_dict["wx_PrecipRate_inhr_latest_max"] = np.max(
-            stations.wx_PrecipRate_inhr_latest_max)
-        grouped_station_dict["wx_PrecipRate_inhr_last_1hr"] = np.max(
-            stations.wx_PrecipRate_inhr_last_1hr)
-        grouped_station_dict["wx_station_count"] = station_count
-        grouped_station_dict["wx_unique_event_id"] = unique_event_id
-
-        # combine WSP and WU dictionaries and append to wsp_df_new
-        temp_df_dict.update(grouped_station_dict)
-        wsp_df_new = wsp_df_new.append(temp_df_dict, ignore_index=True)
+
+    return add_wu_data_to_wsp_df(wsp_df, station_df, station_tree,
+                                 wu_obs_filepath, radius_mi, workers=workers,
+                                 station_cache=station_cache,
+                                 features=features)
+
+
+def add_wu_data_to_wsp_df(wsp_df, station_df, station_tree, wu_obs_filepath,
+                          radius_mi, workers=1, station_cache=None,
+                          event_ids=None, features=None):
+    """
+    Add columns with WU data to a DataFrame of WSP collision records
+    :param wsp_df: pandas.DataFrame
+        cleaned WSP collision data
+    :param station_df: pandas.DataFrame
+        WU station metadata, indexed by station ID
+    :param station_tree: sklearn.neighbors.BallTree
+        station index for station_df (from build_station_tree)
+    :param wu_obs_filepath: string or wu_obs_store.ObsStore
+        filepath for directory containing WU observation data (pickle files)
+        or
+        observation store with cleaned WU observation data
+    :param radius_mi: int
+        radius (miles) for WU station use
+    :param workers: int
+        number of worker processes (see enhance_wsp_with_wu_data)
+    :param station_cache: station_cache.StationObsCache
+        cache for station data (see enhance_wsp_with_wu_data)
+    :param event_ids: dict
+        event IDs already assigned (see group_collision_events)
+    :param features: list
+        weather features to merge (see enhance_wsp_with_wu_data)
+    :return: pandas.DataFrame with WSP and WU data (index is reset)
+    """
+    feature_spec = compile_feature_spec(features)
+
+    # group collision records into unique events (same lat/lon/date/time),
+    # so wx info is calculated once per event
+    events, event_row_ids = group_collision_events(wsp_df, event_ids)
+
+    # find stations within max radius of every event in a single batch
+    # query (rather than a distance calculation per event/station pair)
+    nearby_station_rows, nearby_station_dists = get_stations_within_radius(
+        station_tree, events[["lat", "lon"]].values, radius_mi,
+        station_df[["Latitude", "Longitude"]].values)
+
+    nearby_station_ids = [station_df.index.values[station_rows]
+                          for station_rows in nearby_station_rows]
+
+    if station_cache is None:
+        station_cache = StationObsCache()
+
+    if workers > 1:
+        # compute wx info for spatially compact shards of events in parallel
+        shards = shard_collision_events(events, workers, radius_mi)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shard_futures = [executor.submit(
+                get_event_wx_data, events["datetime"].values[shard],
+                [nearby_station_ids[i] for i in shard],
+                [nearby_station_dists[i] for i in shard], wu_obs_filepath,
+                StationObsCache(station_cache.max_bytes), feature_spec)
+                for shard in shards]
+            event_df = pd.concat([shard_future.result().set_index(shard)
+                                  for shard, shard_future
+                                  in zip(shards, shard_futures)])
+        event_df = event_df.sort_index()
+    else:
+        event_df = get_event_wx_data(events["datetime"].values,
+                                     nearby_station_ids,
+                                     nearby_station_dists, wu_obs_filepath,
+                                     station_cache, feature_spec)
+    event_df["wx_unique_event_id"] = events["wx_unique_event_id"].values
+
+    # broadcast event wx info back to every collision record in the event
+    event_df = event_df[feature_spec["columns"]]
+    wsp_df_new = pd.concat([wsp_df.reset_index(drop=True),
+                            event_df.iloc[event_row_ids]
+                            .reset_index(drop=True)], axis=1)
 
     return wsp_df_new
+
+
+def enhance_wsp_with_wu_data_chunked(wu_metadata_full_filepath,
+                                     wsp_data_full_filepath,
+                                     wu_obs_filepath, radius_mi,
+                                     output_filepath,
+                                     lat_range=[47.4, 47.8],
+                                     lon_range=[-122.5, -122.2],
+                                     chunksize=10000,
+                                     checkpoint_filepath=None, workers=1,
+                                     station_cache=None, features=None):
+    """
+    Add columns with WU data to WSP data, reading collision records in chunks
+    and appending each enhanced chunk to a csv file as soon as it is done, so
+    memory use depends on chunksize rather than on the size of the WSP file.
+    A checkpoint is saved after every chunk; rerunning with the same
+    arguments after an interruption resumes after the last completed chunk.
+    :param wu_metadata_full_filepath: string or wu_station_store.StationStore
+        full filepath for wu_station_list (csv file)
+        or
+        station store, from which only stations in the box are read
+    :param wsp_data_full_filepath: string
+        full filepath for wsp data (csv file)
+    :param wu_obs_filepath: string or wu_obs_store.ObsStore
+        filepath for directory containing WU observation data (pickle files)
+        or
+        observation store with cleaned WU observation data
+    :param radius_mi: int
+        radius (miles) for WU station use
+    :param output_filepath: string
+        full filepath for enhanced wsp data (csv file)
+    :param lat_range: 2-element list
+        min and max latitude range, e.g. [47.4, 47.8]
+    :param lon_range: 2-element list
+        min and max longitude range, e.g. [-122.5, -122.2]
+    :param chunksize: int
+        number of collision records per chunk
+    :param checkpoint_filepath: string
+        full filepath for checkpoint (json file); defaults to output_filepath
+        with ".checkpoint" appended
+    :param workers: int
+        number of worker processes (see enhance_wsp_with_wu_data)
+    :param station_cache: station_cache.StationObsCache
+        cache for station data, shared by all chunks (see
+        enhance_wsp_with_wu_data)
+    :param features: list
+        weather features to merge (see enhance_wsp_with_wu_data)
+    :return: None (enhanced data saved to output_filepath)
+    """
+    if checkpoint_filepath is None:
+        checkpoint_filepath = output_filepath + ".checkpoint"
+    if station_cache is None:
+        station_cache = StationObsCache()
+
+    station_df = wu_meta.subset_stations_by_coords(wu_metadata_full_filepath,
+                                           lat_range, lon_range)
+    station_tree = build_station_tree(station_df)
+
+    # event IDs by event key, so IDs are unique across chunks
+    event_ids = dict()
+
+    if os.path.isfile(checkpoint_filepath):
+        with open(checkpoint_filepath) as f:
+            checkpoint = json.load(f)
+        rows_completed = checkpoint["rows_completed"]
+        print("resuming after row #" + str(rows_completed) + " (event #" +
+              str(checkpoint["last_event_id"]) + ")")
+
+        # drop anything written after the last checkpoint
+        with open(output_filepath, "r+") as f:
+            f.truncate(checkpoint["output_bytes"])
+
+        # re-assign event IDs for completed rows (keys only, no wx info)
+        if rows_completed > 0:
+            for wsp_keys in pd.read_csv(wsp_data_full_filepath,
+                                        usecols=["lat", "lon", "date",
+                                                 "time_of_day"],
+                                        nrows=rows_completed,
+                                        chunksize=chunksize):
+                group_collision_events(wsp_keys, event_ids)
+    else:
+        rows_completed = 0
+        open(output_filepath, "w").close()
+
+    wsp_chunks = pd.read_csv(wsp_data_full_filepath, index_col="Unnamed: 0",
+                             chunksize=chunksize,
+                             skiprows=range(1, rows_completed + 1))
+
+    for wsp_chunk in wsp_chunks:
+
+        print("-------- merging rows #" + str(rows_completed + 1) + " to #" +
+              str(rows_completed + wsp_chunk.shape[0]) + " --------")
+
+        wsp_chunk_new = add_wu_data_to_wsp_df(wsp_chunk, station_df,
+                                              station_tree, wu_obs_filepath,
+                                              radius_mi, workers=workers,
+                                              station_cache=station_cache,
+                                              event_ids=event_ids,
+                                              features=features)
+        wsp_chunk_new.index = np.arange(rows_completed,
+                                        rows_completed + wsp_chunk.shape[0])
+
+        # append chunk to output, then record progress
+        with open(output_filepath, "a") as f:
+            wsp_chunk_new.to_csv(f, header=(rows_completed == 0))
+        rows_completed += wsp_chunk.shape[0]
+        checkpoint = {"rows_completed": rows_completed,
+                      "last_event_id": len(event_ids),
+                      "output_bytes": os.path.getsize(output_filepath)}
+        with open(checkpoint_filepath + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_filepath + ".tmp", checkpoint_filepath)
+
+
+def hash_wsp_records(wsp_df):
+    """
+    Content hash for each WSP collision record, used to recognize records
+    that are unchanged between WSP exports
+    :param wsp_df: pandas.DataFrame
+        WSP collision data (the index is not hashed)
+    :return: numpy array of hex digest strings, one per record
+    """
+    record_strs = wsp_df.astype(str).values
+    return np.array([hashlib.sha1("\x1f".join(record_str).encode("utf-8"))
+                     .hexdigest() for record_str in record_strs])
+
+
+def enhance_wsp_with_wu_data_incremental(wu_metadata_full_filepath,
+                                         wsp_data_full_filepath,
+                                         wu_obs_filepath, radius_mi,
+                                         previous_output,
+                                         lat_range=[47.4, 47.8],
+                                         lon_range=[-122.5, -122.2],
+                                         workers=1, station_cache=None,
+                                         features=None):
+    """
+    Add columns with WU data to WSP DataFrame, reusing WU data from a
+    previous merge for records that are unchanged since then. Records are
+    matched by a hash of their WSP columns, so only new or changed records
+    have WU data computed. The previous merge must have used the same
+    radius, station list, WU observation data and weather features.
+    :param wu_metadata_full_filepath: string or wu_station_store.StationStore
+        full filepath for wu_station_list (csv file)
+        or
+        station store, from which only stations in the box are read
+    :param wsp_data_full_filepath: string
+        full filepath for wsp data (csv file)
+    :param wu_obs_filepath: string or wu_obs_store.ObsStore
+        filepath for directory containing WU observation data (pickle files)
+        or
+        observation store with cleaned WU observation data
+    :param radius_mi: int
+        radius (miles) for WU station use
+    :param previous_output: string or pandas.DataFrame
+        full filepath for the previous merged data (csv file, as written by
+        DataFrame.to_csv or enhance_wsp_with_wu_data_chunked)
+        or
+        pandas.DataFrame with the previous merged data
+    :param lat_range: 2-element list
+        min and max latitude range, e.g. [47.4, 47.8]
+    :param lon_range: 2-element list
+        min and max longitude range, e.g. [-122.5, -122.2]
+    :param workers: int
+        number of worker processes (see enhance_wsp_with_wu_data)
+    :param station_cache: station_cache.StationObsCache
+        cache for station data (see enhance_wsp_with_wu_data)
+    :param features: list
+        weather features to merge (see enhance_wsp_with_wu_data)
+    :return: pandas.DataFrame with WSP and WU data, as from
+        enhance_wsp_with_wu_data
+    """
+    wsp_df = pd.read_csv(wsp_data_full_filepath, index_col="Unnamed: 0")
+    if isinstance(previous_output, str):
+        previous_output = pd.read_csv(previous_output, index_col=0)
+    wx_columns = compile_feature_spec(features)["columns"]
+
+    # match records to previously merged records by content hash
+    wsp_cols = list(wsp_df.columns)
+    if set(wsp_cols + wx_columns) <= set(previous_output.columns):
+        previous_hashes = hash_wsp_records(previous_output[wsp_cols])
+    else:
+        previous_hashes = np.array([], dtype=str)
+    previous_row_ids = dict()
+    for row_id, record_hash in enumerate(previous_hashes):
+        previous_row_ids.setdefault(record_hash, row_id)
+    matched_row_ids = np.array([previous_row_ids.get(record_hash, -1)
+                                for record_hash in hash_wsp_records(wsp_df)],
+                               dtype=int)
+    is_new = matched_row_ids < 0
+
+    print("reusing WU data for " + str(np.sum(~is_new)) + " of " +
+          str(wsp_df.shape[0]) + " records")
+
+    wx_df = pd.DataFrame(np.nan, index=np.arange(wsp_df.shape[0]),
+                         columns=wx_columns)
+    wx_df.iloc[~is_new, :] = (previous_output[wx_columns]
+                              .iloc[matched_row_ids[~is_new]].values)
+
+    # merge new or changed records only
+    if is_new.any():
+        station_df = wu_meta.subset_stations_by_coords(
+            wu_metadata_full_filepath, lat_range, lon_range)
+        station_tree = build_station_tree(station_df)
+        wsp_df_changed = add_wu_data_to_wsp_df(wsp_df[is_new], station_df,
+                                               station_tree, wu_obs_filepath,
+                                               radius_mi, workers=workers,
+                                               station_cache=station_cache,
+                                               features=features)
+        wx_df.iloc[is_new, :] = wsp_df_changed[wx_columns].values
+
+    # event IDs are renumbered over the whole WSP file
+    _, event_row_ids = group_collision_events(wsp_df)
+    wx_df["wx_unique_event_id"] = event_row_ids + 1
+
+    return pd.concat([wsp_df.reset_index(drop=True), wx_df], axis=1)
@@ -0,0 +1,103 @@
+"""
+Memory-bounded cache for WU PWS observation data used when merging
+"""
+
+from collections import OrderedDict
+import sys
+
+import numpy as np
+import pandas as pd
+
+
+def get_nbytes(obj):
+    """
+    Approximate memory used by cached station data
+    :param obj: pandas.DataFrame, numpy array, or dict of either
+        object to size
+    :return: int, size in bytes
+    """
+    if isinstance(obj, dict):
+        return sum(get_nbytes(value) for value in obj.values())
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(np.sum(obj.memory_usage(deep=True)))
+    else:
+        return sys.getsizeof(obj)
+
+
+class StationObsCache(object):
+    """
+    Least-recently-used cache of per-station observation data, bounded by a
+    byte budget. One cache can be shared by several merges in a session
+    (e.g. with different radii or date ranges), so each station file is only
+    loaded and prepared once while it stays in the cache.
+    """
+
+    def __init__(self, max_bytes=1024 ** 3):
+        """
+        :param max_bytes: int
+            memory budget for cached data, in bytes (default 1 GB)
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, load_func):
+        """
+        Get cached data, loading (and caching) it on a miss
+        :param key: hashable
+            cache key, e.g. (observation directory, station ID)
+        :param load_func: function
+            called with no arguments to load the data on a miss
+        :return: cached or newly loaded data
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+        self.misses += 1
+        value = load_func()
+        nbytes = get_nbytes(value)
+        self._entries[key] = (value, nbytes)
+        self.current_bytes += nbytes
+
+        # evict least recently used entries until back under budget (an
+        # entry larger than the whole budget is returned but not kept)
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_nbytes
+            self.evictions += 1
+
+        return value
+
+    def clear(self):
+        """
+        Remove all cached data (counters are kept)
+        :return: None
+        """
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        """
+        Cache counters
+        :return: dict with hits, misses, evictions, entries, current_bytes
+            and max_bytes
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes}
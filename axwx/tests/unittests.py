@@ -5,15 +5,140 @@ Collision Analysis Tool)
 
 
 import axwx
+import datetime
+import os
 import os.path as op
 import numpy as np
 import pandas as pd
+import requests
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from geopy.distance import vincenty
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from axwx.wu_benchmark import benchmark_scraping
+from axwx.wu_mock_server import MockWUServer, make_mock_stations
 
 
 data_path = op.join(axwx.__path__[0], 'data')
 
 
+def make_merge_test_data(test_dir):
+    """
+    Write a small synthetic station list, WSP collision file and WU
+    observation files for merge tests
+    :param test_dir: str
+        directory in which to write test files
+    :return: (station csv filepath, wsp csv filepath, wu obs directory)
+    """
+    station_df = pd.DataFrame({"id": ["KTEST1", "KTEST2"],
+                               "Latitude": [47.60, 47.61],
+                               "Longitude": [-122.30, -122.30]},
+                              index=[1, 2])
+    station_df.to_csv(op.join(test_dir, "stations.csv"))
+
+    obs_time = pd.date_range("2016-05-01 11:00", "2016-05-01 13:00",
+                             freq="10min")
+    for station_id, offset in [("KTEST1", 50), ("KTEST2", 60)]:
+        n = len(obs_time)
+        obs_df = pd.DataFrame({
+            "Time": obs_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "TemperatureF": offset + np.arange(n, dtype=float),
+            "DewpointF": 40.0, "PressureIn": 30.0,
+            "WindDirection": "North", "WindDirectionDegrees": 0.0,
+            "WindSpeedMPH": 5.0, "WindSpeedGustMPH": offset / 10.0,
+            "Humidity": 80.0, "HourlyPrecipIn": 0.0,
+            "DateUTC": (obs_time + pd.Timedelta(hours=7))
+            .strftime("%Y-%m-%d %H:%M:%S"),
+            "cum_rain_in": np.arange(n) * 0.01})
+        obs_df.to_pickle(op.join(test_dir, station_id + "_cleaned.p"))
+
+    wsp_df = pd.DataFrame({"lat": [47.605, 47.605, 47.605],
+                           "lon": [-122.30, -122.30, -122.30],
+                           "date": ["2016-05-01"] * 3,
+                           "time_of_day": ["12:13:00", "12:13:00",
+                                           "11:05:00"],
+                           "vehicle_action": ["A", "B", "C"]})
+    wsp_df.to_csv(op.join(test_dir, "wsp.csv"))
+
+    return (op.join(test_dir, "stations.csv"), op.join(test_dir, "wsp.csv"),
+            test_dir)
+
+
+class StandInWUHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for WU WXDailyHistory.asp responses: hourly readings for any
+    station and day (or custom range of days), in the WU comma/<br> format
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+    max_bytes = None  # cut responses off after this many bytes
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        station_id = query["ID"][0]
+        date = pd.Timestamp(int(query["year"][0]), int(query["month"][0]),
+                            int(query["day"][0]))
+        if query["graphspan"][0] == "custom":
+            end_date = pd.Timestamp(int(query["yearend"][0]),
+                                    int(query["monthend"][0]),
+                                    int(query["dayend"][0]))
+        else:
+            end_date = date
+        lines = ["\nTime,TemperatureF,DateUTC,Station<br>\n"]
+        for hour in range(24 * ((end_date - date).days + 1)):
+            obs_time = date + pd.Timedelta(hours=hour)
+            lines.append(",".join([str(obs_time),
+                                   str(40 + obs_time.hour + obs_time.day),
+                                   str(obs_time + pd.Timedelta(hours=7)),
+                                   station_id]) + ",\n<br>\n")
+        content = "".join(lines).encode("utf-8")[:self.max_bytes]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInWUServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stand_in_server(handler=StandInWUHandler):
+    """
+    Start a local stand-in WU server in a background thread
+    :param handler: BaseHTTPRequestHandler subclass
+        request handler
+    :return: (server, base URL)
+    """
+    server = StandInWUServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:" + str(server.server_port) + "/"
+
+
+def make_response(text, status_code=200):
+    """
+    Make an HTTP response without a server
+    :param text: str
+        response body
+    :param status_code: int
+        HTTP status
+    :return: requests.Response
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response.encoding = "utf-8"
+    response._content = text.encode("utf-8")
+    return response
+
+
 class TestWspCleaning(unittest.TestCase):
     """
     Unit tests for wsp_cleaning.py (Washington State Patrol:
@@ -205,6 +330,1399 @@ class TestMergeDatasets(unittest.TestCase):
                            'vehicle_action')
         self.assertTrue(expected_header in header)
 
+    def test_synthetic_values(self):
+        """
+        Test merged values against hand-computed values for synthetic data
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            df = axwx.enhance_wsp_with_wu_data(
+                *make_merge_test_data(test_dir), radius_mi=2,
+                lat_range=[47.5, 47.7], lon_range=[-122.4, -122.2])
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(list(df["vehicle_action"]), ["A", "B", "C"])
+        self.assertEqual(list(df["wx_station_count"]), [2, 2, 2])
+        self.assertEqual(list(df["wx_unique_event_id"]), [1, 1, 2])
+        # 12:13 collision: obs at 11:20-12:10 in last hr, 12:10 latest
+        self.assertEqual(list(df["wx_TemperatureF_latest"]), [62, 62, 55])
+        self.assertEqual(df["wx_TemperatureF_last_1hr_avg"][0], 59.5)
+        self.assertEqual(df["wx_TemperatureF_last_1hr_change"][0], 5)
+        self.assertEqual(df["wx_TemperatureF_last_1hr_avg_decrease"][0], 1)
+        self.assertEqual(df["wx_WindSpeedGustMPH_latest"][0], 6)
+        self.assertAlmostEqual(df["wx_PrecipRate_inhr_last_1hr"][0], 0.06)
+        # 11:05 collision: single obs, so no 1 hr changes
+        self.assertTrue(np.isnan(df["wx_TemperatureF_last_1hr_change"][2]))
+
+    def test_no_nearby_stations(self):
+        """
+        Test that collisions with no station within the radius get missing
+        wx info rather than an error
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            df = axwx.enhance_wsp_with_wu_data(
+                *make_merge_test_data(test_dir), radius_mi=0.1,
+                lat_range=[47.5, 47.7], lon_range=[-122.4, -122.2])
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(list(df["wx_station_count"]), [0, 0, 0])
+        self.assertTrue(df["wx_TemperatureF_latest"].isnull().all())
+        self.assertTrue(df["wx_mean_station_dist_mi"].isnull().all())
+
+    def test_chunked_resume(self):
+        """
+        Test that a chunked merge interrupted partway resumes from its
+        checkpoint and writes the same data as a single in-memory merge
+        """
+        class FailingCache(axwx.StationObsCache):
+            def get(self, key, load_func):
+                # fail in second chunk (first chunk loads two stations)
+                if self.hits + self.misses >= 2:
+                    raise RuntimeError("interrupted")
+                return axwx.StationObsCache.get(self, key, load_func)
+
+        test_dir = tempfile.mkdtemp()
+        try:
+            test_files = make_merge_test_data(test_dir)
+            output_filepath = op.join(test_dir, "merged.csv")
+            kwargs = dict(radius_mi=2, lat_range=[47.5, 47.7],
+                          lon_range=[-122.4, -122.2], chunksize=2)
+            with self.assertRaises(RuntimeError):
+                axwx.enhance_wsp_with_wu_data_chunked(
+                    *test_files, output_filepath=output_filepath,
+                    station_cache=FailingCache(), **kwargs)
+            self.assertEqual(pd.read_csv(output_filepath).shape[0], 2)
+
+            axwx.enhance_wsp_with_wu_data_chunked(
+                *test_files, output_filepath=output_filepath, **kwargs)
+            df_chunked = pd.read_csv(output_filepath, index_col=0)
+            df_expected = axwx.enhance_wsp_with_wu_data(
+                *test_files, radius_mi=2, lat_range=[47.5, 47.7],
+                lon_range=[-122.4, -122.2])
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(list(df_chunked["wx_unique_event_id"]), [1, 1, 2])
+        pd.testing.assert_frame_equal(df_chunked, df_expected,
+                                      check_dtype=False)
+
+    def test_incremental(self):
+        """
+        Test that an incremental merge reuses WU data for unchanged records
+        and matches a full merge of the updated WSP data
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            stations_csv, wsp_csv, wu_obs_dir = make_merge_test_data(test_dir)
+            kwargs = dict(radius_mi=2, lat_range=[47.5, 47.7],
+                          lon_range=[-122.4, -122.2])
+            previous_output = op.join(test_dir, "merged.csv")
+            axwx.enhance_wsp_with_wu_data(stations_csv, wsp_csv, wu_obs_dir,
+                                          **kwargs).to_csv(previous_output)
+
+            # unchanged WSP data: nothing to compute
+            cache = axwx.StationObsCache()
+            df_incremental = axwx.enhance_wsp_with_wu_data_incremental(
+                stations_csv, wsp_csv, wu_obs_dir,
+                previous_output=previous_output, station_cache=cache,
+                **kwargs)
+            self.assertEqual(cache.misses, 0)
+
+            # changed time for one record, plus one new record
+            wsp_df = pd.read_csv(wsp_csv, index_col=0)
+            wsp_df.loc[0, "time_of_day"] = "11:05:00"
+            wsp_df.loc[3] = wsp_df.loc[2]
+            wsp_df.to_csv(wsp_csv)
+            df_incremental = axwx.enhance_wsp_with_wu_data_incremental(
+                stations_csv, wsp_csv, wu_obs_dir,
+                previous_output=previous_output, **kwargs)
+            df_expected = axwx.enhance_wsp_with_wu_data(
+                stations_csv, wsp_csv, wu_obs_dir, **kwargs)
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(list(df_incremental["wx_unique_event_id"]),
+                         [1, 2, 1, 1])
+        pd.testing.assert_frame_equal(df_incremental, df_expected,
+                                      check_dtype=False)
+
+    def test_feature_subset(self):
+        """
+        Test that merging a subset of features matches the full merge
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            stations_csv, wsp_csv, wu_obs_dir = make_merge_test_data(test_dir)
+            kwargs = dict(radius_mi=2, lat_range=[47.5, 47.7],
+                          lon_range=[-122.4, -122.2])
+            df_full = axwx.enhance_wsp_with_wu_data(stations_csv, wsp_csv,
+                                                    wu_obs_dir, **kwargs)
+            features = ["wx_WindSpeedGustMPH_latest",
+                        "wx_TemperatureF_last_1hr_avg"]
+            df_subset = axwx.enhance_wsp_with_wu_data(
+                stations_csv, wsp_csv, wu_obs_dir, features=features,
+                **kwargs)
+        finally:
+            shutil.rmtree(test_dir)
+
+        wx_columns = [col for col in df_subset.columns
+                      if col.startswith("wx_")]
+        self.assertEqual(wx_columns, features + axwx.WX_SUMMARY_COLUMNS)
+        pd.testing.assert_frame_equal(df_subset[wx_columns],
+                                      df_full[wx_columns])
+
+    def test_parallel_matches_serial(self):
+        """
+        Test that a multi-process merge gives the same result as a single
+        process merge
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            test_files = make_merge_test_data(test_dir)
+            kwargs = dict(radius_mi=2, lat_range=[47.5, 47.7],
+                          lon_range=[-122.4, -122.2])
+            df_serial = axwx.enhance_wsp_with_wu_data(*test_files, **kwargs)
+            df_parallel = axwx.enhance_wsp_with_wu_data(*test_files,
+                                                        workers=2, **kwargs)
+        finally:
+            shutil.rmtree(test_dir)
+
+        pd.testing.assert_frame_equal(df_serial, df_parallel)
+
+
+class TestStationObsCache(unittest.TestCase):
+    """
+    Unit tests for the station observation cache (station_cache.py)
+    """
+
+    def test_lru_eviction(self):
+        """
+        Test that the least recently used entries are evicted to stay within
+        the byte budget, and that counters are kept
+        """
+        cache = axwx.StationObsCache(max_bytes=2000)
+        for key in ["A", "B", "A", "C"]:
+            cache.get(key, lambda: np.zeros(100))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertTrue("A" in cache and "C" in cache)
+        self.assertFalse("B" in cache)
+        self.assertEqual(cache.current_bytes, 1600)
+
+        cache.get("D", lambda: np.zeros(1000))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.current_bytes, 0)
+
+    def test_shared_between_merges(self):
+        """
+        Test that a second merge with a shared cache loads no station files
+        """
+        cache = axwx.StationObsCache()
+        test_dir = tempfile.mkdtemp()
+        try:
+            test_files = make_merge_test_data(test_dir)
+            for radius_mi in [2, 1]:
+                axwx.enhance_wsp_with_wu_data(*test_files,
+                                              radius_mi=radius_mi,
+                                              lat_range=[47.5, 47.7],
+                                              lon_range=[-122.4, -122.2],
+                                              station_cache=cache)
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(len(cache), 2)
+
+
+class TestCollisionEvents(unittest.TestCase):
+    """
+    Unit tests for grouping WSP collision records into unique events
+    """
+
+    def test_group_collision_events(self):
+        """
+        Test that records with the same lat/lon/date/time share an event,
+        whether or not they are adjacent
+        """
+        wsp_df = pd.DataFrame({"lat": [47.6, 47.6, 47.7, 47.6, 47.6],
+                               "lon": [-122.3, -122.3, -122.3, -122.3,
+                                       -122.3],
+                               "date": ["2016-05-01", "2016-05-01",
+                                        "2016-05-01", "2016-05-01",
+                                        "2016-05-02"],
+                               "time_of_day": ["12:00:00"] * 5},
+                              index=[10, 11, 12, 13, 14])
+        events, event_row_ids = axwx.group_collision_events(wsp_df)
+
+        self.assertEqual(list(event_row_ids), [0, 0, 1, 0, 2])
+        self.assertEqual(list(events["wx_unique_event_id"]), [1, 2, 3])
+        self.assertEqual(list(events["lat"]), [47.6, 47.7, 47.6])
+        self.assertEqual(events["datetime"].iloc[2],
+                         pd.Timestamp("2016-05-02 12:00"))
+
+    def test_shard_collision_events(self):
+        """
+        Test that shards cover every event once and keep nearby events
+        together
+        """
+        events = pd.DataFrame({"lat": [47.6, 45.6, 47.6, 45.6, 47.6],
+                               "lon": [-122.3, -122.3, -122.3, -122.3,
+                                       -122.3],
+                               "datetime": pd.date_range("2016-05-01",
+                                                         periods=5)})
+        shards = axwx.shard_collision_events(events, 2, radius_mi=2)
+        self.assertEqual(sorted(np.concatenate(shards)), [0, 1, 2, 3, 4])
+        self.assertEqual([list(shard) for shard in shards],
+                         [[1, 3, 0], [2, 4]])
+        self.assertEqual(len(axwx.shard_collision_events(events, 8, 2)), 5)
+
+
+class TestStationIndex(unittest.TestCase):
+    """
+    Unit tests for the station spatial index used by merge_datasets.py
+    """
+
+    def test_stations_within_radius(self):
+        """
+        Test that the batch radius query returns the same stations as a
+        brute-force distance check, sorted by distance
+        """
+        station_df = pd.DataFrame({"Latitude": [47.60, 47.62, 47.70, 47.40],
+                                   "Longitude": [-122.30, -122.33, -122.30,
+                                                 -122.30]},
+                                  index=["A", "B", "C", "D"])
+        coords = np.array([[47.61, -122.31], [47.40, -122.30],
+                           [np.nan, -122.30], [45.0, -120.0]])
+        tree = axwx.build_station_tree(station_df)
+        rows, dists = axwx.get_stations_within_radius(
+            tree, coords, 2, station_df[["Latitude", "Longitude"]].values)
+
+        self.assertEqual(list(station_df.index[rows[0]]), ["A", "B"])
+        self.assertTrue((np.diff(dists[0]) >= 0).all())
+        for row_id, dist in zip(rows[0], dists[0]):
+            station_coords = tuple(station_df.iloc[row_id])
+            expected = vincenty(tuple(coords[0]), station_coords).miles
+            self.assertEqual(dist, expected)
+        self.assertEqual(list(station_df.index[rows[1]]), ["D"])
+        self.assertAlmostEqual(dists[1][0], 0)
+        self.assertEqual(len(rows[2]), 0)
+        self.assertEqual(len(rows[3]), 0)
+
+        # stations right at the radius are in or out as with vincenty
+        radius_mi = vincenty(tuple(coords[0]), (47.70, -122.30)).miles
+        for radius, expected in [(radius_mi, ["A", "B", "C"]),
+                                 (radius_mi - 1e-9, ["A", "B"])]:
+            rows, dists = axwx.get_stations_within_radius(
+                tree, coords[:1], radius,
+                station_df[["Latitude", "Longitude"]].values)
+            self.assertEqual(list(station_df.index[rows[0]]), expected)
+
+
+class TestStationObsWindows(unittest.TestCase):
+    """
+    Unit tests for the sorted station observation windows used by
+    merge_datasets.py
+    """
+
+    def test_window_bounds(self):
+        """
+        Test that observations are sorted on load and that window bounds
+        match the pre-collision windows
+        """
+        obs_df = pd.DataFrame({"Time": ["2016-05-01 12:10:00",
+                                        "2016-05-01 11:00:00",
+                                        "not a time",
+                                        "2016-05-01 12:00:00",
+                                        "2016-05-01 12:30:00"],
+                               "DateUTC": ["2016-05-01 19:10:00",
+                                           "2016-05-01 18:00:00", "",
+                                           "2016-05-01 19:00:00",
+                                           "2016-05-01 19:30:00"],
+                               "TemperatureF": [3, 1, np.nan, 2, 4]})
+        obs = axwx.prepare_station_obs(obs_df)
+        self.assertEqual(list(obs["data"]["TemperatureF"]), [1, 2, 3, 4])
+        self.assertTrue((np.diff(obs["time_utc"]) > np.timedelta64(0)).all())
+
+        bounds = axwx.get_window_bounds(obs["time"],
+                                        np.datetime64("2016-05-01 12:10"))
+        self.assertEqual(bounds, {"latest": 1, "last_1hr": 1,
+                                  "last_24hr": 0, "end": 3})
+        bounds = axwx.get_window_bounds(obs["time"],
+                                        np.datetime64("2016-05-01 10:00"))
+        self.assertEqual(bounds["end"], 0)
+
+    def test_feature_lookup(self):
+        """
+        Test precomputed station features against the pre-collision windows
+        """
+        obs_time = pd.date_range("2016-05-01 11:00", "2016-05-01 12:00",
+                                 freq="10min")
+        obs_df = pd.DataFrame({"Time": obs_time.astype(str),
+                               "DateUTC": obs_time.astype(str)})
+        for col in ["TemperatureF", "DewpointF", "PressureIn",
+                    "WindSpeedMPH", "WindSpeedGustMPH", "Humidity",
+                    "HourlyPrecipIn", "cum_rain_in"]:
+            obs_df[col] = 1.0
+        obs_df["TemperatureF"] = [50, 52, 51, 55, 53, 54, 56]
+        obs_df["Humidity"] = [80, 80, np.nan, 70, 70, 70, 70]
+        table = axwx.build_station_feature_table(
+            axwx.prepare_station_obs(obs_df))
+
+        features = axwx.lookup_station_features(
+            table, np.array(["2016-05-01 12:05", "2016-05-01 12:25"],
+                            dtype="datetime64[ns]"))
+        # first window is 11:10 to 12:00
+        self.assertEqual(features["wx_TemperatureF_latest"][0], 56)
+        self.assertEqual(features["wx_TemperatureF_last_1hr_avg"][0], 53.5)
+        self.assertEqual(features["wx_TemperatureF_last_1hr_change"][0], 4)
+        self.assertEqual(
+            features["wx_TemperatureF_last_1hr_avg_increase"][0], 0.6)
+        self.assertEqual(
+            features["wx_TemperatureF_last_1hr_avg_decrease"][0], 1.4)
+        self.assertEqual(features["wx_Humidity_last_1hr_avg"][0], 72)
+        self.assertTrue(np.isnan(features["wx_Humidity_last_1hr_avg_"
+                                          "increase"][0]))
+        # second window is 11:30 to 12:00: too short for changes, too old
+        # for latest
+        self.assertTrue(np.isnan(features["wx_TemperatureF_latest"][1]))
+        self.assertEqual(features["wx_TemperatureF_last_1hr_avg"][1], 54.5)
+        self.assertTrue(np.isnan(features["wx_TemperatureF_last_1hr_"
+                                          "change"][1]))
+
+    def test_feature_rounding_parity(self):
+        """
+        Test that window averages round exactly like averages over each
+        window's readings (e.g. a mean of 46.650000000000006 rounds to 46.7)
+        """
+        obs_time = pd.date_range("2016-05-01 00:00", periods=288,
+                                 freq="5min")
+        values = np.round(np.random.RandomState(0).normal(46, 3, 288), 1)
+        values[:2] = [46.6, 46.7]
+        values[100] = np.nan
+        obs_df = pd.DataFrame({"Time": obs_time.astype(str),
+                               "DateUTC": obs_time.astype(str),
+                               "DewpointF": values})
+        feature_spec = axwx.compile_feature_spec(
+            [("DewpointF", "last_1hr", "avg", 1),
+             ("DewpointF", "last_1hr", "avg_increase", 1),
+             ("DewpointF", "last_1hr", "avg_decrease", 1)])
+        obs = axwx.prepare_station_obs(obs_df)
+        collision_datetimes = (obs_time[1:].values +
+                               np.timedelta64(1, "m") * (np.arange(287) % 5))
+        features = axwx.lookup_station_features(
+            axwx.build_station_feature_table(obs, feature_spec),
+            collision_datetimes, feature_spec)
+
+        self.assertEqual(features["wx_DewpointF_last_1hr_avg"][0], 46.7)
+        for i, collision_datetime in enumerate(collision_datetimes):
+            in_window = ((obs_time >= collision_datetime -
+                          np.timedelta64(1, "h")) &
+                         (obs_time <= collision_datetime))
+            window_values = values[in_window]
+            self.assertEqual(features["wx_DewpointF_last_1hr_avg"][i],
+                             np.round(pd.Series(window_values).mean(), 1))
+            avg_decrease = features["wx_DewpointF_last_1hr_avg_decrease"][i]
+            if not np.isnan(avg_decrease):
+                diffs = np.diff(window_values)
+                self.assertEqual(
+                    features["wx_DewpointF_last_1hr_avg_increase"][i],
+                    -1 * np.round(np.sum(np.minimum(diffs, 0)) /
+                                  (len(window_values) - 1), 1))
+                self.assertEqual(avg_decrease, np.round(
+                    np.sum(np.maximum(diffs, 0)) /
+                    (len(window_values) - 1), 1))
+
+    def test_feature_spec(self):
+        """
+        Test that only the requested features are compiled and computed
+        """
+        obs_time = pd.date_range("2016-05-01 11:00", "2016-05-01 12:00",
+                                 freq="10min")
+        obs_df = pd.DataFrame({"Time": obs_time.astype(str),
+                               "DateUTC": obs_time.astype(str),
+                               "TemperatureF": [50, 52, 51, 55, 53, 54, 56]})
+        feature_spec = axwx.compile_feature_spec(
+            ["wx_TemperatureF_last_1hr_avg",
+             ("TemperatureF", "last_24hr", "max", 1)])
+        self.assertEqual(feature_spec["columns"][:2],
+                         ["wx_TemperatureF_last_1hr_avg",
+                          "wx_TemperatureF_last_24hr_max"])
+        self.assertEqual(list(feature_spec["is_max"]), [False, True])
+
+        table = axwx.build_station_feature_table(
+            axwx.prepare_station_obs(obs_df), feature_spec)
+        self.assertFalse(any(key.startswith("DewpointF") for key in table))
+        features = axwx.lookup_station_features(
+            table, np.datetime64("2016-05-01 12:05"), feature_spec)
+        self.assertEqual(sorted(features), ["wx_TemperatureF_last_1hr_avg",
+                                            "wx_TemperatureF_last_24hr_max"])
+        self.assertEqual(features["wx_TemperatureF_last_24hr_max"][0], 56)
+
+        with self.assertRaises(ValueError):
+            axwx.compile_feature_spec([("TemperatureF", "last_2hr", "avg")])
+
+
+class TestWuMockServer(unittest.TestCase):
+    """
+    Unit tests for wu_mock_server.py and wu_benchmark.py
+    """
+
+    def test_metadata_scraping(self):
+        """
+        Test that the station table and locations scraped from the mock
+        server match its stations
+        """
+        stations = make_mock_stations(3)
+        work_dir = tempfile.mkdtemp()
+        output_csv = op.join(work_dir, "station_data.csv")
+        try:
+            with MockWUServer(stations=stations) as server:
+                df = axwx.scrape_station_info("WA",
+                                              base_url=server.base_url,
+                                              api_base_url=server.base_url,
+                                              output_csv=output_csv)
+            station_ids = axwx.get_station_ids_by_coords(
+                output_csv, [47.4, 47.8], [-122.5, -122.2])
+        finally:
+            shutil.rmtree(work_dir)
+
+        self.assertEqual(list(df.columns), axwx.STATION_TABLE_COLUMNS)
+        self.assertEqual(list(df["id"]), list(stations["id"]))
+        self.assertEqual(list(df["city"]), list(stations["city"]))
+        self.assertEqual(list(df["Latitude"]), list(stations["lat"]))
+        self.assertEqual(list(df["Longitude"]), list(stations["lon"]))
+        self.assertEqual(list(df["Elevation"]),
+                         list(stations["elevation"].astype(float)))
+        self.assertEqual(station_ids, list(stations["id"]))
+
+    def test_multi_state_scraping(self):
+        """
+        Test that station tables for several states are merged, with
+        stations listed in more than one state kept once
+        """
+        wa_stations = make_mock_stations(3)
+        or_stations = make_mock_stations(2, state="OR", seed=1)
+        stations = pd.concat([wa_stations, or_stations,
+                              wa_stations.iloc[[0]].assign(state="OR")],
+                             ignore_index=True)
+        with MockWUServer(stations=stations) as server:
+            df = axwx.scrape_station_info(["WA", "OR", "ID"],
+                                          base_url=server.base_url,
+                                          api_base_url=server.base_url)
+        self.assertEqual(list(df.columns), axwx.STATION_TABLE_COLUMNS)
+        self.assertEqual(list(df["id"]), list(stations["id"][:5]))
+        self.assertEqual(list(df["state"]), ["WA"] * 3 + ["OR"] * 2)
+        self.assertEqual(list(df["Latitude"]), list(stations["lat"][:5]))
+
+        # errors are raised if no state list can be retrieved
+        session = axwx.WUSession(max_retries=0)
+        try:
+            with MockWUServer(stations=stations) as server:
+                base_url = server.base_url
+                server.error_rate = 1
+                with self.assertRaises(requests.HTTPError):
+                    axwx.get_station_lists(["WA", "OR"], session, base_url)
+        finally:
+            session.close()
+
+    def test_batch_geolocation(self):
+        """
+        Test that batch geolocation matches the stations' locations, and
+        reports failures per station
+        """
+        stations = make_mock_stations(5)
+        station_ids = list(stations["id"]) + ["KUNKNOWN"]
+        with MockWUServer(stations=stations) as server:
+            locations = axwx.scrape_lat_lon_batch(station_ids,
+                                                  concurrency=3,
+                                                  base_url=server.base_url)
+        self.assertEqual(list(locations.index), station_ids)
+        self.assertEqual(list(locations["lat"][:5]), list(stations["lat"]))
+        self.assertEqual(list(locations["lon"][:5]), list(stations["lon"]))
+        self.assertTrue(locations["error"][:5].isnull().all())
+        self.assertTrue(np.isnan(locations["lat"]["KUNKNOWN"]))
+        self.assertTrue(locations["error"]["KUNKNOWN"].startswith(
+            "ValueError"))
+
+        session = axwx.WUSession(max_retries=0)
+        try:
+            with MockWUServer(stations=stations,
+                              error_rate=1) as server:
+                locations = axwx.scrape_lat_lon_batch(
+                    station_ids, session=session, base_url=server.base_url)
+        finally:
+            session.close()
+        self.assertTrue(locations["error"].str.startswith(
+            "HTTPError").all())
+
+    def test_adaptive_metadata_scraping(self):
+        """
+        Test that adaptive metadata scraping backs off to a throttling
+        server's limit and locates every station
+        """
+        stations = make_mock_stations(40)
+        controller = axwx.AIMDController(initial_limit=8, max_limit=16)
+        session = axwx.WUSession(pool_size=16, max_retries=5,
+                                 backoff_base=0.01, controller=controller)
+        try:
+            with MockWUServer(stations=stations, latency=0.02,
+                              max_in_flight=3) as server:
+                df = axwx.scrape_station_info(
+                    "WA", session=session, base_url=server.base_url,
+                    api_base_url=server.base_url, concurrency=16,
+                    adaptive=True)
+            stats = session.stats()
+        finally:
+            session.close()
+
+        self.assertEqual(list(df["Latitude"]), list(stations["lat"]))
+        self.assertGreater(stats["throttle_events"], 0)
+        self.assertGreater(stats["decreases"], 0)
+        self.assertLess(stats["concurrency_limit"], 8)
+
+        session = axwx.WUSession()
+        try:
+            with self.assertRaises(ValueError):
+                axwx.scrape_lat_lon_batch(["KMOCKWA1"], session=session,
+                                          adaptive=True)
+        finally:
+            session.close()
+
+    def test_errors(self):
+        """
+        Test that the mock server answers with errors at the given rate
+        """
+        session = axwx.WUSession(max_retries=1, backoff_base=0.001)
+        try:
+            with MockWUServer(error_rate=1) as server:
+                with self.assertRaises(requests.HTTPError):
+                    axwx.scrape_data_one_day("KMOCKWA1", 2016, 5, 1,
+                                             base_url=server.base_url,
+                                             session=session)
+            self.assertEqual((server.requests, server.errors), (2, 2))
+        finally:
+            session.close()
+
+    def test_benchmark(self):
+        """
+        Test that the benchmark scrapes every station-day once
+        """
+        for method in ["sequential", "async"]:
+            results = benchmark_scraping(method, n_stations=2,
+                                         n_days=3, latency=0)
+            self.assertEqual(results["units"], 6)
+            self.assertEqual(results["requests"], 6)
+            self.assertGreater(results["units_per_sec"], 0)
+            self.assertGreater(results["latency_p99"], 0)
+
+
+class TestWuObsStore(unittest.TestCase):
+    """
+    Unit tests for wu_obs_store.py
+    """
+
+    def test_round_trip(self):
+        """
+        Test that stored observations read back unchanged, and that reads
+        can be limited to columns and a time range
+        """
+        df = pd.read_pickle(op.join(data_path, "test_wu_data",
+                                    "KWARAINI5_cleaned.p"))
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = axwx.ObsStore(store_dir)
+            store.write("KWARAINI5", df)
+            self.assertEqual(store.list_stations(), ["KWARAINI5"])
+            pd.testing.assert_frame_equal(store.read("KWARAINI5"),
+                                          df.reset_index(drop=True))
+
+            df_subset = store.read("KWARAINI5",
+                                   columns=["Time", "TemperatureF"],
+                                   start="2017-01-31 12:00",
+                                   end="2017-02-01 12:00")
+            obs_time = pd.to_datetime(df["Time"])
+            in_range = ((obs_time >= "2017-01-31 12:00") &
+                        (obs_time < "2017-02-01 12:00")).values
+            pd.testing.assert_frame_equal(
+                df_subset,
+                df.loc[in_range, ["Time", "TemperatureF"]].reset_index(
+                    drop=True))
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_merge_from_store(self):
+        """
+        Test that merging from an observation store matches merging from
+        pickle files
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            stations_csv, wsp_csv, wu_obs_dir = make_merge_test_data(test_dir)
+            store = axwx.ObsStore(op.join(test_dir, "store"))
+            for station_id in ["KTEST1", "KTEST2"]:
+                store.write(station_id, pd.read_pickle(
+                    op.join(wu_obs_dir, station_id + "_cleaned.p")))
+            kwargs = dict(radius_mi=2, lat_range=[47.5, 47.7],
+                          lon_range=[-122.4, -122.2])
+            df_pickle = axwx.enhance_wsp_with_wu_data(stations_csv, wsp_csv,
+                                                      wu_obs_dir, **kwargs)
+            df_store = axwx.enhance_wsp_with_wu_data(stations_csv, wsp_csv,
+                                                     store, **kwargs)
+        finally:
+            shutil.rmtree(test_dir)
+
+        pd.testing.assert_frame_equal(df_store, df_pickle)
+
+    def test_empty_station(self):
+        """
+        Test that a station saved with no observations counts as saved,
+        reads back with its columns, and takes later appends
+        """
+        df = pd.read_pickle(op.join(data_path, "test_wu_data",
+                                    "KWARAINI5_cleaned.p"))
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = axwx.ObsStore(store_dir)
+            store.write("KWARAINI5", df.iloc[:0])
+            self.assertTrue(store.has_station("KWARAINI5"))
+            manifest = axwx.ScrapeManifest(store_dir)
+            manifest.finish_station("KWARAINI5")
+            self.assertTrue(manifest.is_station_done("KWARAINI5", store))
+            empty_df = store.read("KWARAINI5", start="2017-01-01")
+            self.assertEqual(list(empty_df.columns), list(df.columns))
+            self.assertEqual(len(empty_df), 0)
+
+            store.write("KWARAINI5", df, append=True)
+            pd.testing.assert_frame_equal(store.read("KWARAINI5"),
+                                          df.reset_index(drop=True))
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_append_and_compact(self):
+        """
+        Test that appended days read back in order, before and after their
+        parts are merged
+        """
+        df = pd.read_pickle(op.join(data_path, "test_wu_data",
+                                    "KWARAINI5_cleaned.p"))
+        df = df.reset_index(drop=True)
+        obs_date = pd.to_datetime(df["Time"]).dt.date.values
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = axwx.ObsStore(store_dir)
+            for day_number, date in enumerate(pd.unique(obs_date)):
+                store.write("KWARAINI5", df[obs_date == date],
+                            append=day_number > 0)
+            pd.testing.assert_frame_equal(store.read("KWARAINI5"), df)
+
+            store.compact("KWARAINI5")
+            self.assertEqual(len(os.listdir(store.get_station_dir(
+                "KWARAINI5"))), 5)  # one part per month
+            pd.testing.assert_frame_equal(store.read("KWARAINI5"), df)
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_stream_to_store(self):
+        """
+        Test that days are retrieved lazily, and that streaming them into a
+        store gives the same data as saving pickle files
+        """
+        class CountingHandler(StandInWUHandler):
+            def do_GET(self):
+                requested.append(self.path)
+                StandInWUHandler.do_GET(self)
+
+        requested = []
+        server, base_url = start_stand_in_server(CountingHandler)
+        data_dir = tempfile.mkdtemp()
+        session = axwx.WUSession()
+        try:
+            days = axwx.iter_data_multiple_day("KTEST1", 20160530, 20160602,
+                                               delay=0, base_url=base_url,
+                                               session=session)
+            date, day_df = next(days)
+            self.assertEqual(date, pd.Timestamp(2016, 5, 30))
+            self.assertEqual(len(requested), 1)
+            self.assertEqual(len(list(days)), 3)
+
+            store = axwx.ObsStore(op.join(data_dir, "store"))
+            for kwargs in [dict(), dict(store=store)]:
+                axwx.scrape_data_multiple_stations_and_days(
+                    ["KTEST1", "KTEST2"], 20160530, 20160602, data_dir,
+                    delay=0, base_url=base_url, session=session, **kwargs)
+            for station_id in ["KTEST1", "KTEST2"]:
+                pd.testing.assert_frame_equal(
+                    store.read(station_id),
+                    pd.read_pickle(op.join(data_dir, station_id + ".p")))
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(data_dir)
+
+
+class TestWuObservationParsing(unittest.TestCase):
+    """
+    Unit tests for WXDailyHistory parsing in wu_observation_scraping.py
+    """
+
+    content = ("\nTime,TemperatureF,Humidity,WindDirection,Conditions,"
+               "DateUTC<br>\n"
+               "2016-05-01 00:04:00,48.2,87,SW,,2016-05-01 07:04:00,\n<br>\n"
+               "2016-05-01 00:09:00,48.1,86,WSW,,2016-05-01 07:09:00,\n<br>\n"
+               "2016-05-01 00:14:00,48.0,,West,,2016-05-01 07:14:00,\n<br>\n")
+
+    def test_typed_parser(self):
+        """
+        Test that the typed parser gives float and datetime64 columns with
+        the same values as parsing strings and cleaning
+        """
+        df_typed = axwx.parse_daily_history_typed(self.content)
+        self.assertEqual(list(df_typed.dtypes.astype(str)),
+                         ["datetime64[ns]", "float64", "float64", "object",
+                          "float64", "datetime64[ns]"])
+        self.assertTrue(np.isnan(df_typed["Humidity"][2]))
+        self.assertEqual(df_typed["DateUTC"][0],
+                         pd.Timestamp("2016-05-01 07:04:00"))
+
+        df_clean = axwx.clean_obs_data(
+            axwx.parse_daily_history(self.content))
+        df_typed_clean = axwx.clean_obs_data(df_typed)
+        for col in ["TemperatureF", "Humidity", "WindDirection",
+                    "Conditions"]:
+            pd.testing.assert_series_equal(df_typed_clean[col],
+                                           df_clean[col], check_dtype=False)
+        self.assertEqual(list(df_typed_clean["Time"].astype(str)),
+                         list(df_clean["Time"]))
+
+        # unparseable values in numeric columns
+        df_typed = axwx.parse_daily_history_typed(
+            self.content.replace("48.1", "-"))
+        self.assertEqual(df_typed["TemperatureF"].dtype, float)
+        self.assertTrue(np.isnan(df_typed["TemperatureF"][1]))
+
+    def test_typed_parser_empty(self):
+        """
+        Test that responses without data give empty DataFrames
+        """
+        self.assertEqual(axwx.parse_daily_history_typed("").shape, (0, 0))
+        df_typed = axwx.parse_daily_history_typed(
+            self.content.split("<br>")[0] + "<br>\n")
+        self.assertEqual(df_typed.shape, (0, 6))
+
+
+class TestWuConcurrency(unittest.TestCase):
+    """
+    Unit tests for wu_concurrency.py
+    """
+
+    def test_aimd(self):
+        """
+        Test that the limit grows by about one per round of fast responses,
+        holds on slow responses, and halves once per round of throttling
+        """
+        controller = axwx.AIMDController(initial_limit=4, max_limit=8)
+        for _ in range(4):
+            start_time = controller.acquire()
+            controller.release()
+            controller.record(start_time, 0.1, False)
+        self.assertAlmostEqual(controller.limit, 4.9, places=1)
+
+        controller.record(time.monotonic(), 1.0, False)
+        self.assertAlmostEqual(controller.limit, 4.9, places=1)
+
+        start_time = controller.acquire()
+        controller.release()
+        controller.record(start_time, 0.1, True)
+        self.assertAlmostEqual(controller.limit, 2.45, places=1)
+        controller.record(start_time, 0.1, True)  # same round
+        self.assertAlmostEqual(controller.limit, 2.45, places=1)
+        self.assertEqual(controller.stats()["throttle_events"], 2)
+        self.assertEqual(controller.stats()["decreases"], 1)
+
+    def test_adaptive_fetch(self):
+        """
+        Test that adaptive fetching backs off to a throttling server's
+        limit and completes every station-day
+        """
+        data_dir = tempfile.mkdtemp()
+        controller = axwx.AIMDController(initial_limit=8, max_limit=16)
+        session = axwx.WUSession(pool_size=16, max_retries=5,
+                                 backoff_base=0.01, controller=controller)
+        try:
+            with MockWUServer(latency=0.02, max_in_flight=3,
+                              obs_interval=60) as server:
+                axwx.scrape_data_multiple_stations_and_days_async(
+                    ["KMOCKWA1", "KMOCKWA2"], 20160501, 20160510, data_dir,
+                    concurrency=16, requests_per_sec=None,
+                    base_url=server.base_url, session=session,
+                    adaptive=True)
+            for station_id in ["KMOCKWA1", "KMOCKWA2"]:
+                df = pd.read_pickle(op.join(data_dir, station_id + ".p"))
+                self.assertEqual(len(df), 240)
+        finally:
+            session.close()
+            shutil.rmtree(data_dir)
+
+        stats = session.stats()
+        self.assertGreater(stats["throttle_events"], 0)
+        self.assertGreater(stats["decreases"], 0)
+        self.assertLess(stats["concurrency_limit"], 8)
+
+
+class TestWuObservationScraping(unittest.TestCase):
+    """
+    Unit tests for scraping in wu_observation_scraping.py, against a local
+    stand-in WU server
+    """
+
+    def test_range_requests(self):
+        """
+        Test that retrieving runs of days with one request each gives the
+        same data as one request per day, with fewer requests, and falls
+        back to daily requests when a range response is cut off
+        """
+        class TruncatingHandler(StandInWUHandler):
+            max_bytes = 3000  # a bit over two days of readings
+
+        for handler, expected_requests in [(StandInWUHandler, 2),
+                                           (TruncatingHandler, 8)]:
+            server, base_url = start_stand_in_server(handler)
+            session = axwx.WUSession()
+            try:
+                df_daily = axwx.scrape_data_multiple_day(
+                    "KTEST1", 20160528, 20160606, delay=0,
+                    base_url=base_url, session=session)
+                session.reset_stats()
+                df_range = axwx.scrape_data_multiple_day(
+                    "KTEST1", 20160528, 20160606, delay=0,
+                    base_url=base_url, session=session, span_days=7)
+            finally:
+                session.close()
+                server.shutdown()
+                server.server_close()
+
+            self.assertEqual(len(df_daily), 240)
+            pd.testing.assert_frame_equal(df_range, df_daily)
+            self.assertEqual(session.stats()["requests"], expected_requests)
+
+
+class TestWuFetch(unittest.TestCase):
+    """
+    Unit tests for wu_fetch.py, against a local stand-in WU server
+    """
+
+    def test_async_matches_sequential(self):
+        """
+        Test that concurrent scraping saves the same files as sequential
+        scraping
+        """
+        server, base_url = start_stand_in_server()
+        dir_seq = tempfile.mkdtemp()
+        dir_async = tempfile.mkdtemp()
+        station_ids = ["KTEST1", "KTEST2"]
+        try:
+            axwx.scrape_data_multiple_stations_and_days(
+                station_ids, 20160430, 20160502, dir_seq, delay=0,
+                base_url=base_url)
+            axwx.scrape_data_multiple_stations_and_days_async(
+                station_ids, 20160430, 20160502, dir_async, concurrency=4,
+                requests_per_sec=100, base_url=base_url)
+            for station_id in station_ids:
+                df_seq = pd.read_pickle(op.join(dir_seq, station_id + ".p"))
+                df_async = pd.read_pickle(op.join(dir_async,
+                                                  station_id + ".p"))
+                self.assertEqual(df_async.shape, (72, 4))
+                pd.testing.assert_frame_equal(df_async, df_seq)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(dir_seq)
+            shutil.rmtree(dir_async)
+
+    def test_failed_days(self):
+        """
+        Test that days that can't be retrieved are reported without ending
+        the run, that the other days are saved, and that every request
+        attempt (retries included) is rate limited
+        """
+        request_count = [0]
+
+        class FailingDayHandler(StandInWUHandler):
+            def do_GET(self):
+                request_count[0] += 1
+                if "day=1&" in self.path and "KTEST2" in self.path:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    StandInWUHandler.do_GET(self)
+
+        class CountingBucket(axwx.TokenBucket):
+            acquired = 0
+
+            def acquire(self):
+                CountingBucket.acquired += 1
+                axwx.TokenBucket.acquire(self)
+
+        server, base_url = start_stand_in_server(FailingDayHandler)
+        data_dir = tempfile.mkdtemp()
+        session = axwx.WUSession(max_retries=2, backoff_base=0.001,
+                                 rate_limiter=CountingBucket(1000))
+        try:
+            failures = axwx.scrape_data_multiple_stations_and_days_async(
+                ["KTEST1", "KTEST2"], 20160430, 20160502, data_dir,
+                concurrency=3, base_url=base_url, session=session)
+            df = pd.read_pickle(op.join(data_dir, "KTEST2.p"))
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(data_dir)
+
+        self.assertEqual([(station_id, str(date.date()))
+                          for station_id, date, _ in failures],
+                         [("KTEST2", "2016-05-01")])
+        self.assertIsInstance(failures[0][2], requests.HTTPError)
+        self.assertEqual(list(pd.to_datetime(df["Time"]).dt.day.unique()),
+                         [30, 2])
+        self.assertEqual(request_count[0], 8)
+        self.assertEqual(CountingBucket.acquired, 8)
+
+    def test_unsupported_options(self):
+        """
+        Test that options the concurrent fetch doesn't support are
+        rejected rather than ignored
+        """
+        station_csv = op.join(data_path, "station_data.csv")
+        for kwargs in [{"resume": True}, {"span_days": 7}]:
+            with self.assertRaises(ValueError):
+                axwx.get_wu_obs(station_csv, 20160430, 20160502,
+                                tempfile.gettempdir(), concurrency=4,
+                                **kwargs)
+
+    def test_token_bucket(self):
+        """
+        Test that the token bucket holds requests to the given rate
+        """
+        bucket = axwx.TokenBucket(rate=50)
+        start = time.monotonic()
+        threads = [threading.Thread(target=bucket.acquire)
+                   for _ in range(11)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # one token to start with, then 10 more at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+
+class TestWuHttp(unittest.TestCase):
+    """
+    Unit tests for wu_http.py, against a local stand-in WU server
+    """
+
+    def test_keep_alive(self):
+        """
+        Test that sequential requests reuse one pooled connection
+        """
+        client_ports = set()
+
+        class PortRecordingHandler(StandInWUHandler):
+            def do_GET(self):
+                client_ports.add(self.client_address[1])
+                StandInWUHandler.do_GET(self)
+
+        server, base_url = start_stand_in_server(PortRecordingHandler)
+        session = axwx.WUSession()
+        try:
+            for day in [1, 2, 3]:
+                day_df = axwx.scrape_data_one_day("KTEST1", 2016, 5, day,
+                                                  base_url=base_url,
+                                                  session=session)
+                self.assertEqual(day_df.shape, (24, 4))
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(client_ports), 1)
+        self.assertEqual(session.stats()["requests"], 3)
+
+    def test_retry(self):
+        """
+        Test that transient server errors are retried with backoff, and
+        that persistent errors raise once retries run out
+        """
+        fail_counts = {"KFLAKY": 2, "KDOWN": 100}
+
+        class FlakyHandler(StandInWUHandler):
+            def do_GET(self):
+                station_id = parse_qs(urlparse(self.path).query)["ID"][0]
+                if fail_counts.get(station_id, 0) > 0:
+                    fail_counts[station_id] -= 1
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    StandInWUHandler.do_GET(self)
+
+        server, base_url = start_stand_in_server(FlakyHandler)
+        session = axwx.WUSession(max_retries=3, backoff_base=0.01)
+        try:
+            day_df = axwx.scrape_data_one_day("KFLAKY", 2016, 5, 1,
+                                              base_url=base_url,
+                                              session=session)
+            self.assertEqual(day_df.shape, (24, 4))
+            stats = session.stats()
+            self.assertEqual((stats["requests"], stats["retries"],
+                              stats["failures"]), (3, 2, 0))
+            self.assertGreater(stats["latency_p99"], 0)
+
+            with self.assertRaises(requests.HTTPError):
+                axwx.scrape_data_one_day("KDOWN", 2016, 5, 1,
+                                         base_url=base_url, session=session)
+            self.assertEqual(session.stats()["failures"], 1)
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+
+
+class TestWuResponseCache(unittest.TestCase):
+    """
+    Unit tests for wu_response_cache.py
+    """
+
+    def test_scrape_uses_cache(self):
+        """
+        Test that repeated scrapes of past days are served from the cache
+        """
+        request_count = [0]
+
+        class CountingHandler(StandInWUHandler):
+            def do_GET(self):
+                request_count[0] += 1
+                StandInWUHandler.do_GET(self)
+
+        server, base_url = start_stand_in_server(CountingHandler)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = axwx.ResponseCache(cache_dir)
+            df_first = axwx.scrape_data_multiple_day(
+                "KTEST1", 20160501, 20160503, delay=0, base_url=base_url,
+                cache=cache)
+            # a new cache object on the same directory (e.g. a new session)
+            cache = axwx.ResponseCache(cache_dir)
+            df_second = axwx.scrape_data_multiple_day(
+                "KTEST1", 20160502, 20160504, delay=0, base_url=base_url,
+                cache=cache)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(cache_dir)
+
+        self.assertEqual(request_count[0], 4)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        pd.testing.assert_frame_equal(df_second.iloc[:48],
+                                      df_first.iloc[24:].reset_index(
+                                          drop=True))
+
+    def test_errors_not_cached(self):
+        """
+        Test that error responses, and responses that aren't observation
+        tables, are not cached, so the next scrape fetches them again
+        """
+        request_count = [0]
+
+        class FailingOnceHandler(StandInWUHandler):
+            def do_GET(self):
+                request_count[0] += 1
+                if request_count[0] > 1:
+                    return StandInWUHandler.do_GET(self)
+                content = b"<html>Not Found</html>"
+                self.send_response(404)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        server, base_url = start_stand_in_server(FailingOnceHandler)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = axwx.ResponseCache(cache_dir)
+            df_error = axwx.scrape_data_one_day("KTEST1", 2016, 5, 1,
+                                                base_url=base_url,
+                                                cache=cache)
+            df_first = axwx.scrape_data_one_day("KTEST1", 2016, 5, 1,
+                                                base_url=base_url,
+                                                cache=cache)
+            df_second = axwx.scrape_data_one_day("KTEST1", 2016, 5, 1,
+                                                 base_url=base_url,
+                                                 cache=cache)
+
+            date = datetime.date(2016, 5, 2)
+            cache.get("KTEST1", date, "WXDailyHistory",
+                      lambda: make_response("<html>Busy</html>"),
+                      axwx.is_daily_history)
+            self.assertNotIn(("KTEST1", date, "WXDailyHistory"), cache)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(cache_dir)
+
+        self.assertEqual(len(df_error), 0)
+        self.assertEqual(len(df_first), 24)
+        self.assertEqual(request_count[0], 2)
+        pd.testing.assert_frame_equal(df_second, df_first)
+
+    def test_ttl_and_eviction(self):
+        """
+        Test that responses for the current day expire and that the least
+        recently used responses are evicted when over budget
+        """
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = axwx.ResponseCache(cache_dir, max_bytes=250,
+                                       today_ttl=0)
+            today = datetime.date.today()
+            cache.get("KTEST1", today, "WXDailyHistory",
+                      lambda: make_response("a"))
+            content = cache.get("KTEST1", today, "WXDailyHistory",
+                                lambda: make_response("b"))
+            self.assertEqual(content, "b")
+            self.assertEqual(cache.expirations, 1)
+
+            past_days = [datetime.date(2016, 5, day) for day in range(1, 4)]
+            for date in past_days:
+                cache.get("KTEST1", date, "WXDailyHistory",
+                          lambda: make_response("x" * 100))
+            self.assertEqual(cache.evictions, 2)
+            self.assertLessEqual(cache.current_bytes, 250)
+            self.assertIn(("KTEST1", past_days[-1], "WXDailyHistory"), cache)
+            self.assertNotIn(("KTEST1", past_days[0], "WXDailyHistory"),
+                             cache)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class TestWuScrapeManifest(unittest.TestCase):
+    """
+    Unit tests for wu_scrape_manifest.py
+    """
+
+    def test_resume(self):
+        """
+        Test that a rerun after a failure only retrieves the unfinished
+        station-days and saves the same files as an uninterrupted run
+        """
+        requested = []
+        fail = {"station_day": ("KTEST2", "2")}
+
+        class FailingHandler(StandInWUHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                station_day = (query["ID"][0], query["day"][0])
+                if station_day == fail["station_day"]:
+                    self.send_response(500)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    requested.append(station_day)
+                    StandInWUHandler.do_GET(self)
+
+        server, base_url = start_stand_in_server(FailingHandler)
+        session = axwx.WUSession(max_retries=0)
+        data_dir = tempfile.mkdtemp()
+        ref_dir = tempfile.mkdtemp()
+        station_ids = ["KTEST1", "KTEST2", "KTEST3"]
+        try:
+            with self.assertRaises(requests.HTTPError):
+                axwx.scrape_data_multiple_stations_and_days(
+                    station_ids, 20160501, 20160503, data_dir, delay=0,
+                    base_url=base_url, session=session, resume=True)
+            self.assertTrue(op.isfile(op.join(data_dir, "KTEST1.p")))
+            self.assertFalse(op.isfile(op.join(data_dir, "KTEST2.p")))
+
+            # rerun once the server recovers
+            fail["station_day"] = None
+            del requested[:]
+            axwx.scrape_data_multiple_stations_and_days(
+                station_ids, 20160501, 20160503, data_dir, delay=0,
+                base_url=base_url, session=session, resume=True)
+            self.assertEqual(requested, [("KTEST2", "2"), ("KTEST2", "3"),
+                                         ("KTEST3", "1"), ("KTEST3", "2"),
+                                         ("KTEST3", "3")])
+
+            axwx.scrape_data_multiple_stations_and_days(
+                station_ids, 20160501, 20160503, ref_dir, delay=0,
+                base_url=base_url, session=session)
+            for station_id in station_ids:
+                pd.testing.assert_frame_equal(
+                    pd.read_pickle(op.join(data_dir, station_id + ".p")),
+                    pd.read_pickle(op.join(ref_dir, station_id + ".p")))
+            self.assertFalse(op.isdir(op.join(data_dir, "partial",
+                                              "KTEST2")))
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(data_dir)
+            shutil.rmtree(ref_dir)
+
+
+class TestWuStationStore(unittest.TestCase):
+    """
+    Unit tests for wu_station_store.py
+    """
+
+    def test_spatial_queries(self):
+        """
+        Test that box queries match subsetting the station csv, that radius
+        queries match brute-force distances, and that rewritten stations
+        are reindexed
+        """
+        station_csv = op.join(data_path, "station_data.csv")
+        lat_range = [47.4, 47.8]
+        lon_range = [-122.5, -122.2]
+        test_dir = tempfile.mkdtemp()
+        try:
+            store = axwx.StationStore(op.join(test_dir, "stations.db"))
+            store.write_csv(station_csv, state="WA")
+            store_df = axwx.subset_stations_by_coords(store, lat_range,
+                                                      lon_range)
+            csv_df = axwx.subset_stations_by_coords(station_csv, lat_range,
+                                                    lon_range)
+            self.assertEqual(list(store_df.index), list(csv_df.index))
+            np.testing.assert_array_equal(store_df["Latitude"],
+                                          csv_df["Latitude"])
+            self.assertTrue((store_df["state"] == "WA").all())
+
+            radius_df = store.query_radius(47.6, -122.3, 3)
+            all_df = store.query_box([-90, 90], [-180, 180])
+            dists = axwx.get_distance_mi(47.6, -122.3,
+                                         all_df["Latitude"].values,
+                                         all_df["Longitude"].values)
+            self.assertEqual(sorted(radius_df.index),
+                             sorted(all_df.index[dists <= 3]))
+            self.assertTrue((np.diff(radius_df["dist_mi"]) >= 0).all())
+
+            # move one station out of the box and drop another's location
+            moved = store_df.iloc[:2].copy()
+            moved["Latitude"] = [10.0, np.nan]
+            store.write(moved)
+            self.assertEqual(len(store), len(pd.read_csv(station_csv)))
+            self.assertEqual(list(store.query_box(lat_range,
+                                                  lon_range).index),
+                             list(store_df.index[2:]))
+            self.assertEqual(list(store.query_box([9, 11], [-180,
+                                                            180]).index),
+                             [store_df.index[0]])
+            store.close()
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_refresh(self):
+        """
+        Test that refreshing a station store locates only new stations,
+        and marks stations no longer listed as inactive
+        """
+        stations = make_mock_stations(6)
+        test_dir = tempfile.mkdtemp()
+        try:
+            store = axwx.StationStore(op.join(test_dir, "stations.db"))
+            with MockWUServer(stations=stations.iloc[:5]) as server:
+                kwargs = dict(base_url=server.base_url,
+                              api_base_url=server.base_url)
+                changes = axwx.refresh_station_info(
+                    store, "WA", seen_time="2016-05-01", **kwargs)
+                self.assertEqual(changes["new"], list(stations["id"][:5]))
+                self.assertEqual(server.requests, 6)
+
+                # one station retired, one added
+                server.stations = stations.iloc[1:]
+                changes = axwx.refresh_station_info(
+                    store, "WA", seen_time="2016-06-01", **kwargs)
+                self.assertEqual(server.requests, 8)
+                self.assertEqual(changes["new"], [stations["id"][5]])
+                self.assertEqual(changes["retired"], [stations["id"][0]])
+
+                server.stations = stations
+                changes = axwx.refresh_station_info(
+                    store, "WA", seen_time="2016-07-01", **kwargs)
+                self.assertEqual(server.requests, 9)
+                self.assertEqual(changes["reactivated"],
+                                 [stations["id"][0]])
+
+                server.stations = stations.iloc[1:]
+                axwx.refresh_station_info(store, "WA",
+                                          seen_time="2016-08-01", **kwargs)
+            df = store.get_stations("WA")
+            store.close()
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(list(df.index), list(stations["id"]))
+        self.assertEqual(list(df["Latitude"]), list(stations["lat"]))
+        self.assertEqual(list(df["active"]), [False] + [True] * 5)
+        self.assertEqual(list(df["first_seen"].dt.month), [5] * 5 + [6])
+        self.assertEqual(list(df["last_seen"].dt.month), [7] + [8] * 5)
+
+    def test_refresh_relocates_with_cache(self):
+        """
+        Test that stations without a location are located again by the
+        next refresh when a response cache is used
+        """
+        stations = make_mock_stations(3)
+        test_dir = tempfile.mkdtemp()
+        try:
+            store = axwx.StationStore(op.join(test_dir, "stations.db"))
+            cache = axwx.ResponseCache(op.join(test_dir, "cache"))
+            with MockWUServer(stations=stations) as server, \
+                    MockWUServer(stations=stations.iloc[:2]) as api:
+                changes = axwx.refresh_station_info(
+                    store, "WA", cache=cache, base_url=server.base_url,
+                    api_base_url=api.base_url)
+                self.assertEqual(changes["failed"], [stations["id"][2]])
+                self.assertNotIn((stations["id"][2], None,
+                                  axwx.LOCATION_ENDPOINT), cache)
+
+                api.stations = stations
+                changes = axwx.refresh_station_info(
+                    store, "WA", cache=cache, base_url=server.base_url,
+                    api_base_url=api.base_url)
+            df = store.get_stations("WA")
+            store.close()
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEqual(changes["failed"], [])
+        self.assertEqual(list(df["Latitude"]), list(stations["lat"]))
+
+    def test_merge_from_store(self):
+        """
+        Test that merging with stations from a station store matches
+        merging with the station csv
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            stations_csv, wsp_csv, wu_obs_dir = make_merge_test_data(test_dir)
+            store = axwx.StationStore(op.join(test_dir, "stations.db"))
+            store.write_csv(stations_csv)
+            kwargs = dict(radius_mi=2, lat_range=[47.5, 47.7],
+                          lon_range=[-122.4, -122.2])
+            df_csv = axwx.enhance_wsp_with_wu_data(stations_csv, wsp_csv,
+                                                   wu_obs_dir, **kwargs)
+            df_store = axwx.enhance_wsp_with_wu_data(store, wsp_csv,
+                                                     wu_obs_dir, **kwargs)
+            store.close()
+        finally:
+            shutil.rmtree(test_dir)
+
+        pd.testing.assert_frame_equal(df_store, df_csv)
+
 
 if __name__ == '__main__':
     unittest.main(buffer=True)
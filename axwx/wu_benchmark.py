@@ -0,0 +1,191 @@
+"""
+Scraping throughput benchmark
+
+Runs the WU scraping entry points against a local MockWUServer and reports
+throughput (station-days per second for observations, stations per second
+for metadata) and request latency percentiles, so changes to concurrency,
+caching and request batching can be compared offline
+
+Run from the command line with:
+
+    python -m axwx.wu_benchmark --stations 10 --days 7 --latency 0.05
+
+"""
+
+import argparse
+import contextlib
+import io
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from axwx import wu_fetch
+from axwx import wu_http
+from axwx import wu_metadata_scraping as wu_meta
+from axwx import wu_observation_scraping as wu_obs
+from axwx.wu_concurrency import AIMDController
+from axwx.wu_mock_server import MockWUServer, make_mock_stations
+from axwx.wu_response_cache import ResponseCache
+
+# scraping entry points that can be benchmarked
+BENCHMARK_METHODS = ["sequential", "async", "metadata"]
+
+
+def benchmark_scraping(method="sequential", n_stations=10, n_days=7,
+                       latency=0.05, latency_jitter=0, error_rate=0,
+                       concurrency=8, span_days=1, cache_dir=None,
+                       typed=False, start_date=20160501, seed=0,
+                       quiet=True, max_in_flight=None, adaptive=False):
+    """
+    Time one scraping entry point against a local mock WU server
+    :param method: str
+        "sequential" (wu_observation_scraping.
+        scrape_data_multiple_stations_and_days, with no delay), "async"
+        (wu_fetch.scrape_data_multiple_stations_and_days_async, with no
+        rate limit) or "metadata" (wu_metadata_scraping.scrape_station_info)
+    :param n_stations: int
+        number of stations
+    :param n_days: int
+        number of days per station (not used for "metadata")
+    :param latency: float
+        mock server delay before each response (seconds)
+    :param latency_jitter: float
+        mock server random extra delay, up to this many seconds
+    :param error_rate: float
+        fraction of mock server responses that are HTTP 503 errors
+    :param concurrency: int
+        requests in flight for "async" and "metadata" (the maximum, if
+        adaptive)
+    :param span_days: int
+        days per request for "sequential" (see wu_observation_scraping.
+        scrape_data_multiple_day)
+    :param cache_dir: str
+        directory for a response cache (no caching if None); run twice
+        with the same directory to time a warm cache
+    :param typed: bool
+        if True, parse typed columns
+    :param start_date: int (yyyymmdd)
+        first day of observations
+    :param seed: int
+        random seed for mock stations, latency jitter and errors
+    :param quiet: bool
+        if True, hide the scraping functions' progress messages
+    :param max_in_flight: int
+        mock server limit on requests handled at once; requests beyond it
+        are throttled with HTTP 429 (no throttling if None)
+    :param adaptive: bool
+        if True, adapt requests in flight to server feedback (see
+        wu_concurrency.AIMDController)
+    :return: dict with method, units (station-days or stations), seconds,
+        units_per_sec, and the session's request counts, latency
+        percentiles and concurrency metrics (see wu_http.WUSession.stats)
+    """
+    if method not in BENCHMARK_METHODS:
+        raise ValueError("method must be one of " + str(BENCHMARK_METHODS))
+
+    stations = make_mock_stations(n_stations, seed=seed)
+    controller = AIMDController(max_limit=concurrency) if adaptive else None
+    session = wu_http.WUSession(pool_size=concurrency, backoff_base=0.01,
+                                controller=controller)
+    cache = None if cache_dir is None else ResponseCache(cache_dir)
+    end_date = int((pd.to_datetime(str(start_date), format="%Y%m%d") +
+                    pd.Timedelta(days=n_days - 1)).strftime("%Y%m%d"))
+
+    data_dir = tempfile.mkdtemp()
+    server = MockWUServer(latency=latency, latency_jitter=latency_jitter,
+                          error_rate=error_rate, stations=stations,
+                          seed=seed, max_in_flight=max_in_flight)
+    if quiet:
+        output = contextlib.redirect_stdout(io.StringIO())
+    else:
+        output = contextlib.ExitStack()  # leave stdout as is
+    try:
+        server.start()
+        with output:
+            start = time.monotonic()
+            if method == "sequential":
+                wu_obs.scrape_data_multiple_stations_and_days(
+                    list(stations["id"]), start_date, end_date, data_dir,
+                    delay=0, base_url=server.base_url, session=session,
+                    cache=cache, typed=typed, span_days=span_days)
+                units = n_stations * n_days
+            elif method == "async":
+                wu_fetch.scrape_data_multiple_stations_and_days_async(
+                    list(stations["id"]), start_date, end_date, data_dir,
+                    concurrency=concurrency, requests_per_sec=1e9,
+                    base_url=server.base_url, session=session, cache=cache,
+                    typed=typed, adaptive=adaptive)
+                units = n_stations * n_days
+            else:
+                wu_meta.scrape_station_info(stations["state"][0], session,
+                                            cache, base_url=server.base_url,
+                                            api_base_url=server.base_url,
+                                            concurrency=concurrency)
+                units = n_stations
+            seconds = time.monotonic() - start
+    finally:
+        server.stop()
+        session.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    results = {"method": method, "units": units, "seconds": seconds,
+               "units_per_sec": units / seconds}
+    results.update(session.stats())
+
+    return results
+
+
+def print_benchmark(results):
+    """
+    Print benchmark results
+    :param results: dict
+        results from benchmark_scraping
+    :return: None
+    """
+    unit_name = "stations" if results["method"] == "metadata" \
+        else "station-days"
+    print(results["method"] + ": " + str(results["units"]) + " " +
+          unit_name + " in " + "%.2f" % results["seconds"] + " s (" +
+          "%.1f" % results["units_per_sec"] + " " + unit_name + "/s), " +
+          str(results["requests"]) + " requests, " +
+          str(results["retries"]) + " retries, latency p50 " +
+          "%.1f" % (1000 * results["latency_p50"]) + " ms, p99 " +
+          "%.1f" % (1000 * results["latency_p99"]) + " ms")
+    if "concurrency_limit" in results:
+        print("  concurrency limit " +
+              "%.1f" % results["concurrency_limit"] + " (max in flight " +
+              str(results["max_in_flight"]) + "), " +
+              str(results["throttle_events"]) + " throttle events, " +
+              str(results["decreases"]) + " decreases")
+
+
+def benchmark_main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark WU scraping against a local mock server")
+    parser.add_argument("--methods", nargs="+", default=BENCHMARK_METHODS,
+                        choices=BENCHMARK_METHODS)
+    parser.add_argument("--stations", type=int, default=10)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--latency-jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--span-days", type=int, default=1)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--typed", action="store_true")
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--adaptive", action="store_true")
+    args = parser.parse_args()
+
+    for method in args.methods:
+        print_benchmark(benchmark_scraping(
+            method, args.stations, args.days, args.latency,
+            args.latency_jitter, args.error_rate, args.concurrency,
+            args.span_days, args.cache_dir, args.typed,
+            max_in_flight=args.max_in_flight, adaptive=args.adaptive))
+
+
+if __name__ == "__main__":
+    benchmark_main()
@@ -20,9 +20,11 @@ def clean_obs_data(df):
 
     df_clean = copy.deepcopy(df)
 
-    # convert strings to numeric where possible
+    # convert strings to numeric where possible (columns already parsed as
+    # numbers or times, e.g. by parse_daily_history_typed, are kept as is)
     for col in df_clean.columns:
-        df_clean[col] = pd.to_numeric(df_clean[col], errors='ignore')
+        if df_clean[col].dtype == object:
+            df_clean[col] = pd.to_numeric(df_clean[col], errors='ignore')
 
     ignore = ["Time", "WindDirection", "SoftwareType", "Conditions", "Clouds",
               "DateUTC"]
@@ -102,3 +104,27 @@ def clean_and_enhance_wu_data(raw_data_dir, cleaned_data_dir):
         except:
             print("*** skipped " + file + " ***")
             pass
+
+
+def clean_and_enhance_wu_store(raw_store, cleaned_store, station_ids=None):
+    """
+    Clean and enhance raw WU data saved in an observation store
+    :param raw_store: wu_obs_store.ObsStore
+        store with raw WU data
+    :param cleaned_store: wu_obs_store.ObsStore
+        store to which to save cleaned WU data
+    :param station_ids: list
+        stations to clean (all stations in raw_store if None)
+    :return: None
+    """
+    if station_ids is None:
+        station_ids = raw_store.list_stations()
+    for station_id in station_ids:
+        try:
+            df = raw_store.read(station_id)
+            df = clean_obs_data(df)
+            df = enhance_wu_data(df)
+            cleaned_store.write(station_id, df)
+        except:
+            print("*** skipped " + station_id + " ***")
+            pass
@@ -0,0 +1,140 @@
+"""
+Adaptive concurrency control for Weather Underground scraping
+
+Rather than a fixed delay or a fixed number of requests in flight, the limit
+on requests in flight is adjusted from server feedback with AIMD (additive
+increase, multiplicative decrease): it grows slowly while responses are fast
+and successful, and is cut sharply when the server throttles (HTTP 429/5xx)
+or connections fail
+
+"""
+
+from collections import deque
+import threading
+import time
+
+
+class AIMDController(object):
+    """
+    Limit on concurrent requests, adjusted with AIMD. Requests take a slot
+    with acquire() (blocking while the limit is reached), give it back with
+    release(), and report how they went with record(). Safe to share
+    between threads; a wu_http.WUSession given a controller does all of
+    this for each request.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32,
+                 increase=1, decrease_factor=0.5, latency_tolerance=2,
+                 latency_window=100, history=1000):
+        """
+        :param initial_limit: float
+            starting limit on requests in flight
+        :param min_limit: float
+            lowest limit (at least 1)
+        :param max_limit: float
+            highest limit
+        :param increase: float
+            limit increase per limit's worth of healthy responses (i.e.
+            per round of requests)
+        :param decrease_factor: float
+            factor the limit is multiplied by when the server throttles
+        :param latency_tolerance: float
+            responses slower than this multiple of the baseline latency
+            (the fastest recent response) don't increase the limit
+        :param latency_window: int
+            number of recent response latencies the baseline is taken from
+        :param history: int
+            number of most recent limit changes kept for metrics
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.successes = 0
+        self.throttle_events = 0
+        self.decreases = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.limit_history = deque([(time.monotonic(), self.limit)],
+                                   maxlen=history)
+        self._last_decrease = -float("inf")
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot under the limit, then take it
+        :return: float, time the slot was taken (time.monotonic), to pass
+            to record()
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return time.monotonic()
+
+    def release(self):
+        """
+        Give back a slot taken with acquire()
+        :return: None
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def record(self, start_time, latency, throttled):
+        """
+        Adjust the limit after a response
+        :param start_time: float
+            time the request's slot was taken (from acquire)
+        :param latency: float
+            response time (seconds)
+        :param throttled: bool
+            True if the server throttled the request (HTTP 429/5xx) or the
+            connection failed
+        :return: None
+        """
+        with self._condition:
+            if throttled:
+                self.throttle_events += 1
+                # decrease once per round: requests sent before the last
+                # decrease were already in flight at the old limit
+                if start_time > self._last_decrease:
+                    self._set_limit(self.limit * self.decrease_factor)
+                    self._last_decrease = time.monotonic()
+                    self.decreases += 1
+                return
+
+            self.successes += 1
+            self.latencies.append(latency)
+            if latency <= self.latency_tolerance * min(self.latencies):
+                self._set_limit(self.limit + self.increase / self.limit)
+
+    def _set_limit(self, limit):
+        old_limit = int(self.limit)
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+        if int(self.limit) != old_limit:
+            self.limit_history.append((time.monotonic(), self.limit))
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Concurrency metrics
+        :return: dict with concurrency_limit, in_flight, max_in_flight,
+            successes, throttle_events, decreases and latency_baseline
+            (seconds)
+        """
+        with self._condition:
+            return {"concurrency_limit": self.limit,
+                    "in_flight": self.in_flight,
+                    "max_in_flight": self.max_in_flight,
+                    "successes": self.successes,
+                    "throttle_events": self.throttle_events,
+                    "decreases": self.decreases,
+                    "latency_baseline": (min(self.latencies)
+                                         if len(self.latencies) > 0
+                                         else float("nan"))}
@@ -0,0 +1,245 @@
+"""
+Concurrent fetch engine for Weather Underground PWS observation requests
+
+Station-days are fetched with a configurable number of requests in flight,
+limited to a given request rate by a token bucket (rather than by sleeping a
+fixed delay after every request), or adapted to server feedback (see
+wu_concurrency). Station-days that can't be retrieved are reported rather
+than ending the run
+
+"""
+
+import asyncio
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from axwx import wu_http
+from axwx import wu_observation_scraping as wu_obs
+from axwx.wu_concurrency import AIMDController
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter. Tokens are added at a steady rate up to a
+    maximum burst size, and each request takes one. Safe to share between
+    threads; a wu_http.WUSession given a rate limiter takes a token for
+    every request attempt.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: float
+            tokens added per second (i.e. sustained requests per second)
+        :param burst: int
+            maximum number of tokens held, i.e. requests that can be sent
+            at once after an idle period
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Wait until a token is available, then take it
+        :return: None
+        """
+        with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+async def fetch_station_days(station_days, handle_day, concurrency=8,
+                             requests_per_sec=2, base_url=wu_obs.WU_BASE_URL,
+                             session=None, cache=None, typed=False,
+                             adaptive=False):
+    """
+    Fetch PWS data for a list of station-days concurrently
+    :param station_days: list
+        (station ID, date) pairs to fetch, with dates as pandas.Timestamp
+    :param handle_day: function
+        called with (station ID, date, DataFrame) as each day is fetched
+    :param concurrency: int
+        maximum number of requests in flight
+    :param requests_per_sec: float
+        maximum sustained request rate, counting retries (no rate limit if
+        None); applied to the session for the run, unless it has its own
+        rate limiter
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param session: wu_http.WUSession
+        HTTP session; a new session with one pooled connection per request
+        in flight is used (and closed) if None
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses (see wu_observation_scraping.
+        scrape_data_one_day); days found in the cache don't count against
+        the request rate
+    :param typed: bool
+        if True, parse typed columns (see wu_observation_scraping.
+        scrape_data_one_day)
+    :param adaptive: bool
+        if True, adjust the number of requests in flight (up to
+        concurrency) from server feedback, with the session's
+        wu_concurrency.AIMDController; a new session gets a new controller
+    :return: list of (station ID, date, exception) for station-days that
+        could not be retrieved (after the session's retries)
+    """
+    own_session = session is None
+    if own_session:
+        controller = AIMDController(max_limit=concurrency) if adaptive \
+            else None
+        session = wu_http.WUSession(pool_size=concurrency,
+                                    controller=controller)
+    elif adaptive and session.controller is None:
+        raise ValueError("adaptive fetching needs a session with a "
+                         "controller")
+
+    # the rate limit applies to every request attempt the session makes
+    # (so cache hits are free and retries are not)
+    rate_limiter = session.rate_limiter
+    if rate_limiter is None and requests_per_sec is not None:
+        session.rate_limiter = TokenBucket(requests_per_sec)
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    for station_day in station_days:
+        queue.put_nowait(station_day)
+    failures = []
+
+    async def worker(executor):
+        while not queue.empty():
+            station_id, date = queue.get_nowait()
+            print('retrieving data for ' + station_id + " on " +
+                  str(date.year) + "-" + str(date.month) + "-" +
+                  str(date.day))
+            try:
+                day_df = await loop.run_in_executor(
+                    executor, wu_obs.scrape_data_one_day, station_id,
+                    date.year, date.month, date.day, base_url, session,
+                    cache, typed)
+            except Exception as error:
+                print("could not retrieve data for " + station_id + " on " +
+                      str(date.date()) + ": " + type(error).__name__ +
+                      ": " + str(error))
+                failures.append((station_id, date, error))
+                continue
+            handle_day(station_id, date, day_df)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = await asyncio.gather(
+                *[worker(executor) for _ in range(concurrency)],
+                return_exceptions=True)
+    finally:
+        session.rate_limiter = rate_limiter
+        if own_session:
+            session.close()
+
+    # errors other than failed requests (e.g. in handle_day) are raised
+    # once the other workers are done
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    return failures
+
+
+def scrape_data_multiple_stations_and_days_async(station_ids, start_date,
+                                                 end_date, data_dir,
+                                                 concurrency=8,
+                                                 requests_per_sec=2,
+                                                 base_url=wu_obs.WU_BASE_URL,
+                                                 session=None, cache=None,
+                                                 typed=False, store=None,
+                                                 adaptive=False):
+    """
+    Retrieve PWS data for multiple stations over a given date range, with
+    several requests in flight at once. Saves the same files as
+    wu_observation_scraping.scrape_data_multiple_stations_and_days.
+    :param station_ids: list
+        WU PWS station IDs
+    :param start_date: int (yyyymmdd)
+        start date for data retrieval
+    :param end_date: int (yyyymmdd)
+        end date for data retrieval
+    :param data_dir: str
+        data directory to which to save pickle files for each station
+    :param concurrency: int
+        maximum number of requests in flight
+    :param requests_per_sec: float
+        maximum sustained request rate to WU server (no rate limit if None)
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param session: wu_http.WUSession
+        HTTP session (see fetch_station_days)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses (see fetch_station_days)
+    :param typed: bool
+        if True, parse typed columns (see wu_observation_scraping.
+        scrape_data_one_day)
+    :param store: wu_obs_store.ObsStore
+        store to which to save each station's data, instead of pickle files
+    :param adaptive: bool
+        if True, adapt the number of requests in flight to server feedback
+        (see fetch_station_days)
+    :return: list of (station ID, date, exception) for station-days that
+        could not be retrieved; their stations are saved with the days that
+        were, if any (files saved to given directory or store)
+    """
+    date_list = wu_obs.get_date_list(start_date, end_date)
+    station_days = [(station, date) for station in station_ids
+                    for date in date_list]
+
+    # collect days per station; save each station as soon as all of its
+    # days are in
+    station_day_dfs = {station: dict() for station in station_ids}
+
+    def save_station(station_id):
+        day_dfs = station_day_dfs.pop(station_id)
+        df = pd.concat([day_dfs[date] for date in date_list
+                        if date in day_dfs], ignore_index=True)
+        if store is not None:
+            store.write(station_id, df)
+        else:
+            filename = os.path.join(data_dir, station_id + ".p")
+            pickle.dump(df, open(filename, "wb"))
+
+    def handle_day(station_id, date, day_df):
+        day_dfs = station_day_dfs[station_id]
+        day_dfs[date] = day_df
+        if len(day_dfs) == len(date_list):
+            save_station(station_id)
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        failures = loop.run_until_complete(fetch_station_days(
+            station_days, handle_day, concurrency, requests_per_sec,
+            base_url, session, cache, typed, adaptive))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    # stations with failed days: save the days that were retrieved
+    for station_id in list(station_day_dfs):
+        if len(station_day_dfs[station_id]) > 0:
+            save_station(station_id)
+    if len(failures) > 0:
+        print("could not retrieve " + str(len(failures)) + " station-days")
+
+    return failures
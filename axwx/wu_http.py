@@ -0,0 +1,201 @@
+"""
+Shared HTTP session for Weather Underground scraping
+
+Requests to WU go through one pooled keep-alive session, with timeouts and
+bounded retries (exponential backoff with jitter) for transient failures,
+and per-request latency is recorded so slow scrapes can be diagnosed. A
+session can also limit its requests in flight with an adaptive concurrency
+controller (see wu_concurrency), and its request rate with a rate limiter
+(see wu_fetch.TokenBucket)
+
+"""
+
+from collections import deque
+import random
+import threading
+import time
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+# HTTP status codes worth retrying (rate limited or server trouble)
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class WUSession(object):
+    """
+    Pooled keep-alive HTTP session with retries and latency stats. Safe to
+    share between threads.
+    """
+
+    def __init__(self, pool_size=10, max_retries=3, backoff_base=0.5,
+                 backoff_max=30, timeout=(10, 60), latency_history=10000,
+                 controller=None, rate_limiter=None):
+        """
+        :param pool_size: int
+            connections kept open per host (use at least the number of
+            concurrent requests)
+        :param max_retries: int
+            retries per request after a connection error, timeout or
+            retryable status (see RETRY_STATUSES)
+        :param backoff_base: float
+            delay before the first retry (seconds); doubles with each retry
+        :param backoff_max: float
+            maximum delay before a retry (seconds)
+        :param timeout: float or (float, float)
+            connect and read timeouts (seconds)
+        :param latency_history: int
+            number of most recent request latencies kept for stats
+        :param controller: wu_concurrency.AIMDController
+            controller limiting requests in flight, adjusted from server
+            feedback (no limit other than the calling threads if None)
+        :param rate_limiter: wu_fetch.TokenBucket
+            rate limiter whose acquire() is called before every attempt,
+            retries included (no rate limit if None)
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.controller = controller
+        self.rate_limiter = rate_limiter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=latency_history)
+        self._lock = threading.Lock()
+
+    def get_backoff(self, retry):
+        """
+        Delay before a retry: exponential backoff with full jitter
+        :param retry: int
+            retry number (0 for the first retry)
+        :return: float, delay in seconds
+        """
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** retry))
+
+    def get(self, url, **kwargs):
+        """
+        GET a URL, retrying transient failures
+        :param url: string
+            URL to retrieve
+        :param kwargs:
+            passed to requests.Session.get (e.g. params, headers)
+        :return: requests.Response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            if self.controller is not None:
+                slot_time = self.controller.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, **kwargs)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as err:
+                response = None
+                error = err
+            finally:
+                if self.controller is not None:
+                    self.controller.release()
+            latency = time.monotonic() - start
+
+            if self.controller is not None:
+                self.controller.record(
+                    slot_time, latency, error is not None or
+                    response.status_code in RETRY_STATUSES)
+
+            with self._lock:
+                self.requests += 1
+                self.latencies.append(latency)
+
+            if (error is None and
+                    response.status_code not in RETRY_STATUSES):
+                return response
+
+            if attempt < self.max_retries:
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self.get_backoff(attempt))
+
+        # out of retries
+        with self._lock:
+            self.failures += 1
+        if error is not None:
+            raise error
+        response.raise_for_status()
+
+    def stats(self):
+        """
+        Request counters and latency percentiles (over the most recent
+        requests)
+        :return: dict with requests, retries, failures, and latency mean,
+            p50, p90, p99 and max (seconds), plus the controller's metrics
+            if the session has one (see wu_concurrency.AIMDController.stats)
+        """
+        with self._lock:
+            latencies = np.array(self.latencies)
+            stats = {"requests": self.requests,
+                     "retries": self.retries,
+                     "failures": self.failures}
+
+        if len(latencies) > 0:
+            stats.update({"latency_mean": np.mean(latencies),
+                          "latency_p50": np.percentile(latencies, 50),
+                          "latency_p90": np.percentile(latencies, 90),
+                          "latency_p99": np.percentile(latencies, 99),
+                          "latency_max": np.max(latencies)})
+        else:
+            stats.update({"latency_mean": np.nan, "latency_p50": np.nan,
+                          "latency_p90": np.nan, "latency_p99": np.nan,
+                          "latency_max": np.nan})
+
+        if self.controller is not None:
+            stats.update(self.controller.stats())
+
+        return stats
+
+    def reset_stats(self):
+        """
+        Reset request counters and latencies
+        :return: None
+        """
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.failures = 0
+            self.latencies.clear()
+
+    def close(self):
+        """
+        Close pooled connections
+        :return: None
+        """
+        self.session.close()
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Session shared by all WU scraping functions that aren't given one
+    :return: WUSession
+    """
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = WUSession()
+    return _default_session
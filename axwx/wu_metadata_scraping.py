@@ -5,91 +5,519 @@ Code to scrape PWS network metadata
 """
 
 
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import lxml.html
 import pandas as pd
-import urllib3
+import requests
 from bs4 import BeautifulSoup as BS
 import numpy as np
-import requests
-# import time
+from axwx import wu_http
+from axwx.wu_concurrency import AIMDController
+from axwx.wu_observation_scraping import WU_BASE_URL
+from axwx.wu_station_store import StationStore
+
+WU_API_BASE_URL = "https://api.wunderground.com/"
+
+# response cache endpoint name for station locations
+LOCATION_ENDPOINT = "WXDailyHistory_XML"
+
 
+# columns of the station table from scrape_station_info (as in
+# data/station_data.csv, plus the state)
+STATION_TABLE_COLUMNS = ["id", "neighborhood", "city", "type", "Elevation",
+                         "Latitude", "Longitude", "state"]
 
-def scrape_station_info(state="WA"):
+# states (and DC) with WU station lists, for scrape_station_info("all")
+US_STATES = ["AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL",
+             "GA", "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME",
+             "MD", "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH",
+             "NJ", "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI",
+             "SC", "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI",
+             "WY"]
+
+
+def parse_station_list(content):
     """
-    A script to scrape the station information published at the following URL:
+    Parse a ListStations.asp page into a table of stations
+    :param content: bytes or string
+        page content
+    :return: pandas.DataFrame with columns id, neighborhood, city and type,
+        one row per station, in page order
+    """
+    page = lxml.html.fromstring(content)
+
+    station_rows = []
+    for row in page.iterfind(".//tr"):
+        cells = row.findall("td")
+        if len(cells) < 4:
+            continue  # header row
+
+        # the station ID is in the link to the station's page
+        links = cells[0].xpath(".//a/@href")
+        if len(links) > 0 and "ID=" in links[0]:
+            station_id = links[0].split("ID=")[1].split("&")[0]
+        else:
+            station_id = cells[0].text_content()
+
+        # text up to the non-breaking space padding each cell
+        station_rows.append([station_id.strip()] +
+                            [cell.text_content().split("\xa0")[0].strip()
+                             for cell in cells[1:4]])
+
+    return pd.DataFrame(station_rows,
+                        columns=["id", "neighborhood", "city", "type"])
+
+
+def get_station_list(state="WA", session=None, base_url=WU_BASE_URL):
+    """
+    Scrape the list of stations in a state published at the following URL
+    (without station locations):
     https://www.wunderground.com/weatherstation/ListStations.asp?
     selectedState=WA&selectedCountry=United+States&MR=1
     :param state: US State by which to subset WU Station table
-    :return: numpy array with station info
+    :param session: wu_http.WUSession
+        HTTP session (the shared session from wu_http.get_session is used
+        if None)
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :return: pandas.DataFrame with columns id, neighborhood, city and type
+        (see parse_station_list)
     """
-    url = "https://www.wunderground.com/" \
+    if session is None:
+        session = wu_http.get_session()
+
+    url = base_url + \
           "weatherstation/ListStations.asp?selectedState=" \
           + state + "&selectedCountry=United+States&MR=1"
-    raw_site_content = requests.get(url).content
-    soup = BS(raw_site_content, 'html.parser')
+    return parse_station_list(session.get(url).content)
+
+
+def add_station_locations(station_df, session=None, cache=None,
+                          api_base_url=WU_API_BASE_URL, concurrency=8):
+    """
+    Add station locations to a station list
+    :param station_df: pandas.DataFrame
+        stations, with station IDs in column id (from get_station_list)
+    :param session: wu_http.WUSession
+        HTTP session (see scrape_lat_lon_batch)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses for station locations (see
+        scrape_lat_lon_fly)
+    :param api_base_url: string
+        WU API server URL, for station locations (see scrape_lat_lon_fly)
+    :param concurrency: int
+        maximum number of station locations requested at once (see
+        scrape_lat_lon_batch); stations whose location can't be retrieved
+        are listed, and have missing locations
+    :return: pandas.DataFrame with columns STATION_TABLE_COLUMNS (state
+        only if station_df has it)
+    """
+    # grab the latitude, longitude, and elevation metadata
+    locations = scrape_lat_lon_batch(list(station_df["id"]), concurrency,
+                                     session, cache, api_base_url)
+    failed = locations[locations["error"].notnull()]
+    if len(failed) > 0:
+        print("could not retrieve locations for " + str(len(failed)) +
+              " stations:")
+        for station_id, error in failed["error"].items():
+            print("  " + station_id + ": " + error)
+
+    station_df = station_df.copy()
+    # elevations are given like "65 ft"
+    station_df["Elevation"] = pd.to_numeric(
+        locations["elevation"].str.extract(r"(-?[\d.]+)", expand=False),
+        errors="coerce").values.astype(float)
+    station_df["Latitude"] = locations["lat"].values
+    station_df["Longitude"] = locations["lon"].values
+
+    return station_df[[col for col in STATION_TABLE_COLUMNS
+                       if col in station_df.columns]]
+
+
+def get_station_lists(states, session=None, base_url=WU_BASE_URL,
+                      concurrency=8):
+    """
+    Scrape the station lists of several states concurrently (see
+    get_station_list). States whose list can't be retrieved are listed and
+    left out, unless no list could be retrieved, in which case the error
+    is raised.
+    :param states: list
+        US states
+    :param session: wu_http.WUSession
+        HTTP session (the shared session from wu_http.get_session is used
+        if None)
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param concurrency: int
+        maximum number of station lists requested at once
+    :return: pandas.DataFrame with columns id, neighborhood, city, type and
+        state, in the order of the states
+    """
+    if session is None:
+        session = wu_http.get_session()
+
+    def get_state_list(state):
+        start = time.monotonic()
+        try:
+            station_df = get_station_list(state, session, base_url)
+        except requests.RequestException as error:
+            print(state + ": could not retrieve station list: " +
+                  type(error).__name__ + ": " + str(error))
+            return error
+        print(state + ": " + str(len(station_df)) + " stations listed in " +
+              "%.2f" % (time.monotonic() - start) + " s")
+        station_df["state"] = state
+        return station_df
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(get_state_list, states))
+
+    station_dfs = [result for result in results
+                   if isinstance(result, pd.DataFrame)]
+    if len(station_dfs) == 0:
+        raise results[0]
+
+    return pd.concat(station_dfs, ignore_index=True)
+
+
+def scrape_station_info(state="WA", session=None, cache=None,
+                        base_url=WU_BASE_URL, api_base_url=WU_API_BASE_URL,
+                        concurrency=8, output_csv=None, adaptive=False):
+    """
+    A script to scrape the station information published at the following URL:
+    https://www.wunderground.com/weatherstation/ListStations.asp?
+    selectedState=WA&selectedCountry=United+States&MR=1
+    :param state: str or list
+        US State by which to subset WU Station table, a list of states, or
+        "all" (US_STATES). State lists are retrieved concurrently (see
+        get_station_lists); stations listed in more than one state are
+        kept once, under the first of those states.
+    :param session: wu_http.WUSession
+        HTTP session (the shared session from wu_http.get_session is used
+        if None)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses for station locations (see
+        scrape_lat_lon_fly)
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param api_base_url: string
+        WU API server URL, for station locations (see scrape_lat_lon_fly)
+    :param concurrency: int
+        maximum number of station lists or locations requested at once
+        (see scrape_lat_lon_batch); stations whose location can't be
+        retrieved are listed, and have missing locations
+    :param output_csv: str
+        csv filepath to which to also save the station table (not saved if
+        None)
+    :param adaptive: bool
+        if True, adjust the number of requests in flight (up to
+        concurrency) from server feedback, with the session's
+        wu_concurrency.AIMDController; if session is None, a new session
+        with a new controller is used (and closed)
+    :return: pandas.DataFrame with station info: id, neighborhood, city
+        and type, plus Elevation (feet), Latitude and Longitude as floats,
+        and state
+    """
+    own_session = session is None and adaptive
+    if own_session:
+        session = wu_http.WUSession(
+            pool_size=concurrency,
+            controller=AIMDController(max_limit=concurrency))
+    elif session is None:
+        session = wu_http.get_session()
+    elif adaptive and session.controller is None:
+        raise ValueError("adaptive scraping needs a session with a "
+                         "controller")
+
+    try:
+        return _scrape_station_info(state, session, cache, base_url,
+                                    api_base_url, concurrency, output_csv)
+    finally:
+        if own_session:
+            session.close()
 
-    list_stations_info = soup.find_all("tr")
 
-    all_station_info = np.array(['id', 'neighborhood', 'city', 'type', 'lat',
-                                 'lon', 'elevation'])
+def _scrape_station_info(state, session, cache, base_url, api_base_url,
+                         concurrency, output_csv):
+    # scrape_station_info with a session
+    if state == "all":
+        states = US_STATES
+    elif isinstance(state, str):
+        states = [state]
+    else:
+        states = list(state)
 
-    for i in range(1, len(list_stations_info)):  # start at 1 to omit headers
-        station_info = str(list_stations_info[i]).splitlines()
+    station_df = get_station_lists(states, session, base_url, concurrency)
+    station_df = station_df.drop_duplicates("id")
 
-        # pull out station info
-        station_id = station_info[1].split('ID=')[1].split('"')[0]
-        station_neighborhood = station_info[2].split('<td>')[1]
-        station_neighborhood = station_neighborhood.split('\xa0')[0]
-        station_city = station_info[3].split('<td>')[1].split('\xa0')[0]
-        station_type = station_info[4].split('station-type">')[1]
-        station_type = station_type.split('\xa0')[0]
+    # locate stations state by state, to report progress per state
+    state_dfs = []
+    for state, state_df in station_df.groupby("state", sort=False):
+        start = time.monotonic()
+        state_dfs.append(add_station_locations(state_df, session, cache,
+                                               api_base_url, concurrency))
+        seconds = time.monotonic() - start
+        print(state + ": " + str(len(state_df)) + " stations located in " +
+              "%.2f" % seconds + " s (" +
+              "%.1f" % (len(state_df) / max(seconds, 1e-9)) +
+              " stations/s)")
+    if len(state_dfs) > 0:
+        station_df = pd.concat(state_dfs, ignore_index=True)
+    else:
+        station_df = add_station_locations(station_df, session, cache,
+                                           api_base_url, concurrency)
 
-        station_id = station_id.strip()
-        station_neighborhood = station_neighborhood.strip()
-        station_city = station_city.strip()
-        station_type = station_type.strip()
+    if output_csv is not None:
+        station_df.to_csv(output_csv)
 
-        # grab the latitude, longitude, and elevation metadata
-        lat, lon, elev = scrape_lat_lon_fly(station_id)
+    return station_df
 
-        # put all data into an array
-        header = [station_id, station_neighborhood, station_city, station_type,
-                  lat, lon, elev]
-        head_len = len(header)
-        all_station_info = np.vstack([all_station_info, header])
 
-        all_station_info = pd.DataFrame(all_station_info)
-        all_station_info.columns = all_station_info.ix[0, :]
+def refresh_station_info(store, state="WA", session=None, cache=None,
+                         base_url=WU_BASE_URL, api_base_url=WU_API_BASE_URL,
+                         concurrency=8, seen_time=None, adaptive=False):
+    """
+    Update the stations of a state in a station store from the current
+    station list. Only stations not yet in the store (or still without a
+    location) are located, so a refresh costs one request for the list
+    plus one per new station. Listed stations are marked active and seen;
+    stations of the state that are no longer listed are marked inactive.
+    :param store: wu_station_store.StationStore
+        station store to update
+    :param state: US State by which to subset WU Station table
+    :param session: wu_http.WUSession
+        HTTP session (the shared session from wu_http.get_session is used
+        if None)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses for station locations (see
+        scrape_lat_lon_fly); cached responses for stations without a
+        location are removed, so they're requested again
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param api_base_url: string
+        WU API server URL, for station locations (see scrape_lat_lon_fly)
+    :param concurrency: int
+        maximum number of station locations requested at once (see
+        scrape_lat_lon_batch)
+    :param seen_time: str or datetime
+        time the stations were listed (UTC); the current time if None
+    :param adaptive: bool
+        if True, adapt the number of requests in flight to server feedback
+        (see scrape_station_info)
+    :return: dict with lists of station IDs: new (added to the store),
+        reactivated (listed again after being marked inactive), retired
+        (marked inactive) and failed (location couldn't be retrieved)
+    """
+    own_session = session is None and adaptive
+    if own_session:
+        session = wu_http.WUSession(
+            pool_size=concurrency,
+            controller=AIMDController(max_limit=concurrency))
+    elif session is None:
+        session = wu_http.get_session()
+    elif adaptive and session.controller is None:
+        raise ValueError("adaptive scraping needs a session with a "
+                         "controller")
 
-    # do some dataframe editing
-    all_station_info = all_station_info.drop(all_station_info
-                                             .index[0]).reset_index()
-    all_station_info = all_station_info.drop(all_station_info.columns[0],
-                                             axis=1)
-    return(all_station_info.to_csv('./data/station_data_from_FUN.csv'))
+    try:
+        return _refresh_station_info(store, state, session, cache, base_url,
+                                     api_base_url, concurrency, seen_time)
+    finally:
+        if own_session:
+            session.close()
 
 
-def scrape_lat_lon_fly(stationID):
+def _refresh_station_info(store, state, session, cache, base_url,
+                          api_base_url, concurrency, seen_time):
+    # refresh_station_info with a session
+    if seen_time is None:
+        seen_time = pd.Timestamp.now(tz="UTC").tz_localize(None)
+
+    station_df = get_station_list(state, session, base_url)
+    station_df = station_df.drop_duplicates("id")
+
+    stored = store.get_stations(state)
+    is_new = ~station_df["id"].isin(stored.index)
+    unlocated = stored.index[stored["Latitude"].isnull() |
+                             stored["Longitude"].isnull()]
+    to_locate = station_df[is_new | station_df["id"].isin(unlocated)]
+    if cache is not None:
+        # locate stations that couldn't be located before afresh
+        for station_id in unlocated:
+            cache.remove(station_id, None, LOCATION_ENDPOINT)
+    print("refreshing " + state + " stations: " + str(len(station_df)) +
+          " listed, " + str(is_new.sum()) + " new, " + str(len(to_locate)) +
+          " to locate")
+
+    # names can change, so update them for all listed stations
+    store.write(station_df, state)
+    if len(to_locate) > 0:
+        located = add_station_locations(to_locate, session, cache,
+                                        api_base_url, concurrency)
+        store.write(located, state)
+        failed = list(located["id"][located["Latitude"].isnull() |
+                                    located["Longitude"].isnull()])
+    else:
+        failed = []
+    store.mark_seen(station_df["id"], seen_time)
+
+    is_listed = stored.index.isin(station_df["id"])
+    retired = list(stored.index[stored["active"] & ~is_listed])
+    store.mark_inactive(retired)
+
+    return {"new": list(station_df["id"][is_new]),
+            "reactivated": list(stored.index[~stored["active"] & is_listed]),
+            "retired": retired,
+            "failed": failed}
+
+
+def parse_station_location(content):
+    """
+    Parse a station's location from a WXDailyHistory.asp?format=XML
+    response
+    :param content: string
+        response text
+    :return: (latitude, longitude, elevation) as strings, or None if the
+        response has no location
+    """
+    soup = BS(content, 'xml')
+
+    lat = soup.find('latitude')
+    lon = soup.find('longitude')
+    elev = soup.find('elevation')
+    if lat is None or lon is None or elev is None:
+        return None
+
+    return lat.get_text(), lon.get_text(), elev.get_text()
+
+
+def get_station_location(station_id, session=None, cache=None,
+                         base_url=WU_API_BASE_URL):
+    """
+    Latitude, longitude and elevation of a station
+    :param station_id: str
+        PWS station ID
+    :param session: wu_http.WUSession
+        HTTP session (the shared session from wu_http.get_session is used
+        if None)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses (see scrape_lat_lon_fly); responses without
+        a location are not cached
+    :param base_url: string
+        WU API server URL (e.g. a local stand-in server for testing)
+    :return: (latitude, longitude, elevation) as strings; raises
+        requests.RequestException if the request fails, or ValueError if
+        the response has no location
+    """
+
+    if session is None:
+        session = wu_http.get_session()
+
+    url = base_url + 'weatherstation/' \
+        'WXDailyHistory.asp?ID={0}&format=XML'.format(station_id)
+    if cache is None:
+        r = session.get(url).text
+    else:
+        r = cache.get(station_id, None, LOCATION_ENDPOINT,
+                      lambda: session.get(url),
+                      lambda content: parse_station_location(content)
+                      is not None)
+
+    location = parse_station_location(r)
+    if location is None:
+        raise ValueError("no location in response for station " +
+                         station_id)
+
+    return location
+
+
+def scrape_lat_lon_batch(station_ids, concurrency=8, session=None,
+                         cache=None, base_url=WU_API_BASE_URL,
+                         adaptive=False):
+    """
+    Latitude, longitude and elevation of many stations, requested
+    concurrently over one connection pool
+    :param station_ids: list
+        PWS station IDs
+    :param concurrency: int
+        maximum number of requests in flight
+    :param session: wu_http.WUSession
+        HTTP session; a new session with one pooled connection per request
+        in flight is used (and closed) if None
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses (see scrape_lat_lon_fly)
+    :param base_url: string
+        WU API server URL (e.g. a local stand-in server for testing)
+    :param adaptive: bool
+        if True, adjust the number of requests in flight (up to
+        concurrency) from server feedback, with the session's
+        wu_concurrency.AIMDController; a new session gets a new controller
+    :return: pandas.DataFrame indexed by station ID, in the order given,
+        with columns lat and lon (floats), elevation (str) and error (None,
+        or why the station's location couldn't be retrieved, in which case
+        lat, lon and elevation are missing)
+    """
+
+    own_session = session is None
+    if own_session:
+        controller = AIMDController(max_limit=concurrency) if adaptive \
+            else None
+        session = wu_http.WUSession(pool_size=concurrency,
+                                    controller=controller)
+    elif adaptive and session.controller is None:
+        raise ValueError("adaptive scraping needs a session with a "
+                         "controller")
+
+    def locate(station_id):
+        try:
+            lat, lon, elev = get_station_location(station_id, session,
+                                                  cache, base_url)
+            return float(lat), float(lon), elev, None
+        except Exception as err:
+            return np.nan, np.nan, None, type(err).__name__ + ": " + str(err)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = []
+            for i, result in enumerate(executor.map(locate, station_ids)):
+                results.append(result)
+                if (i + 1) % 100 == 0:
+                    print("located " + str(i + 1) + " of " +
+                          str(len(station_ids)) + " stations")
+    finally:
+        if own_session:
+            session.close()
+
+    return pd.DataFrame(results, index=pd.Index(station_ids, name="id"),
+                        columns=["lat", "lon", "elevation", "error"])
+
+
+def scrape_lat_lon_fly(stationID, session=None, cache=None,
+                       base_url=WU_API_BASE_URL):
     """
     Add latitude, longitude and elevation data to the stationID that is
     inputted as the argument to the function. Boom.
     :param stationID: str
         a unique identifier for the weather underground personal
         weather station
+    :param session: wu_http.WUSession
+        HTTP session (the shared session from wu_http.get_session is used
+        if None)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses, checked before going to the network (no
+        caching if None); station locations are cached without a date, so
+        they don't expire
+    :param base_url: string
+        WU API server URL (e.g. a local stand-in server for testing)
     :return: (latitude,longitude,elevation) as a tuple. Double Boom.
+        'NA' for each if the location can't be retrieved (see
+        get_station_location and scrape_lat_lon_batch for the reason)
     """
 
-    http = urllib3.PoolManager(maxsize=10, block=True,
-                               cert_reqs='CERT_REQUIRED')
     try:
-        url = 'https://api.wunderground.com/weatherstation/' \
-              'WXDailyHistory.asp?ID={0}&format=XML'.format(stationID)
-        r = http.request('GET', url, preload_content=False)
-        soup = BS(r, 'xml')
-
-        lat = soup.find_all('latitude')[0].get_text()
-        long = soup.find_all('longitude')[0].get_text()
-        elev = soup.find_all('elevation')[0].get_text()
-        return(lat, long, elev)
+        return get_station_location(stationID, session, cache, base_url)
 
     except Exception as err:
         lat = 'NA'
@@ -101,10 +529,12 @@ def scrape_lat_lon_fly(stationID):
 def subset_stations_by_coords(station_data, lat_range, lon_range):
     """
     Subset station metadata by latitude and longitude
-    :param station_data_csv: str or Pandas.DataFrame
+    :param station_data_csv: str or Pandas.DataFrame or StationStore
         filename of csv with station metadata (from scrape_lat_lon)
         or
         Pandas.DataFrame with station metadata (from scrape_lat_lon)
+        or
+        wu_station_store.StationStore (queried through its spatial index)
     :param lat_range: 2-element list
         min and max latitude range, e.g. [47.4, 47.8]
     :param lon_range: 2-element list
@@ -115,14 +545,16 @@ def subset_stations_by_coords(station_data, lat_range, lon_range):
     lat_range.sort()
     lon_range.sort()
 
-    if isinstance(station_data, str):
+    if isinstance(station_data, StationStore):
+        return station_data.query_box(lat_range, lon_range)
+    elif isinstance(station_data, str):
         df = pd.read_csv(station_data, index_col=1)
         df = df.dropna(subset=["Latitude", "Longitude"])
     elif isinstance(station_data, pd.DataFrame):
         df = station_data
     else:
-        pass
-        # TODO: add exception here if type not supported
+        raise TypeError("station_data must be a csv filename, DataFrame or "
+                        "StationStore")
 
     df = df[(df["Latitude"] >= lat_range[0]) &
             (df["Latitude"] <= lat_range[1]) &
@@ -136,8 +568,9 @@ def get_station_ids_by_coords(station_data_csv, lat_range, lon_range):
     """
     Wrapper around subset_stations_by_coords; returns just the IDs of the
     stations in a box
-    :param station_data_csv: str
-        filename of csv with station metadata (from scrape_lat_lon)
+    :param station_data_csv: str or StationStore
+        filename of csv with station metadata (from scrape_lat_lon), or
+        wu_station_store.StationStore
     :param lat_range: 2-element list
         min and max latitude range, e.g. [47.4, 47.8]
     :param lon_range: 2-element list
@@ -0,0 +1,374 @@
+"""
+Local stand-in for the Weather Underground PWS endpoints
+
+Serves synthetic WXDailyHistory.asp observations (CSV for a day or a custom
+range of days, and XML station locations) and ListStations.asp station
+tables, with configurable latency, error rate and throttling, so scraping
+can be tested and benchmarked without going to wunderground.com
+
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import random
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# columns of synthetic WXDailyHistory.asp observations, as in WU responses
+MOCK_OBS_COLUMNS = ["Time", "TemperatureF", "DewpointF", "PressureIn",
+                    "WindDirection", "WindDirectionDegrees", "WindSpeedMPH",
+                    "WindSpeedGustMPH", "Humidity", "HourlyPrecipIn",
+                    "Conditions", "Clouds", "dailyrainin", "SoftwareType",
+                    "DateUTC"]
+
+COMPASS_POINTS = ["North", "NNE", "NE", "ENE", "East", "ESE", "SE", "SSE",
+                  "South", "SSW", "SW", "WSW", "West", "WNW", "NW", "NNW"]
+
+
+def make_mock_stations(n_stations=20, state="WA", lat_range=[47.4, 47.8],
+                       lon_range=[-122.5, -122.2], seed=0):
+    """
+    Synthetic PWS station metadata
+    :param n_stations: int
+        number of stations
+    :param state: str
+        US state of the stations
+    :param lat_range: 2-element list
+        min and max latitude of the stations
+    :param lon_range: 2-element list
+        min and max longitude of the stations
+    :param seed: int
+        random seed for station locations
+    :return: pandas.DataFrame with columns id, neighborhood, city, type,
+        state, lat, lon and elevation (feet)
+    """
+    rng = np.random.RandomState(seed)
+    station_ids = ["KMOCK" + state + str(i + 1) for i in range(n_stations)]
+    return pd.DataFrame({
+        "id": station_ids,
+        "neighborhood": ["Neighborhood " + str(i + 1)
+                         for i in range(n_stations)],
+        "city": ["City " + str(i % 5 + 1) for i in range(n_stations)],
+        "type": ["MockWX"] * n_stations,
+        "state": [state] * n_stations,
+        "lat": np.round(rng.uniform(lat_range[0], lat_range[1],
+                                    n_stations), 6),
+        "lon": np.round(rng.uniform(lon_range[0], lon_range[1],
+                                    n_stations), 6),
+        "elevation": rng.randint(0, 500, n_stations)},
+        columns=["id", "neighborhood", "city", "type", "state", "lat",
+                 "lon", "elevation"])
+
+
+def make_daily_history(station_id, start_date, end_date, obs_interval=5):
+    """
+    Synthetic WXDailyHistory.asp CSV response: smooth daily cycles, with
+    rain on some days. The same station and time always give the same
+    values.
+    :param station_id: str
+        PWS station ID
+    :param start_date: pandas.Timestamp
+        first day
+    :param end_date: pandas.Timestamp
+        last day (inclusive)
+    :param obs_interval: int
+        minutes between observations
+    :return: str, response text
+    """
+    station_offset = zlib.crc32(station_id.encode("utf-8")) % 1000 / 100.
+    n_obs = ((end_date - start_date).days + 1) * 24 * 60 // obs_interval
+    obs_time = pd.date_range(start_date, periods=n_obs,
+                             freq=str(obs_interval) + "min")
+    hour = obs_time.hour.values + obs_time.minute.values / 60.
+    day_phase = 2 * np.pi * (hour - 9) / 24
+    day_number = obs_time.dayofyear.values
+
+    temp = 50 + station_offset - 10 * np.cos(day_phase)
+    dewpoint = temp - 8 - 4 * np.sin(day_phase)
+    pressure = 30 + 0.2 * np.sin(2 * np.pi * day_number / 7)
+    wind_dir = (200 + 40 * np.sin(day_phase) + 10 * station_offset) % 360
+    wind_speed = 5 + 4 * np.sin(day_phase) ** 2
+    humidity = 80 - 20 * np.sin(day_phase) ** 2
+
+    # rain in the morning every third day
+    is_raining = ((day_number % 3 == 0) & (hour >= 6) & (hour < 12))
+    hourly_precip = np.where(is_raining, 0.05, 0)
+    daily_rain = np.zeros(len(obs_time))
+    for day in np.unique(day_number):
+        is_day = day_number == day
+        daily_rain[is_day] = np.cumsum(hourly_precip[is_day] *
+                                       obs_interval / 60.)
+
+    time_strs = obs_time.strftime("%Y-%m-%d %H:%M:%S")
+    utc_strs = (obs_time + pd.Timedelta(hours=8)).strftime(
+        "%Y-%m-%d %H:%M:%S")
+    lines = ["\n" + ",".join(MOCK_OBS_COLUMNS) + "<br>\n"]
+    for i in range(len(obs_time)):
+        lines.append(",".join([
+            time_strs[i], "%.1f" % temp[i], "%.1f" % dewpoint[i],
+            "%.2f" % pressure[i],
+            COMPASS_POINTS[int(round(wind_dir[i] / 22.5)) % 16],
+            "%d" % wind_dir[i], "%.1f" % wind_speed[i],
+            "%.1f" % (wind_speed[i] * 1.5), "%d" % humidity[i],
+            "%.2f" % hourly_precip[i], "Rain" if is_raining[i] else "",
+            "", "%.2f" % daily_rain[i], "MockWX", utc_strs[i]]) +
+            ",\n<br>\n")
+
+    return "".join(lines)
+
+
+def make_station_xml(station):
+    """
+    Synthetic WXDailyHistory.asp?format=XML response with a station's
+    location
+    :param station: pandas.Series or None
+        station metadata (a row from make_mock_stations); None for an
+        unknown station, which gives a response without a location
+    :return: str, response text
+    """
+    if station is None:
+        return '<?xml version="1.0"?>\n<current_observation>\n' \
+               '</current_observation>\n'
+
+    return '<?xml version="1.0"?>\n' \
+           '<current_observation>\n' \
+           '<location>\n' \
+           '<full>' + station["city"] + ', ' + station["state"] + \
+           '</full>\n' \
+           '<neighborhood>' + station["neighborhood"] + '</neighborhood>\n' \
+           '<city>' + station["city"] + '</city>\n' \
+           '<state>' + station["state"] + '</state>\n' \
+           '<latitude>' + str(station["lat"]) + '</latitude>\n' \
+           '<longitude>' + str(station["lon"]) + '</longitude>\n' \
+           '<elevation>' + str(station["elevation"]) + ' ft</elevation>\n' \
+           '</location>\n' \
+           '<station_id>' + station["id"] + '</station_id>\n' \
+           '</current_observation>\n'
+
+
+def make_station_list_html(stations):
+    """
+    Synthetic ListStations.asp response: a table with one row per station
+    :param stations: pandas.DataFrame
+        station metadata (from make_mock_stations)
+    :return: str, response text
+    """
+    lines = ["<html>", "<body>", '<table id="pwsTable">', "<tr>",
+             "<th>ID</th>", "<th>Neighborhood</th>", "<th>City</th>",
+             "<th>Station Type</th>", "</tr>"]
+    for _, station in stations.iterrows():
+        lines += ["<tr>",
+                  '<td><a href="/personal-weather-station/dashboard?ID=' +
+                  station["id"] + '">' + station["id"] + "</a></td>",
+                  "<td>" + station["neighborhood"] + "&nbsp;</td>",
+                  "<td>" + station["city"] + "&nbsp;</td>",
+                  '<td><span class="station-type">' + station["type"] +
+                  "&nbsp;</span></td>",
+                  "</tr>"]
+    lines += ["</table>", "</body>", "</html>"]
+
+    return "\n".join(lines) + "\n"
+
+
+class MockWUHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for MockWUServer
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+    # headers and body are written separately; without this, delayed ACKs
+    # add ~40 ms to every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0]
+                 for key, values in parse_qs(url.query).items()}
+        is_throttled = not self.server.start_request()
+        try:
+            self.respond(url, query, is_throttled)
+        finally:
+            self.server.end_request()
+
+    def respond(self, url, query, is_throttled):
+        latency = self.server.get_latency()
+        if latency > 0:
+            time.sleep(latency)
+
+        if is_throttled:
+            self.send_content(429, "")
+        elif self.server.is_error():
+            self.send_content(503, "")
+        elif url.path.endswith("/ListStations.asp"):
+            state = query.get("selectedState", "")
+            stations = self.server.stations
+            self.send_content(200, make_station_list_html(
+                stations[stations["state"] == state]))
+        elif url.path.endswith("/WXDailyHistory.asp") and "ID" in query:
+            if query.get("format") == "XML":
+                self.send_content(200, make_station_xml(
+                    self.server.get_station(query["ID"])))
+            else:
+                start_date = pd.Timestamp(int(query["year"]),
+                                          int(query["month"]),
+                                          int(query["day"]))
+                if query.get("graphspan") == "custom":
+                    end_date = pd.Timestamp(int(query["yearend"]),
+                                            int(query["monthend"]),
+                                            int(query["dayend"]))
+                else:
+                    end_date = start_date
+                self.send_content(200, make_daily_history(
+                    query["ID"], start_date, end_date,
+                    self.server.obs_interval))
+        else:
+            self.send_content(404, "")
+
+    def send_content(self, status, content):
+        content = content.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockWUServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in WU server, run in a background thread. Point scraping
+    functions at it with base_url (and api_base_url for station locations),
+    e.g.
+
+        with MockWUServer(latency=0.05) as server:
+            scrape_data_one_day("KMOCKWA1", 2016, 5, 1,
+                                base_url=server.base_url)
+
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, latency_jitter=0, error_rate=0,
+                 stations=None, obs_interval=5, port=0, seed=None,
+                 max_in_flight=None):
+        """
+        :param latency: float
+            delay before each response (seconds)
+        :param latency_jitter: float
+            random extra delay before each response, up to this many
+            seconds
+        :param error_rate: float
+            fraction of requests answered with HTTP 503
+        :param stations: pandas.DataFrame
+            station metadata (from make_mock_stations) for ListStations.asp
+            and station locations; 20 stations in WA if None
+        :param obs_interval: int
+            minutes between synthetic observations
+        :param port: int
+            port to listen on (any free port if 0)
+        :param seed: int
+            random seed for latency jitter and errors
+        :param max_in_flight: int
+            requests handled at once; requests beyond this are throttled
+            with HTTP 429 (no throttling if None)
+        """
+        HTTPServer.__init__(self, ("127.0.0.1", port), MockWUHandler)
+        self.base_url = "http://127.0.0.1:" + str(self.server_port) + "/"
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        if stations is None:
+            stations = make_mock_stations()
+        self.stations = stations
+        self.obs_interval = obs_interval
+        self.max_in_flight = max_in_flight
+
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start_request(self):
+        """
+        Count a request as received and in flight
+        :return: bool, False if the request should be throttled
+        """
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            if (self.max_in_flight is not None and
+                    self.in_flight > self.max_in_flight):
+                self.throttled += 1
+                return False
+            return True
+
+    def end_request(self):
+        """
+        Count a request as no longer in flight
+        :return: None
+        """
+        with self._lock:
+            self.in_flight -= 1
+
+    def get_latency(self):
+        """
+        :return: float, delay before the next response (seconds)
+        """
+        with self._lock:
+            return self.latency + self._random.uniform(0,
+                                                       self.latency_jitter)
+
+    def is_error(self):
+        """
+        :return: bool, True if the next response should be an error
+        """
+        with self._lock:
+            is_error = self._random.random() < self.error_rate
+            if is_error:
+                self.errors += 1
+            return is_error
+
+    def get_station(self, station_id):
+        """
+        :param station_id: str
+            PWS station ID
+        :return: pandas.Series with station metadata, or None if unknown
+        """
+        match = self.stations[self.stations["id"] == station_id]
+        if len(match) == 0:
+            return None
+        return match.iloc[0]
+
+    def start(self):
+        """
+        Start serving in a background thread
+        :return: self
+        """
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        :return: None
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,341 @@
+"""
+Partitioned columnar store for WU PWS observation data
+
+Observations are stored per station and month, one .npy file per column:
+
+    <root>/<station>/<yyyy>-<mm>/c000.npy, c001.npy, ..., _columns.json
+
+Appends add a numbered part to the month (<yyyy>-<mm>.0001, ...) rather
+than rewriting it, so data can be streamed in a day at a time, and
+compact() later merges a month's parts into one (<yyyy>-<mm>.0000-0030,
+covering the parts it replaces). Reads only load the columns asked for, and
+only the months overlapping the time range asked for. A station saved with
+no observations gets an empty part (<root>/<station>/empty), so it still
+counts as saved.
+
+Files are plain numpy arrays (strings are saved as fixed-width unicode,
+never pickled), so they can be loaded safely and don't depend on the pandas
+version that wrote them. HDF5 (PyTables is pinned in requirements.txt)
+would tie the files to the PyTables and pandas versions, and doesn't swap
+in a rewritten month atomically while other processes read it.
+
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+# partition for observations whose time can't be parsed
+UNKNOWN_TIME_PARTITION = "unknown"
+
+# partition marking a station saved with no observations
+EMPTY_PARTITION = "empty"
+
+
+def parse_part_name(part_name):
+    """
+    :param part_name: str
+        partition part directory name, e.g. "2016-05", "2016-05.0003" or
+        "2016-05.0000-0030"
+    :return: (partition, first part number, last part number), or None if
+        the name isn't a part (e.g. left over from an interrupted write)
+    """
+    partition, _, numbers = part_name.partition(".")
+    if numbers == "":
+        return partition, 0, 0
+    first, _, last = numbers.partition("-")
+    if not (first.isdigit() and (last == "" or last.isdigit())):
+        return None
+    return partition, int(first), int(last or first)
+
+
+class ObsStore(object):
+    """
+    Store of observation DataFrames, partitioned by station and by month of
+    the "Time" column
+    """
+
+    def __init__(self, root_dir, time_col="Time"):
+        """
+        :param root_dir: str
+            directory for the store (created if needed)
+        :param time_col: str
+            column with observation times, used for partitioning and time
+            range reads
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.time_col = time_col
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def __repr__(self):
+        return "ObsStore(" + repr(self.root_dir) + ")"
+
+    def get_station_dir(self, station_id):
+        """
+        :param station_id: str
+            PWS station ID
+        :return: str, directory with the station's partitions
+        """
+        return os.path.join(self.root_dir, station_id)
+
+    def list_stations(self):
+        """
+        :return: sorted list of station IDs in the store
+        """
+        return sorted(station_id for station_id in os.listdir(self.root_dir)
+                      if self.has_station(station_id))
+
+    def has_station(self, station_id):
+        """
+        :param station_id: str
+            PWS station ID
+        :return: bool, True if the store has data for the station
+        """
+        return os.path.isdir(self.get_station_dir(station_id))
+
+    def remove_station(self, station_id):
+        """
+        Remove all data for a station
+        :param station_id: str
+            PWS station ID
+        :return: None
+        """
+        shutil.rmtree(self.get_station_dir(station_id), ignore_errors=True)
+
+    def write(self, station_id, df, append=False):
+        """
+        Save observations for a station
+        :param station_id: str
+            PWS station ID
+        :param df: pandas.DataFrame
+            observations, with a time column (strings or datetime64)
+        :param append: bool
+            if True, add to the station's existing observations (as new
+            parts, without rewriting existing data); otherwise replace them
+        :return: None
+        """
+        if not append:
+            self.remove_station(station_id)
+
+        station_dir = self.get_station_dir(station_id)
+        parts = self._list_parts(station_id)
+        if len(df) == 0:
+            # keep the columns, and mark the station as saved
+            if len(parts) == 0:
+                self._write_partition(
+                    os.path.join(station_dir, EMPTY_PARTITION), df)
+            return
+        if EMPTY_PARTITION in parts:
+            shutil.rmtree(os.path.join(station_dir, EMPTY_PARTITION),
+                          ignore_errors=True)
+
+        obs_time = pd.to_datetime(df[self.time_col], errors="coerce")
+        partitions = np.where(obs_time.isnull(), UNKNOWN_TIME_PARTITION,
+                              obs_time.dt.strftime("%Y-%m").values)
+
+        for partition in pd.unique(partitions):
+            if partition in parts:
+                part_name = partition + ".%04d" % (
+                    max(part[1] for part in parts[partition]) + 1)
+            else:
+                part_name = partition
+            self._write_partition(os.path.join(station_dir, part_name),
+                                  df[partitions == partition])
+
+    def compact(self, station_id):
+        """
+        Merge each month's parts (from appends) into one part, for faster
+        reads. Reads running at the same time see either the old parts or
+        the merged part, never both.
+        :param station_id: str
+            PWS station ID
+        :return: None
+        """
+        station_dir = self.get_station_dir(station_id)
+        for partition, parts in self._list_parts(station_id).items():
+            if len(parts) < 2:
+                continue
+            partition_df = pd.concat(
+                [self._read_partition(os.path.join(station_dir, part_name))
+                 for _, _, part_name in parts], ignore_index=True)
+            first_part = parts[0][0]
+            last_part = max(part[1] for part in parts)
+            self._write_partition(
+                os.path.join(station_dir, partition + ".%04d-%04d" % (
+                    first_part, last_part)), partition_df)
+            for _, _, part_name in parts:
+                shutil.rmtree(os.path.join(station_dir, part_name),
+                              ignore_errors=True)
+
+    def _list_parts(self, station_id):
+        """
+        :param station_id: str
+            PWS station ID
+        :return: dict of partition -> list of (first part number, last part
+            number, part directory name) in order, without parts covered by
+            a merged part (see compact)
+        """
+        station_dir = self.get_station_dir(station_id)
+        if not os.path.isdir(station_dir):
+            return dict()
+
+        all_parts = dict()
+        for part_name in os.listdir(station_dir):
+            parsed = parse_part_name(part_name)
+            if parsed is not None:
+                partition, first, last = parsed
+                all_parts.setdefault(partition, []).append((first, last,
+                                                            part_name))
+
+        parts = dict()
+        for partition, partition_parts in all_parts.items():
+            parts[partition] = sorted(
+                part for part in partition_parts
+                if not any(other[0] <= part[0] and part[1] <= other[1] and
+                           other[:2] != part[:2]
+                           for other in partition_parts))
+        return parts
+
+    def read(self, station_id, columns=None, start=None, end=None):
+        """
+        Load observations for a station
+        :param station_id: str
+            PWS station ID
+        :param columns: list
+            columns to load (all columns if None)
+        :param start: datetime-like
+            earliest observation time to load (no lower limit if None)
+        :param end: datetime-like
+            load observations before this time (no upper limit if None);
+            observations with unparseable times are only loaded if neither
+            start nor end is given
+        :return: pandas.DataFrame of observations, by month and in the order
+            written within each month
+        """
+        if not os.path.isdir(self.get_station_dir(station_id)):
+            raise FileNotFoundError("no observations for station " +
+                                    station_id + " in " + repr(self))
+
+        try:
+            return self._read_parts(station_id, columns, start, end)
+        except FileNotFoundError:
+            # parts merged by compact() while reading; list parts again
+            return self._read_parts(station_id, columns, start, end)
+
+    def _read_parts(self, station_id, columns, start, end):
+        station_dir = self.get_station_dir(station_id)
+        has_range = start is not None or end is not None
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+
+        partition_dfs = []
+        for partition, parts in sorted(self._list_parts(station_id).items()):
+            for _, _, part_name in parts:
+                partition_dfs += self._read_part(
+                    os.path.join(station_dir, part_name), partition,
+                    columns, start, end, has_range)
+
+        if len(partition_dfs) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(partition_dfs, ignore_index=True)
+
+    def _read_part(self, partition_dir, partition, columns, start, end,
+                   has_range):
+        """
+        :return: list with the part's observations in the time range, or
+            an empty list if the part is outside the time range
+        """
+        if partition == EMPTY_PARTITION:
+            return [self._read_partition(partition_dir, columns)]
+        if partition == UNKNOWN_TIME_PARTITION:
+            if not has_range:
+                return [self._read_partition(partition_dir, columns)]
+            return []
+
+        # skip months outside the time range
+        month_start = pd.Timestamp(partition + "-01")
+        month_end = month_start + pd.DateOffset(months=1)
+        if ((start is not None and month_end <= start) or
+                (end is not None and month_start >= end)):
+            return []
+
+        # filter rows only in months partly inside the time range
+        if ((start is not None and month_start < start) or
+                (end is not None and month_end > end)):
+            if columns is None or self.time_col in columns:
+                read_columns = columns
+            else:
+                read_columns = list(columns) + [self.time_col]
+            partition_df = self._read_partition(partition_dir, read_columns)
+            obs_time = pd.to_datetime(partition_df[self.time_col],
+                                      errors="coerce")
+            in_range = np.ones(len(obs_time), dtype=bool)
+            if start is not None:
+                in_range &= (obs_time >= start).values
+            if end is not None:
+                in_range &= (obs_time < end).values
+            partition_df = partition_df[in_range]
+            if columns is not None:
+                partition_df = partition_df[list(columns)]
+            return [partition_df]
+
+        return [self._read_partition(partition_dir, columns)]
+
+    @staticmethod
+    def _write_partition(partition_dir, df):
+        tmp_dir = partition_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        column_info = []
+        for col_id, col in enumerate(df.columns):
+            filename = "c%03d.npy" % col_id
+            values = df[col].values
+            info = {"name": col, "file": filename}
+            if values.dtype == object:
+                # strings as fixed-width unicode, with a mask for missing
+                is_null = pd.isnull(values)
+                np.save(os.path.join(tmp_dir, "c%03d_null.npy" % col_id),
+                        is_null)
+                values = np.where(is_null, "", values).astype(str)
+                info["null_file"] = "c%03d_null.npy" % col_id
+            np.save(os.path.join(tmp_dir, filename), values,
+                    allow_pickle=False)
+            column_info.append(info)
+
+        with open(os.path.join(tmp_dir, "_columns.json"), "w") as f:
+            json.dump({"columns": column_info, "rows": len(df)}, f)
+
+        # swap in the new partition
+        old_dir = partition_dir + ".old"
+        if os.path.isdir(partition_dir):
+            os.replace(partition_dir, old_dir)
+        os.replace(tmp_dir, partition_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    @staticmethod
+    def _read_partition(partition_dir, columns=None):
+        with open(os.path.join(partition_dir, "_columns.json")) as f:
+            column_info = json.load(f)["columns"]
+        if columns is not None:
+            info_by_name = {info["name"]: info for info in column_info}
+            column_info = [info_by_name[col] for col in columns
+                           if col in info_by_name]
+
+        data = dict()
+        for info in column_info:
+            values = np.load(os.path.join(partition_dir, info["file"]),
+                             allow_pickle=False)
+            if "null_file" in info:
+                is_null = np.load(os.path.join(partition_dir,
+                                               info["null_file"]),
+                                  allow_pickle=False)
+                values = values.astype(object)
+                values[is_null] = np.nan
+            data[info["name"]] = values
+
+        return pd.DataFrame(data, columns=[info["name"]
+                                           for info in column_info])
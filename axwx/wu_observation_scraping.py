@@ -7,17 +7,34 @@ Code to scrape observation data from wunderground's PWS network
 """
 
 import csv
+import datetime
+import itertools
 import os
 import time
 
+import numpy as np
 import pandas as pd
 import pickle
-import requests
 
+from axwx import wu_http
+from axwx.wu_scrape_manifest import ScrapeManifest
 
-def scrape_data_one_day(station_id, year, month, day):
+WU_BASE_URL = "https://www.wunderground.com/"
+DAILY_HISTORY_ENDPOINT = "WXDailyHistory"
+
+# WXDailyHistory columns parsed as floats and datetimes by
+# parse_daily_history_typed
+WU_NUMERIC_COLUMNS = ["TemperatureF", "DewpointF", "PressureIn",
+                      "WindDirectionDegrees", "WindSpeedMPH",
+                      "WindSpeedGustMPH", "Humidity", "HourlyPrecipIn",
+                      "dailyrainin", "SolarRadiationWatts/m^2"]
+WU_TIME_COLUMNS = ["Time", "DateUTC"]
+
+
+def get_daily_history_url(station_id, year, month, day,
+                          base_url=WU_BASE_URL):
     """
-    Retrieve PWS data for a single station and a single day
+    URL for PWS data for a single station and a single day
     :param station_id: string
         PWS station ID
     :param year: int
@@ -26,7 +43,9 @@ def scrape_data_one_day(station_id, year, month, day):
         month
     :param day: int
         day
-    :return: pandas DataFrame with data for requested day
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :return: string, URL for WXDailyHistory.asp
 
     Sample URL:
     https://www.wunderground.com/weatherstation/WXDailyHistory.asp?
@@ -34,7 +53,7 @@ def scrape_data_one_day(station_id, year, month, day):
 
     """
 
-    url = "https://www.wunderground.com/" \
+    url = base_url + \
           "weatherstation/WXDailyHistory.asp?ID=" \
           + station_id + "&day=" \
           + str(day) + "&month=" \
@@ -42,7 +61,52 @@ def scrape_data_one_day(station_id, year, month, day):
           + str(year) \
           + "&graphspan=day&format=1"
 
-    content = requests.get(url).text
+    return url
+
+
+def get_range_history_url(station_id, start_date, end_date,
+                          base_url=WU_BASE_URL):
+    """
+    URL for PWS data for a single station over a range of days
+    :param station_id: string
+        PWS station ID
+    :param start_date: pandas.Timestamp or datetime.date
+        first day
+    :param end_date: pandas.Timestamp or datetime.date
+        last day (inclusive)
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :return: string, URL for WXDailyHistory.asp
+
+    Sample URL:
+    https://www.wunderground.com/weatherstation/WXDailyHistory.asp?
+    ID=KWAEDMON15&day=1&month=4&year=2017&dayend=7&monthend=4&yearend=2017
+    &graphspan=custom&format=1
+
+    """
+
+    url = base_url + \
+          "weatherstation/WXDailyHistory.asp?ID=" \
+          + station_id + "&day=" \
+          + str(start_date.day) + "&month=" \
+          + str(start_date.month) + "&year=" \
+          + str(start_date.year) + "&dayend=" \
+          + str(end_date.day) + "&monthend=" \
+          + str(end_date.month) + "&yearend=" \
+          + str(end_date.year) \
+          + "&graphspan=custom&format=1"
+
+    return url
+
+
+def parse_daily_history(content):
+    """
+    Parse a WXDailyHistory.asp response into a DataFrame
+    :param content: string
+        response text
+    :return: pandas DataFrame with data for requested day
+    """
+
     content = content.replace("\n", "")
     content = content.replace("<br>", "\n")
     content = content.replace(",\n", "\n")
@@ -54,8 +118,347 @@ def scrape_data_one_day(station_id, year, month, day):
     return data_df
 
 
+def parse_daily_history_typed(content):
+    """
+    Parse a WXDailyHistory.asp response directly into typed columns: floats
+    for numeric columns and datetime64 for Time and DateUTC, rather than the
+    all-string columns from parse_daily_history. Values that can't be parsed
+    in WU_NUMERIC_COLUMNS and WU_TIME_COLUMNS become NaN/NaT; other columns
+    are floats if all of their values are numbers, else strings.
+    :param content: string
+        response text
+    :return: pandas DataFrame with data for requested day
+    """
+
+    # records are separated by <br>; line breaks within the payload are
+    # noise, and data records end with a trailing comma (an extra empty
+    # field, dropped below)
+    records = content.replace("\n", "").split("<br>")
+    header = next(csv.reader(records[:1]), [])
+    rows = list(csv.reader(records[1:-1]))
+    col_values = list(itertools.zip_longest(*rows, fillvalue=""))
+
+    data = dict()
+    for col_id, col in enumerate(header):
+        if col_id < len(col_values):
+            values = col_values[col_id]
+        else:
+            values = ("",) * len(rows)
+
+        if col in WU_TIME_COLUMNS:
+            try:
+                data[col] = np.array(values, dtype="datetime64[s]")
+            except ValueError:
+                data[col] = pd.to_datetime(pd.Series(values, dtype=object),
+                                           errors="coerce").values
+            data[col] = data[col].astype("datetime64[ns]")
+            continue
+
+        try:
+            data[col] = np.array([value or "nan" for value in values],
+                                 dtype=float)
+        except ValueError:
+            if col in WU_NUMERIC_COLUMNS:
+                data[col] = pd.to_numeric(pd.Series(values, dtype=object),
+                                          errors="coerce").values.astype(
+                    float)
+            else:
+                data[col] = np.array(values, dtype=object)
+
+    data_df = pd.DataFrame(data, columns=header, copy=False)
+
+    return data_df
+
+
+def is_daily_history(content):
+    """
+    Whether a response is a WXDailyHistory.asp observation table (rather
+    than e.g. an error page)
+    :param content: string
+        response text
+    :return: bool, True if the response starts with a header with an
+        observation time column (days without observations have just the
+        header)
+    """
+    header = next(csv.reader(content.replace("\n", "").split("<br>")[:1]),
+                  [])
+    return "Time" in header
+
+
+def scrape_data_one_day(station_id, year, month, day, base_url=WU_BASE_URL,
+                        session=None, cache=None, typed=False):
+    """
+    Retrieve PWS data for a single station and a single day
+    :param station_id: string
+        PWS station ID
+    :param year: int
+        year
+    :param month: int
+        month
+    :param day: int
+        day
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param session: wu_http.WUSession
+        HTTP session (the shared session from wu_http.get_session is used
+        if None)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses, checked before going to the network (no
+        caching if None); error responses are not cached
+    :param typed: bool
+        if True, parse numeric columns as floats and times as datetime64
+        (see parse_daily_history_typed); otherwise all columns are strings
+    :return: pandas DataFrame with data for requested day
+    """
+
+    if session is None:
+        session = wu_http.get_session()
+
+    url = get_daily_history_url(station_id, year, month, day, base_url)
+    if cache is None:
+        content = session.get(url).text
+    else:
+        content = cache.get(station_id, datetime.date(year, month, day),
+                            DAILY_HISTORY_ENDPOINT,
+                            lambda: session.get(url), is_daily_history)
+
+    if typed:
+        return parse_daily_history_typed(content)
+    return parse_daily_history(content)
+
+
+def split_history_by_day(content, dates):
+    """
+    Split a multi-day WXDailyHistory.asp response into one response per
+    day, in the same format as a single-day response
+    :param content: string
+        response text for a range of days
+    :param dates: list
+        days requested (pandas.Timestamp), in order
+    :return: dict of date -> day response text, for the days the response
+        fully covers. Days are left out if the response doesn't have
+        observation times, or appears truncated: everything from the last
+        day with observations onwards is left out if the response is cut
+        off mid-record or stops before the last day requested.
+    """
+
+    if not is_daily_history(content):
+        return dict()
+    records = content.replace("\n", "").split("<br>")
+    header = next(csv.reader(records[:1]), [])
+    time_col_id = header.index("Time")
+
+    # group records by the date part of the time column, keeping records
+    # without a recognized date with the day before them
+    day_strs = [date.strftime("%Y-%m-%d") for date in dates]
+    day_records = {day_str: [] for day_str in day_strs}
+    last_day_str = None
+    for record in records[1:-1]:
+        fields = next(csv.reader([record]), [])
+        if len(fields) > time_col_id and fields[time_col_id][:10] in \
+                day_records:
+            last_day_str = fields[time_col_id][:10]
+        day_records[last_day_str or day_strs[0]].append(record)
+
+    # a complete response ends with a record separator; if not, or if the
+    # observations stop early, the response may have been cut off
+    if last_day_str is None:
+        return dict()
+    if records[-1].strip() != "" or last_day_str != day_strs[-1]:
+        n_complete = day_strs.index(last_day_str)
+    else:
+        n_complete = len(day_strs)
+
+    day_contents = dict()
+    for date, day_str in zip(dates[:n_complete], day_strs):
+        day_contents[date] = "\n" + records[0] + "<br>\n" + "".join(
+            record + "\n<br>\n" for record in day_records[day_str])
+
+    return day_contents
+
+
+def scrape_data_date_range(station_id, dates, base_url=WU_BASE_URL,
+                           session=None, cache=None, typed=False):
+    """
+    Retrieve PWS data for a single station over a range of consecutive days
+    with one request, split into days
+    :param station_id: string
+        PWS station ID
+    :param dates: list
+        consecutive days to retrieve (pandas.Timestamp), in order
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param session: wu_http.WUSession
+        HTTP session (see scrape_data_one_day)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses; each complete day is saved to it as if it
+        had been retrieved on its own (see scrape_data_one_day)
+    :param typed: bool
+        if True, parse typed columns (see scrape_data_one_day)
+    :return: dict of date -> pandas DataFrame with data for that day, for
+        the days the response fully covers (see split_history_by_day);
+        days left out have to be retrieved one at a time
+    """
+
+    if session is None:
+        session = wu_http.get_session()
+
+    url = get_range_history_url(station_id, dates[0], dates[-1], base_url)
+    day_contents = split_history_by_day(session.get(url).text, dates)
+
+    day_dfs = dict()
+    for date, day_content in day_contents.items():
+        if cache is not None:
+            cache.put(cache.get_path(station_id, date.date(),
+                                     DAILY_HISTORY_ENDPOINT), day_content)
+        if typed:
+            day_dfs[date] = parse_daily_history_typed(day_content)
+        else:
+            day_dfs[date] = parse_daily_history(day_content)
+
+    return day_dfs
+
+
+def get_date_list(start_date, end_date):
+    """
+    List the days in a date range
+    :param start_date: int (yyyymmdd)
+        start date
+    :param end_date: int (yyyymmdd)
+        end date (inclusive)
+    :return: pandas.DatetimeIndex with one entry per day
+    """
+
+    return pd.date_range(pd.to_datetime(str(start_date), format="%Y%m%d"),
+                         pd.to_datetime(str(end_date), format="%Y%m%d"))
+
+
+def get_date_spans(dates, span_days):
+    """
+    Group days into runs of consecutive days
+    :param dates: list
+        days (pandas.Timestamp), in order
+    :param span_days: int
+        maximum number of days in a run
+    :return: list of lists of days
+    """
+
+    spans = []
+    for date in dates:
+        if (len(spans) > 0 and len(spans[-1]) < span_days and
+                date - spans[-1][-1] == pd.Timedelta(days=1)):
+            spans[-1].append(date)
+        else:
+            spans.append([date])
+
+    return spans
+
+
+def iter_data_multiple_day(station_id, start_date, end_date, delay=3,
+                           base_url=WU_BASE_URL, session=None, cache=None,
+                           manifest=None, typed=False, span_days=1):
+    """
+    Retrieve PWS data for a single station over a given date range, one day
+    at a time. A generator: each day is yielded as soon as it is retrieved,
+    so only one day (or one request's span of days) is held in memory.
+    :param station_id: string
+        PWS station ID
+    :param start_date: int (yyyymmdd)
+        start date for data retrieval
+    :param end_date: int (yyyymmdd)
+        end date for data retrieval
+    :param delay: int
+        delay between requests to WU server (seconds)
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param session: wu_http.WUSession
+        HTTP session (see scrape_data_one_day)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses (see scrape_data_one_day); there is no delay
+        after days found in the cache
+    :param manifest: wu_scrape_manifest.ScrapeManifest
+        manifest of completed days; if given, each day is saved as soon as
+        it is retrieved, and days already completed are loaded from disk
+        instead of retrieved again
+    :param typed: bool
+        if True, parse typed columns (see scrape_data_one_day)
+    :param span_days: int
+        maximum number of days retrieved per request; if more than 1, runs
+        of consecutive days not already completed or cached are retrieved
+        with one request each (see scrape_data_date_range), and days a
+        response doesn't fully cover are retrieved one at a time
+    :return: generator of (pandas.Timestamp, pandas DataFrame) with the
+        data for each day, in order
+    """
+
+    # create date range
+    date_list = get_date_list(start_date, end_date)
+
+    # runs of days to retrieve with one request each, by first day
+    spans = dict()
+    if span_days > 1:
+        pending_dates = [
+            date for date in date_list
+            if not (manifest is not None and
+                    manifest.is_day_done(station_id, date)) and
+            not (cache is not None and
+                 (station_id, date.date(), DAILY_HISTORY_ENDPOINT) in cache)]
+        for span in get_date_spans(pending_dates, span_days):
+            if len(span) > 1:
+                spans[span[0]] = span
+
+    range_dfs = dict()
+    for date in date_list:
+        if manifest is not None and manifest.is_day_done(station_id, date):
+            yield date, manifest.load_day(station_id, date)
+            continue
+
+        if date in spans:
+            span = spans.pop(date)
+            print('retrieving data for ' + station_id + " from " +
+                  str(span[0].year) + "-" + str(span[0].month) + "-" +
+                  str(span[0].day) + " to " + str(span[-1].year) + "-" +
+                  str(span[-1].month) + "-" + str(span[-1].day))
+            range_dfs = scrape_data_date_range(station_id, span,
+                                               base_url=base_url,
+                                               session=session, cache=cache,
+                                               typed=typed)
+            if len(range_dfs) < len(span):
+                print('incomplete response; retrieving ' +
+                      str(len(span) - len(range_dfs)) +
+                      ' remaining days one at a time')
+            time.sleep(delay)
+
+        if date in range_dfs:
+            day_df = range_dfs.pop(date)
+            if manifest is not None:
+                manifest.save_day(station_id, date, day_df)
+            yield date, day_df
+            continue
+
+        temp_yyyy = date.year
+        temp_mm = date.month
+        temp_dd = date.day
+        print('retrieving data for ' + station_id + " on " +
+              str(temp_yyyy) + "-" + str(temp_mm) + "-" + str(temp_dd))
+        is_cached = (cache is not None and
+                     (station_id, date.date(),
+                      DAILY_HISTORY_ENDPOINT) in cache)
+        day_df = scrape_data_one_day(station_id=station_id, year=temp_yyyy,
+                                     month=temp_mm, day=temp_dd,
+                                     base_url=base_url, session=session,
+                                     cache=cache, typed=typed)
+        if manifest is not None:
+            manifest.save_day(station_id, date, day_df)
+        yield date, day_df
+        if not is_cached:
+            time.sleep(delay)
+
+
 def scrape_data_multiple_day(station_id, start_date, end_date,
-                             delay=3, combined_df=None):
+                             delay=3, combined_df=None,
+                             base_url=WU_BASE_URL, session=None, cache=None,
+                             manifest=None, typed=False, span_days=1):
     """
     Retrieve PWS data for a single station over a given date range
     :param station_id: string
@@ -68,6 +471,19 @@ def scrape_data_multiple_day(station_id, start_date, end_date,
         delay between requests to WU server (seconds)
     :param combined_df: pandas.DataFrame
         DataFrame to which to append new observations
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param session: wu_http.WUSession
+        HTTP session (see scrape_data_one_day)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses (see iter_data_multiple_day)
+    :param manifest: wu_scrape_manifest.ScrapeManifest
+        manifest of completed days (see iter_data_multiple_day)
+    :param typed: bool
+        if True, parse typed columns (see scrape_data_one_day)
+    :param span_days: int
+        maximum number of days retrieved per request (see
+        iter_data_multiple_day)
     :return: pandas DataFrame with combined data for period requested
     """
 
@@ -76,31 +492,13 @@ def scrape_data_multiple_day(station_id, start_date, end_date,
     else:
         pass
 
-    # parse out date components
-    start_date_str = str(start_date)
-    start_date_yyyy = int(start_date_str[0:4])
-    start_date_mm = int(start_date_str[4:6])
-    start_date_dd = int(start_date_str[6:8])
-    end_date_str = str(end_date)
-    end_date_yyyy = int(end_date_str[0:4])
-    end_date_mm = int(end_date_str[4:6])
-    end_date_dd = int(end_date_str[6:8])
-
-    # create date range
-    start_date_pd = pd.datetime(start_date_yyyy, start_date_mm, start_date_dd)
-    end_date_pd = pd.datetime(end_date_yyyy, end_date_mm, end_date_dd)
-    date_list = pd.date_range(start_date_pd, end_date_pd)
-
-    for date in date_list:
-        temp_yyyy = date.year
-        temp_mm = date.month
-        temp_dd = date.day
-        print('retrieving data for ' + station_id + " on " +
-              str(temp_yyyy) + "-" + str(temp_mm) + "-" + str(temp_dd))
-        day_df = scrape_data_one_day(station_id=station_id, year=temp_yyyy,
-                                     month=temp_mm, day=temp_dd)
-        combined_df = combined_df.append(day_df, ignore_index=True)
-        time.sleep(delay)
+    # combine all days at once, rather than copying the growing DataFrame
+    # for each day
+    day_dfs = [day_df for _, day_df in iter_data_multiple_day(
+        station_id, start_date, end_date, delay, base_url=base_url,
+        session=session, cache=cache, manifest=manifest, typed=typed,
+        span_days=span_days)]
+    combined_df = pd.concat([combined_df] + day_dfs, ignore_index=True)
 
     return combined_df
 
@@ -111,7 +509,11 @@ def scrape_data_multiple_day(station_id, start_date, end_date,
 
 
 def scrape_data_multiple_stations_and_days(station_ids, start_date,
-                                           end_date, data_dir, delay=1):
+                                           end_date, data_dir, delay=1,
+                                           base_url=WU_BASE_URL,
+                                           session=None, cache=None,
+                                           resume=False, typed=False,
+                                           store=None, span_days=1):
     """
     Retrieve PWS data for multiple stations over a given date range
     :param station_ids: list
@@ -121,19 +523,73 @@ def scrape_data_multiple_stations_and_days(station_ids, start_date,
     :param end_date: int (yyyymmdd)
         end date for data retrieval
     :param data_dir: str
-        data directory to which to save pickle files for each station
+        data directory to which to save pickle files for each station. A
+        pickle file holds a station's whole date range as one DataFrame, so
+        each station's days are kept in memory until they're all in; use
+        store to write days as they arrive instead.
     :param delay: int
         delay between requests to WU server (seconds)
-    :return: None (files saved to given directory)
+    :param base_url: string
+        WU server URL (e.g. a local stand-in server for testing)
+    :param session: wu_http.WUSession
+        HTTP session (see scrape_data_one_day)
+    :param cache: wu_response_cache.ResponseCache
+        cache of raw responses (see scrape_data_one_day)
+    :param resume: bool
+        if True, record each completed station-day in a manifest in data_dir
+        (with partial results saved per day), and skip the stations and days
+        already completed by an earlier, interrupted run with the same date
+        range
+    :param typed: bool
+        if True, parse typed columns (see scrape_data_one_day)
+    :param store: wu_obs_store.ObsStore
+        store to which to save each station's data, instead of pickle files
+        (data_dir is then only used for the resume manifest); days are
+        written as they arrive, so memory use doesn't grow with the date
+        range, and each station's days so far can be read (e.g. for
+        cleaning) while later days are retrieved. Only the store streams
+        days this way.
+    :param span_days: int
+        maximum number of days retrieved per request (see
+        scrape_data_multiple_day)
+    :return: None (files saved to given directory or store)
     """
 
+    if resume:
+        manifest = ScrapeManifest(data_dir, "scrape_manifest_" +
+                                  str(start_date) + "_" + str(end_date) +
+                                  ".jsonl")
+    else:
+        manifest = None
+
     orig_dir = os.getcwd()
     os.chdir(data_dir)
-    for station in station_ids:
-        df = scrape_data_multiple_day(station, start_date, end_date, delay)
-        filename = station + ".p"
-        pickle.dump(df, open(filename, "wb"))
-    os.chdir(orig_dir)
+    try:
+        for station in station_ids:
+            if manifest is not None and manifest.is_station_done(station,
+                                                                 store):
+                print('skipping ' + station + " (already retrieved)")
+                continue
+            days = iter_data_multiple_day(station, start_date, end_date,
+                                          delay, base_url=base_url,
+                                          session=session, cache=cache,
+                                          manifest=manifest, typed=typed,
+                                          span_days=span_days)
+            if store is not None:
+                # write each day as it arrives
+                for day_number, (_, day_df) in enumerate(days):
+                    store.write(station, day_df, append=day_number > 0)
+                store.compact(station)
+            else:
+                df = pd.concat([pd.DataFrame()] +
+                               [day_df for _, day_df in days],
+                               ignore_index=True)
+                filename = station + ".p"
+                pickle.dump(df, open(filename, "wb"))
+            if manifest is not None:
+                manifest.finish_station(station)
+    finally:
+        os.chdir(orig_dir)
 
 # station_ids = ['KWASEATT134', 'KWASEATT166']
 # data_dir = "/Users/Thompson/Desktop/DATA 515/" \
@@ -0,0 +1,244 @@
+"""
+Persistent on-disk cache for raw Weather Underground responses
+
+Responses are stored one file per (station ID, date, endpoint), named by a
+hash of that key, so re-running a scrape over an overlapping date range only
+goes to the network for days not already on disk
+
+"""
+
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+
+class ResponseCache(object):
+    """
+    Disk cache of raw WU responses, bounded by a byte budget. Responses for
+    past days never expire; responses for the current day (which is still
+    being reported) expire after a short TTL. Least recently used responses
+    are evicted when the cache grows past its budget. Only successful
+    responses are cached, so errors are retried on the next request.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, today_ttl=900):
+        """
+        :param cache_dir: string
+            directory for cached responses (created if needed); can be
+            reused across sessions
+        :param max_bytes: int
+            disk budget for cached responses, in bytes (default 10 GB)
+        :param today_ttl: float
+            time after which responses for the current day (or later)
+            expire, in seconds
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.today_ttl = today_ttl
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        # sizes of responses already on disk
+        self._sizes = dict()
+        os.makedirs(cache_dir, exist_ok=True)
+        for dirpath, _, filenames in os.walk(cache_dir):
+            for filename in filenames:
+                if filename.endswith(".txt"):
+                    path = os.path.join(dirpath, filename)
+                    self._sizes[path] = os.path.getsize(path)
+        self.current_bytes = sum(self._sizes.values())
+
+    def get_path(self, station_id, date, endpoint):
+        """
+        File for a cached response
+        :param station_id: string
+            PWS station ID
+        :param date: datetime.date or None
+            date of the response (None for responses not tied to a date)
+        :param endpoint: string
+            WU endpoint, e.g. "WXDailyHistory"
+        :return: string, filepath
+        """
+        date_str = "-" if date is None else date.isoformat()
+        key = "\x1f".join([endpoint, station_id, date_str])
+        key_hash = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key_hash[:2], key_hash + ".txt")
+
+    def is_fresh(self, path, date):
+        """
+        Whether a cached response file can be used
+        :param path: string
+            filepath (from get_path)
+        :param date: datetime.date or None
+            date of the response
+        :return: bool
+        """
+        if path not in self._sizes:
+            return False
+        if date is None or date < datetime.date.today():
+            return True
+        return time.time() - os.path.getmtime(path) < self.today_ttl
+
+    def __contains__(self, key):
+        """
+        :param key: (station ID, date, endpoint)
+        :return: bool, True if a fresh response is cached
+        """
+        station_id, date, endpoint = key
+        return self.is_fresh(self.get_path(station_id, date, endpoint), date)
+
+    def get(self, station_id, date, endpoint, fetch_func, is_valid=None):
+        """
+        Get a cached response, fetching (and caching) it on a miss
+        :param station_id: string
+            PWS station ID
+        :param date: datetime.date or None
+            date of the response (None for responses not tied to a date,
+            which never expire)
+        :param endpoint: string
+            WU endpoint, e.g. "WXDailyHistory"
+        :param fetch_func: function
+            called with no arguments to fetch the response (requests.
+            Response) on a miss
+        :param is_valid: function
+            called with response text; responses for which it returns False
+            are not cached (and cached ones are fetched again). Only
+            successful (2xx) responses are cached either way.
+        :return: string, response text
+        """
+        path = self.get_path(station_id, date, endpoint)
+
+        with self._lock:
+            is_cached = path in self._sizes
+            is_fresh = self.is_fresh(path, date)
+
+        content = None
+        if is_fresh:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    content = f.read()
+                # access time for least-recently-used eviction (mtime is kept
+                # for the current day, so its TTL still counts from fetch)
+                if date is None or date < datetime.date.today():
+                    os.utime(path)
+            except OSError:
+                pass  # removed since checked; fetch again
+            if content is not None and is_valid is not None and \
+                    not is_valid(content):
+                content = None  # cached before it was checked
+
+        with self._lock:
+            if content is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if is_cached and not is_fresh:
+                    self.expirations += 1
+        if content is not None:
+            return content
+
+        response = fetch_func()
+        content = response.text
+        if response.ok and (is_valid is None or is_valid(content)):
+            self.put(path, content)
+
+        return content
+
+    def remove(self, station_id, date, endpoint):
+        """
+        Remove a cached response, if any
+        :param station_id: string
+            PWS station ID
+        :param date: datetime.date or None
+            date of the response
+        :param endpoint: string
+            WU endpoint, e.g. "WXDailyHistory"
+        :return: None
+        """
+        path = self.get_path(station_id, date, endpoint)
+        with self._lock:
+            if path not in self._sizes:
+                return
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.current_bytes -= self._sizes.pop(path)
+
+    def put(self, path, content):
+        """
+        Save a response, evicting least recently used responses if the cache
+        is over budget
+        :param path: string
+            filepath (from get_path)
+        :param content: string
+            response text
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + "." + str(threading.get_ident()) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        nbytes = os.path.getsize(path)
+
+        with self._lock:
+            self.current_bytes += nbytes - self._sizes.get(path, 0)
+            self._sizes[path] = nbytes
+            if self.current_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # evict down to 90% of budget, so eviction isn't needed on every put
+        target_bytes = 0.9 * self.max_bytes
+        paths_by_age = sorted(self._sizes, key=self._get_mtime)
+        for path in paths_by_age:
+            if self.current_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.current_bytes -= self._sizes.pop(path)
+            self.evictions += 1
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    def clear(self):
+        """
+        Remove all cached responses (counters are kept)
+        :return: None
+        """
+        with self._lock:
+            for path in self._sizes:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._sizes.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Cache counters
+        :return: dict with hits, misses, expirations, evictions, entries,
+            current_bytes and max_bytes
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "expirations": self.expirations,
+                    "evictions": self.evictions,
+                    "entries": len(self._sizes),
+                    "current_bytes": self.current_bytes,
+                    "max_bytes": self.max_bytes}
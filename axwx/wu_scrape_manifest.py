@@ -0,0 +1,143 @@
+"""
+Resumable scrape manifest for multi-station WU observation pulls
+
+Each completed station-day is saved to its own partial file and recorded in
+an append-only manifest, so an interrupted pull can restart where it left
+off instead of from zero
+
+"""
+
+import json
+import os
+import pickle
+import shutil
+
+import pandas as pd
+
+
+class ScrapeManifest(object):
+    """
+    Record of completed (station, day) units for a scrape into a data
+    directory, with the partial results for each day. Once all days of a
+    station are in, they are combined into the usual <station>.p file and
+    the partial files are removed.
+    """
+
+    def __init__(self, data_dir, manifest_filename="scrape_manifest.jsonl"):
+        """
+        :param data_dir: str
+            data directory to which station pickle files are saved
+        :param manifest_filename: str
+            manifest file name (in data_dir); an existing manifest is
+            loaded, so a rerun skips finished work
+        """
+        self.data_dir = os.path.abspath(data_dir)
+        self.manifest_filepath = os.path.join(self.data_dir,
+                                              manifest_filename)
+        self.partial_dir = os.path.join(self.data_dir, "partial")
+        self.done_days = set()
+        self.done_stations = set()
+
+        if os.path.isfile(self.manifest_filepath):
+            with open(self.manifest_filepath) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # partly written line from an interruption
+                    if entry["date"] is None:
+                        self.done_stations.add(entry["station"])
+                    else:
+                        self.done_days.add((entry["station"],
+                                            entry["date"]))
+
+    def _record(self, station_id, date_str):
+        with open(self.manifest_filepath, "a") as f:
+            f.write(json.dumps({"station": station_id,
+                                "date": date_str}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_day_filepath(self, station_id, date):
+        """
+        Partial results file for a station-day
+        :param station_id: str
+            PWS station ID
+        :param date: pandas.Timestamp or datetime.date
+            day
+        :return: str, filepath
+        """
+        return os.path.join(self.partial_dir, station_id,
+                            date.strftime("%Y%m%d") + ".p")
+
+    def is_day_done(self, station_id, date):
+        """
+        :param station_id: str
+            PWS station ID
+        :param date: pandas.Timestamp or datetime.date
+            day
+        :return: bool, True if the station-day was completed (and its
+            partial results are still on disk)
+        """
+        return ((station_id, date.strftime("%Y-%m-%d")) in self.done_days and
+                os.path.isfile(self.get_day_filepath(station_id, date)))
+
+    def is_station_done(self, station_id, store=None):
+        """
+        :param station_id: str
+            PWS station ID
+        :param store: wu_obs_store.ObsStore
+            store the station is saved to (None if saved as a pickle file
+            in data_dir)
+        :return: bool, True if the station's data was saved
+        """
+        if station_id not in self.done_stations:
+            return False
+        if store is not None:
+            return store.has_station(station_id)
+        return os.path.isfile(os.path.join(self.data_dir, station_id + ".p"))
+
+    def save_day(self, station_id, date, day_df):
+        """
+        Save the results for a station-day and record it as done
+        :param station_id: str
+            PWS station ID
+        :param date: pandas.Timestamp or datetime.date
+            day
+        :param day_df: pandas.DataFrame
+            data for the day (from scrape_data_one_day)
+        :return: None
+        """
+        filepath = self.get_day_filepath(station_id, date)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath + ".tmp", "wb") as f:
+            pickle.dump(day_df, f)
+        os.replace(filepath + ".tmp", filepath)
+
+        date_str = date.strftime("%Y-%m-%d")
+        self._record(station_id, date_str)
+        self.done_days.add((station_id, date_str))
+
+    def load_day(self, station_id, date):
+        """
+        Load the saved results for a completed station-day
+        :param station_id: str
+            PWS station ID
+        :param date: pandas.Timestamp or datetime.date
+            day
+        :return: pandas.DataFrame
+        """
+        return pd.read_pickle(self.get_day_filepath(station_id, date))
+
+    def finish_station(self, station_id):
+        """
+        Record a station as done (after its data is saved) and remove its
+        partial results
+        :param station_id: str
+            PWS station ID
+        :return: None
+        """
+        self._record(station_id, None)
+        self.done_stations.add(station_id)
+        shutil.rmtree(os.path.join(self.partial_dir, station_id),
+                      ignore_errors=True)
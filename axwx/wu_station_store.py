@@ -0,0 +1,261 @@
+"""
+Persistent store of WU PWS station metadata
+
+Stations are kept in a SQLite database with an R-tree index on their
+locations, so stations in a bounding box or within a radius can be found in
+milliseconds without loading the whole station list, which can then cover
+many states
+
+"""
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# station metadata columns kept in the store (as in data/station_data.csv,
+# plus the state)
+STATION_STORE_COLUMNS = ["neighborhood", "city", "type", "state",
+                         "Elevation", "Latitude", "Longitude"]
+
+# columns tracking whether stations are still listed by WU (see
+# wu_metadata_scraping.refresh_station_info)
+STATION_STATUS_COLUMNS = ["active", "first_seen", "last_seen"]
+
+# format of first_seen and last_seen times
+SEEN_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# R-tree coordinates are 32-bit floats, so boxes are widened by this much
+# (degrees) before the exact check against the stored coordinates
+RTREE_PADDING_DEG = 1e-4
+
+
+class StationStore(object):
+    """
+    SQLite store of station metadata, indexed by location
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: str
+            SQLite database file (created if needed)
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stations ("
+                "station_rowid INTEGER PRIMARY KEY, "
+                "id TEXT NOT NULL UNIQUE, neighborhood TEXT, city TEXT, "
+                "type TEXT, state TEXT, Elevation REAL, Latitude REAL, "
+                "Longitude REAL, active INTEGER NOT NULL DEFAULT 1, "
+                "first_seen TEXT, last_seen TEXT)")
+            self.connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS station_rtree USING "
+                "rtree(station_rowid, min_lat, max_lat, min_lon, max_lon)")
+
+    def __repr__(self):
+        return "StationStore(" + repr(self.db_path) + ")"
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM stations").fetchone()[0]
+
+    def close(self):
+        """
+        Close the database connection
+        :return: None
+        """
+        self.connection.close()
+
+    def write(self, station_df, state=None):
+        """
+        Add stations to the store, or update the metadata of stations
+        already in it
+        :param station_df: pandas.DataFrame
+            station metadata with an "id" column (or station IDs as index)
+            and any of the columns in STATION_STORE_COLUMNS, e.g. from
+            wu_metadata_scraping.scrape_station_info; other columns are
+            left as they are (missing for new stations)
+        :param state: str
+            state of the stations (default: the "state" column, if any)
+        :return: None
+        """
+        if "id" not in station_df.columns:
+            station_df = station_df.rename_axis("id").reset_index()
+        station_df = station_df.copy()
+        if state is not None:
+            station_df["state"] = state
+        columns = [col for col in STATION_STORE_COLUMNS
+                   if col in station_df.columns]
+        station_df = station_df[["id"] + columns]
+        for col in ["Elevation", "Latitude", "Longitude"]:
+            if col not in columns:
+                continue
+            if station_df[col].dtype == object:
+                # elevations in older station lists are given like "65 ft"
+                station_df[col] = station_df[col].astype(str).str.extract(
+                    r"(-?[\d.]+)", expand=False)
+            station_df[col] = pd.to_numeric(station_df[col],
+                                            errors="coerce").astype(float)
+
+        # missing values as NULL
+        rows = [[None if pd.isnull(value) else value for value in row]
+                for row in station_df.itertuples(index=False)]
+
+        if len(columns) > 0:
+            on_conflict = "DO UPDATE SET " + ", ".join(
+                [col + " = excluded." + col for col in columns])
+        else:
+            on_conflict = "DO NOTHING"
+
+        with self.connection:
+            # stations already in the store keep their rowid, so their
+            # index entries are replaced rather than orphaned
+            self.connection.executemany(
+                "INSERT INTO stations (" + ", ".join(["id"] + columns) +
+                ") VALUES (" + ", ".join(["?"] * (len(columns) + 1)) +
+                ") ON CONFLICT (id) " + on_conflict, rows)
+
+            self._set_selected_ids([row[0] for row in rows])
+            self.connection.execute(
+                "DELETE FROM station_rtree WHERE station_rowid IN ("
+                "SELECT station_rowid FROM stations JOIN selected_ids "
+                "USING (id))")
+            self.connection.execute(
+                "INSERT INTO station_rtree SELECT station_rowid, Latitude, "
+                "Latitude, Longitude, Longitude FROM stations JOIN "
+                "selected_ids USING (id) WHERE Latitude IS NOT NULL AND "
+                "Longitude IS NOT NULL")
+
+    def _set_selected_ids(self, station_ids):
+        # station IDs to join against, in a temporary table
+        self.connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS selected_ids "
+            "(id TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM selected_ids")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO selected_ids VALUES (?)",
+            [[station_id] for station_id in station_ids])
+
+    def mark_seen(self, station_ids, seen_time):
+        """
+        Mark stations as active and listed at a given time
+        :param station_ids: list
+            station IDs (stations not in the store are ignored)
+        :param seen_time: str or datetime
+            time the stations were listed (UTC); also their first_seen
+            time, if they didn't have one
+        :return: None
+        """
+        seen_time = pd.Timestamp(seen_time).strftime(SEEN_TIME_FORMAT)
+        with self.connection:
+            self._set_selected_ids(station_ids)
+            self.connection.execute(
+                "UPDATE stations SET active = 1, last_seen = ?, "
+                "first_seen = COALESCE(first_seen, ?) "
+                "WHERE id IN (SELECT id FROM selected_ids)",
+                [seen_time, seen_time])
+
+    def mark_inactive(self, station_ids):
+        """
+        Mark stations as no longer listed (they're kept, with their
+        metadata and last_seen time)
+        :param station_ids: list
+            station IDs
+        :return: None
+        """
+        with self.connection:
+            self._set_selected_ids(station_ids)
+            self.connection.execute(
+                "UPDATE stations SET active = 0 "
+                "WHERE id IN (SELECT id FROM selected_ids)")
+
+    def get_stations(self, state=None):
+        """
+        All stations, or all stations in a state
+        :param state: str
+            state of the stations (all states if None)
+        :return: pandas.DataFrame of station metadata indexed by station ID
+            (see query_box)
+        """
+        if state is None:
+            return self._query("1", [])
+        return self._query("state = ?", [state])
+
+    def write_csv(self, station_data_csv, state=None):
+        """
+        Add stations from a station metadata csv file
+        :param station_data_csv: str
+            filename of csv with station metadata (e.g. data/
+            station_data.csv, or from wu_metadata_scraping.
+            scrape_station_info)
+        :param state: str
+            state of the stations (see write)
+        :return: None
+        """
+        self.write(pd.read_csv(station_data_csv), state)
+
+    def _query(self, where, params):
+        df = pd.read_sql_query(
+            "SELECT id, " +
+            ", ".join(STATION_STORE_COLUMNS + STATION_STATUS_COLUMNS) +
+            " FROM stations WHERE " + where + " ORDER BY station_rowid",
+            self.connection, params=params, index_col="id")
+        for col in ["Elevation", "Latitude", "Longitude"]:
+            df[col] = df[col].astype(float)
+        df["active"] = df["active"].astype(bool)
+        for col in ["first_seen", "last_seen"]:
+            df[col] = pd.to_datetime(df[col], format=SEEN_TIME_FORMAT)
+        return df
+
+    def query_box(self, lat_range, lon_range):
+        """
+        Stations in a bounding box
+        :param lat_range: 2-element list
+            min and max latitude, e.g. [47.4, 47.8]
+        :param lon_range: 2-element list
+            min and max longitude, e.g. [-122.5, -122.2]
+        :return: pandas.DataFrame of station metadata indexed by station ID,
+            with columns STATION_STORE_COLUMNS and STATION_STATUS_COLUMNS,
+            in the order the stations were first added
+        """
+        min_lat, max_lat = sorted(lat_range)
+        min_lon, max_lon = sorted(lon_range)
+        return self._query(
+            "station_rowid IN (SELECT station_rowid FROM station_rtree "
+            "WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND "
+            "min_lon <= ?) AND Latitude BETWEEN ? AND ? AND "
+            "Longitude BETWEEN ? AND ?",
+            [min_lat - RTREE_PADDING_DEG, max_lat + RTREE_PADDING_DEG,
+             min_lon - RTREE_PADDING_DEG, max_lon + RTREE_PADDING_DEG,
+             min_lat, max_lat, min_lon, max_lon])
+
+    def query_radius(self, lat, lon, radius_mi):
+        """
+        Stations within a radius of a location
+        :param lat: float
+            latitude of the location
+        :param lon: float
+            longitude of the location
+        :param radius_mi: float
+            search radius, in miles
+        :return: pandas.DataFrame of station metadata indexed by station ID,
+            with distances in column dist_mi, nearest first
+        """
+        # imported here to avoid a circular import (merge_datasets imports
+        # wu_metadata_scraping, which imports this module)
+        from axwx.merge_datasets import get_distance_mi
+
+        # a box that holds the circle (a degree of latitude is at least
+        # 68.7 miles), then exact distances
+        lat_pad = 1.01 * radius_mi / 68.7
+        lon_pad = lat_pad / max(np.cos(np.radians(abs(lat) + lat_pad)),
+                                1e-6)
+        df = self.query_box([lat - lat_pad, lat + lat_pad],
+                            [lon - lon_pad, lon + lon_pad])
+        df["dist_mi"] = get_distance_mi(lat, lon, df["Latitude"].values,
+                                        df["Longitude"].values)
+        df = df[df["dist_mi"] <= radius_mi]
+
+        return df.sort_values("dist_mi", kind="mergesort")